@@ -3,8 +3,13 @@ import math
 
 from litex.soc.interconnect.csr import *
 from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
 
 class DemosaicBase(Module):
+    # colors alternate along a Bayer line, so the pixel decoded next to "R" is "G0" etc.
+    neighbour_color = {"R": "G0", "G0": "R", "G1": "B", "B": "G1"}
+
+    # marks the first beat of a frame, called for every decoded beat
     def first_pix(self):
         return [If(self.first_pixel,
                 NextValue(self.rgb_first,1),
@@ -13,7 +18,133 @@ class DemosaicBase(Module):
                 NextValue(self.rgb_first,0),
             )]
 
-    def __init__(self, cache, im_w, im_h, min_lines_req, streamout, active):
+    # FSM states decoding the line in given chunk, a rotating datapath has
+    # a single set of states which follows cache.read_chunk
+    def state(self, name, chunk):
+        return name if chunk is None else "{}{}".format(name, chunk)
+
+    def chunks(self):
+        return [None] if self.rotate else list(range(self.mem_chunks))
+
+    def next_chunk(self, chunk):
+        return None if chunk is None else (chunk+1)%self.mem_chunks
+
+    # previous frame decoded by another demosaicer sharing the cache,
+    # continue with the chunk it stopped at
+    def chunk_moved(self, read_chunk, chunk):
+        return 0 if chunk is None else read_chunk != chunk
+
+    def follow_chunk(self, read_chunk, name):
+        if self.rotate:
+            return []
+        return Case(read_chunk, {k: NextState(self.state(name, k)) for k in self.chunks()})
+
+    # even and odd lines of a frame start with different colors
+    def first_color(self, line, even, odd):
+        return If(line[0], NextState(odd)).Else(NextState(even))
+
+    # color decoded by given lane when lane 0 decodes `color`
+    def lane_color(self, color, lane):
+        return color if lane%2 == 0 else self.neighbour_color[color]
+
+    # color decoded by lane 0 in the next cycle,
+    # with even number of pixels per clock every word starts on the same color
+    def next_color(self, color):
+        return self.lane_color(color, self.ppc)
+
+    # width of the kernel shift register able to decode ppc pixels at once,
+    # the right halo has to hold a whole word as pixels are fetched ppc at a time
+    def window_width(self, left, right):
+        return left + self.ppc + max(self.ppc, right)
+
+    # position of the given lane center relative to a single pixel kernel
+    def lane_offset(self, lane, right):
+        return max(self.ppc, right) + self.ppc - 1 - lane - right
+
+    # number of words fetched ahead of the decoded one
+    def fetch_ahead(self, right):
+        return (right + self.ppc - 1)//self.ppc
+
+    # the lines of the kernel of the next line are collected, its first column
+    # is fetched at the line end only then, otherwise FETCH_SYNC fetches it
+    def next_line_ready(self, cache, im_h):
+        return (cache.collected_lines - cache.processed_lines > self.min_lines_required + 1) | (cache.collected_lines >= im_h)
+
+    # register a value for given number of decode pipeline stages
+    def delay(self, value, depth, reset=None):
+        for _ in range(depth):
+            reg = Signal(len(value))
+            if reset is None:
+                self.sync += If(self.advance, reg.eq(value))
+            else:
+                self.sync += If(reset, reg.eq(0)).Elif(self.advance, reg.eq(value))
+            value = reg
+        return value
+
+    # adder tree over `depth` pipeline stages, each stage adds pairs
+    # of the partial sums registered by the previous one
+    def sum_tree(self, terms, depth):
+        if len(terms) == 1:
+            return self.delay(terms[0], depth)
+        if depth == 0:
+            return sum(terms[1:], terms[0])
+        half = len(terms)//2
+        return self.delay(self.sum_tree(terms[:half], depth-1) + self.sum_tree(terms[half:], depth-1), 1)
+
+    def cells_key(self, cells):
+        return tuple((id(c.value), c.start, c.stop) for c in cells)
+
+    # sum of kernel cells, with a pipelined decode stage the sum
+    # is registered by the adder tree stages
+    def cell_sum(self, *cells):
+        key = self.cells_key(cells)
+        if key not in self.sums:
+            self.sums[key] = self.sum_tree(list(cells), self.pipeline)
+        return self.sums[key]
+
+    # mean of 1, 2 or 4 kernel cells, as soon as the kernel sums are ready
+    def kernel_mean(self, *cells):
+        if len(cells) == 1:
+            return self.cell_sum(*cells)
+        return self.cell_sum(*cells) >> int(math.log(len(cells), 2))
+
+    # mean of kernel cells aligned with the decoded color,
+    # delayed past the stages a core adds after the kernel sums
+    def mean(self, *cells):
+        key = ("mean",) + self.cells_key(cells)
+        if key not in self.sums:
+            self.sums[key] = self.delay(self.kernel_mean(*cells), self.post_stages)
+        return self.sums[key]
+
+    # decoders assign the pixel in the FSM or in the pipelined decode stage
+    def assign(self, target, value):
+        return target.eq(value) if self.pipeline else NextValue(target, value)
+
+    # with a pipelined decode stage the FSM only tags the decoded color,
+    # which is decoded when the kernel sums are ready
+    def decode(self, decoder, pattern, state):
+        if not self.pipeline:
+            return decoder(pattern, state)
+        return NextValue(self.decoded_color, self.decode_states.index(state))
+
+    def decode_stage(self, decoder, pattern):
+        if self.pipeline:
+            color = self.delay(self.decoded_color, self.depth-1)
+            pattern = self.delay(pattern, self.depth)
+            self.sync += If(self.advance,
+                Case(color, {i: decoder(pattern, state) for i, state in enumerate(self.decode_states)}),
+            )
+
+    def pack_rgb(self, r_val, g_val, b_val):
+        lane_w = len(self.rgb_data)//self.ppc
+        lsb, bpp = self.bpp-self.out_bpp, self.bpp
+        pad = [C(0, lane_w-3*self.out_bpp)] if lane_w > 3*self.out_bpp else []
+        return Cat(*[Cat(b_val[j][lsb:bpp], g_val[j][lsb:bpp], r_val[j][lsb:bpp], *pad)
+                     for j in range(self.ppc)])
+
+    decode_states = ["DECODE_R", "DECODE_G0", "DECODE_G1", "DECODE_B"]
+
+    def __init__(self, cache, im_w, im_h, min_lines_req, streamout, active, rotate=False, pipeline=0, post_stages=0, out_bpp=None):
 
         self.rgb_ready = Signal(reset=0)
         self.rgb_valid = Signal(reset=0)
@@ -23,14 +154,40 @@ class DemosaicBase(Module):
         self.min_lines_required = min_lines_req
         self.working = Signal(reset=0)
         self.first_pixel = Signal(reset=1)
+        self.bpp = cache.bpp
+        self.ppc = cache.ppc
+        # decode with a single set of FSM states instead of one per line buffer
+        self.rotate = rotate
+        self.mem_chunks = cache.mem_chunks
+        self.reset_state = self.state("FETCH_SYNC", self.chunks()[0])
+        # depth of the output colors, the decoded ones are cut to their most significant bits
+        self.out_bpp = self.bpp if out_bpp is None else out_bpp
+        assert(self.out_bpp <= self.bpp)
+        assert(len(streamout.data) % self.ppc == 0)
+        assert(len(streamout.data)//self.ppc >= 3*self.out_bpp)
+
+        # register stages of the kernel adder trees, followed by the stages a core
+        # adds after the kernel sums, the decoded pixels are registered once more
+        self.pipeline = pipeline
+        self.post_stages = post_stages
+        self.depth = pipeline + post_stages
+        self.advance = Signal()
+        self.decoded_color = Signal(2)
+        self.sums = {}
+        rgb_valid = self.delay(self.rgb_valid, self.depth, reset=cache.force_reset)
+        rgb_first = self.delay(self.rgb_first, self.depth)
+        rgb_last = self.delay(self.rgb_last, self.depth)
+        # working as seen at the output, the core gets idle after its last pixel
+        self.busy = self.delay(self.working, self.depth)
 
         self.comb += [
            If(active,
                #connect rgb stream with local signals
-               self.rgb_ready.eq(streamout.ready),
-               streamout.valid.eq(self.rgb_valid),
-               streamout.last.eq(self.rgb_last),
-               streamout.first.eq(self.rgb_first),
+               self.advance.eq(pipeline_advance(rgb_valid, streamout.ready) if pipeline else streamout.ready),
+               self.rgb_ready.eq(self.advance),
+               streamout.valid.eq(rgb_valid),
+               streamout.last.eq(rgb_last),
+               streamout.first.eq(rgb_first),
                streamout.data.eq(self.rgb_data),
             )
         ]
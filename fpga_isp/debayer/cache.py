@@ -3,25 +3,87 @@ import math
 
 from litex.soc.interconnect.csr import *
 from litex.soc.interconnect import stream
+from fpga_isp.debayer.dpc import *
 
 class MemoryBank(Module):
-    def __init__(self, slots, width, depth):
+    def __init__(self, slots, width, depth, sync_read=False, we_granularity=0):
         # Memory
         mems  = [None]*slots
         ports = [None]*slots
+        rports = [None]*slots
         for i in range(slots):
             mems[i] = Memory(width, depth)
-            ports[i] = mems[i].get_port(write_capable=True, async_read=True)
-            self.specials += ports[i], mems[i]
+            # separate write and read port, a line can be read while another one is written,
+            # registered read port infers block RAM
+            ports[i] = mems[i].get_port(write_capable=True, we_granularity=we_granularity)
+            rports[i] = mems[i].get_port(async_read=not sync_read)
+            self.specials += ports[i], rports[i], mems[i]
         self.mem_size = slots*width*(depth/8)
         self.mems = mems
         self.ports = ports
+        self.rports = rports
 
 class DemosaicCache(Module):
-    def __init__(self, bpp, mem_chunks, streamin, im_w, im_h, mem_treshold, u_reset=Signal(), enable=None):
+    # data of the line `offset` lines below the decoded one, lines outside
+    # of the image read as zeros and form the image border,
+    # the decoded line is in `chunk`, or in read_chunk when chunk is None
+    def line_data(self, chunk, offset):
+        if offset < 0:
+            inside = self.processed_lines >= -offset
+        else:
+            inside = self.processed_lines + offset < self.im_h
+        if chunk is None:
+            lines = Array(self.r_data[(k+offset)%self.mem_chunks] for k in range(self.mem_chunks))
+            data = lines[self.read_chunk]
+        else:
+            data = self.r_data[(chunk+offset)%self.mem_chunks]
+        return Mux(inside, data, 0)
+
+    # read address of the decoded line, without a fixed chunk
+    # all line buffers are read at the same column
+    def line_adr(self, chunk):
+        return self.adrs[0 if chunk is None else chunk]
+
+    # move the kernel rows to the next column, or back to the line start
+    def fetch_adrs(self, chunk, rows, rewind=False):
+        if chunk is None:
+            adr = 0 if rewind else self.adrs[0]+1
+            return [self.adrs_next[k].eq(adr) for k in range(self.mem_chunks)]
+        chunks = [(chunk+r)%self.mem_chunks for r in rows]
+        return [self.adrs_next[k].eq(0 if rewind else self.adrs[k]+1) for k in chunks]
+
+    # whole frame decoded, next one follows in the chunks after the last line
+    def next_frame(self):
+        return [self.frame_read.eq(1),
+                [self.adrs_next[i].eq(0) for i in range(self.mem_chunks)]]
+
+    def __init__(self, bpp, mem_chunks, streamin, im_w, im_h, mem_treshold, u_reset=Signal(), enable=None, ppc=1, sync_read=False,
+                 max_width=None, max_height=None, pack=None, dpc=None):
         assert(mem_chunks>2 and mem_chunks%2 ==0)
+        # pixels per clock, every memory word holds ppc horizontally adjacent pixels
+        assert(ppc in [1, 2, 4])
+        assert(len(streamin.data) == bpp*ppc)
         self.bpp = bpp
+        self.ppc = ppc
+        # pixels stored in one memory word, words wider than the pixel stream
+        # are written lane by lane with per lane write enables
+        if pack is None:
+            pack = ppc
+        assert(pack in [1, 2, 4] and pack % ppc == 0)
+        self.pack = pack
+        lanes = pack//ppc
+        lane_bits = int(math.log(lanes, 2))
         self.mem_chunks = mem_chunks
+        self.im_h = im_h
+        # line width in memory words
+        self.line_w = line_w = im_w >> int(math.log(ppc, 2))
+        # largest supported image, sizes the line buffers and counters,
+        # by default everything what fits in im_w and im_h signals
+        self.max_width = max_width
+        self.max_height = max_height
+        w_bits = len(im_w) if max_width is None else bits_for(max_width)
+        h_bits = len(im_h) if max_height is None else bits_for(max_height)
+        depth = 2**len(im_w) if max_width is None else max_width
 
         self.raw_ready = Signal(reset=1)
         self.raw_valid = Signal(reset=0)
@@ -29,24 +91,58 @@ class DemosaicCache(Module):
         self.raw_first = Signal(reset=0)
         self.raw_data = Signal(len(streamin.data))
 
-        self.submodules.mem_bank = MemoryBank(slots=self.mem_chunks, width=self.bpp, depth=2**len(im_w))
-        self.adrs = [Signal(len(im_w)+1) for _ in range(self.mem_chunks)]
-        self.r_data = [Signal(self.bpp) for _ in range(self.mem_chunks)]
+        self.submodules.mem_bank = MemoryBank(slots=self.mem_chunks,
+                                              width=self.bpp*pack,
+                                              depth=(depth+pack-1)//pack,
+                                              sync_read=sync_read,
+                                              we_granularity=self.bpp*ppc if lanes > 1 else 0)
+        self.sync_read = sync_read
+        # read addresses of each line buffer, driven by the demosaicers
+        self.adrs = [Signal(w_bits+1) for _ in range(self.mem_chunks)]
+        # addresses are updated only through adrs_next (also by demosaicers),
+        # so that a synchronous read port can be given the address one cycle ahead
+        self.adrs_next = [Signal(w_bits+1) for _ in range(self.mem_chunks)]
+        self.comb += [self.adrs_next[i].eq(self.adrs[i]) for i in range(self.mem_chunks)]
+        self.sync += [self.adrs[i].eq(self.adrs_next[i]) for i in range(self.mem_chunks)]
+        self.r_data = [Signal(self.bpp*ppc) for _ in range(self.mem_chunks)]
+        # write side, only the chunk of the collected line is written, in pixel stream words
+        self.we = [Signal() for _ in range(self.mem_chunks)]
+        self.wadr = Signal(w_bits+1)
         self.current_chunk = Signal(int(math.log(self.mem_chunks,2))+1)
-        self.collected_lines = Signal(len(im_h)+1, reset=0)
-        self.processed_lines = Signal(len(im_h)+1, reset=0)
-        self.memory_reset = Signal(1, reset=0)
-        self.push_zeros = Signal(1, reset=0)
+        # chunk of the decoded line
+        self.read_chunk = Signal(len(self.current_chunk))
+        # both counted from the first line of the decoded frame, lines of the
+        # next frame are collected while the last lines are still decoded
+        self.collected_lines = Signal(h_bits+1, reset=0)
+        self.processed_lines = Signal(h_bits+1, reset=0)
+        # lines collected from the frame being written
+        self.frame_lines = Signal(h_bits+1, reset=0)
+        # strobes from the demosaicers, line and whole frame decoded
+        self.line_read = Signal()
+        self.frame_read = Signal()
         self.force_reset = Signal()
-        self.hold_reset = Signal()
         # vars to check if line has underflow or overflow
-        self.columns_caputred = Signal(len(im_w)+1, reset=0)
+        self.columns_caputred = Signal(w_bits+1, reset=0)
         self.underflow = Signal()
         self.overflow = Signal()
         self.error = Signal()
+        # image configured above the supported size, ingest is blocked
+        self.size_error = Signal()
+        if max_width is not None:
+            self.comb += [If(im_w > max_width, self.size_error.eq(1))]
+        if max_height is not None:
+            self.comb += [If(im_h > max_height, self.size_error.eq(1))]
         self.frame_sync_incorrect = Signal()
         self.comb += [self.error.eq((self.overflow | self.underflow))]
 
+        # optional defect pixel correction of the input, dpc holds its enable and threshold signals,
+        # it reads the lines above through the write ports of the line buffers not being written
+        if dpc is not None:
+            self.dpc_lines = [Signal(self.bpp*ppc) for _ in range(self.mem_chunks)]
+            self.submodules.dpc = DefectCorrection(bpp, ppc, line_w, *dpc, self.dpc_lines, self.current_chunk, w_bits+1)
+            self.comb += streamin.connect(self.dpc.sink)
+            streamin = self.dpc.source
+
         if enable is None:
             self.comb += [
                #connect raw signals with local signals
@@ -69,47 +165,88 @@ class DemosaicCache(Module):
             ]
         self.f_reset = Signal()
         self.wait_for_reset = Signal()
+        self.restart = Signal()
+        self.write = Signal()
+        self.line_done = Signal()
+        self.comb += [
+            self.restart.eq((self.wait_for_reset & ~u_reset) | self.frame_sync_incorrect),
+            self.write.eq(self.raw_valid & self.raw_ready),
+            self.line_done.eq(self.write & (self.wadr >= line_w-1)),
+        ]
         self.sync += [
             If(u_reset | self.wait_for_reset,
                 self.wait_for_reset.eq(1),
             ),
+            self.f_reset.eq(0),
             If(self.wait_for_reset & ~u_reset,
                 self.wait_for_reset.eq(0),
                 self.f_reset.eq(1),
             ),
-            If((self.wait_for_reset & ~u_reset) | self.raw_first,
-                [self.adrs[i].eq(0) for i in range(self.mem_chunks)],
+            If(self.write,
+                If(self.line_done,
+                    self.wadr.eq(0),
+                    If(self.current_chunk < self.mem_chunks-1,
+                        self.current_chunk.eq(self.current_chunk+1),
+                    ).Else(
+                        self.current_chunk.eq(0),
+                    ),
+                    If(self.frame_lines < im_h-1,
+                        self.frame_lines.eq(self.frame_lines+1),
+                    ).Else(
+                        self.frame_lines.eq(0),
+                    ),
+                ).Else(
+                    self.wadr.eq(self.wadr+1),
+                )
+            ),
+            If(self.frame_read,
+                self.processed_lines.eq(0),
+                self.collected_lines.eq(self.collected_lines-im_h+self.line_done),
+            ).Else(
+                If(self.line_read,
+                    self.processed_lines.eq(self.processed_lines+1),
+                ),
+                If(self.line_done,
+                    self.collected_lines.eq(self.collected_lines+1),
+                ),
+            ),
+            If(self.line_read,
+                If(self.read_chunk < self.mem_chunks-1,
+                    self.read_chunk.eq(self.read_chunk+1),
+                ).Else(
+                    self.read_chunk.eq(0),
+                )
+            ),
+            If(self.restart,
                 self.processed_lines.eq(0),
-                self.current_chunk.eq(0),
                 self.collected_lines.eq(0),
+                self.frame_lines.eq(0),
+                self.current_chunk.eq(0),
+                self.read_chunk.eq(0),
+                self.wadr.eq(0),
                 self.wait_for_reset.eq(0),
             ),
         ]
-        self.ch_nrdy = Signal()
-        self.adr_nrdy = Signal()
+        # a frame may start only where the previous one ended
         self.comb += [
-            self.ch_nrdy.eq(self.current_chunk != 0),
-            self.adr_nrdy.eq(self.adrs[0] > 0),
-            self.frame_sync_incorrect.eq((self.raw_first & self.ch_nrdy)
-                                        | (self.raw_first & self.adr_nrdy))
-        ]
-
-        self.comb += [
-            self.force_reset.eq(self.hold_reset | self.raw_first | self.f_reset),
-            self.memory_reset.eq(self.force_reset),
+            self.frame_sync_incorrect.eq(self.raw_valid & self.raw_first & ((self.wadr != 0) | (self.frame_lines != 0))),
+            self.force_reset.eq(self.f_reset | self.frame_sync_incorrect),
+            If(self.force_reset,
+                [self.adrs_next[i].eq(0) for i in range(self.mem_chunks)],
+            ),
         ]
 
         self.comb += [
             If(self.raw_last,
-                If(self.columns_caputred > (im_w-1),
+                If(self.columns_caputred > (line_w-1),
                     self.overflow.eq(1),
-                ).Elif(self.columns_caputred < (im_w-1),
+                ).Elif(self.columns_caputred < (line_w-1),
                     self.underflow.eq(1),
                 ).Else(
                     self.underflow.eq(0),
                     self.overflow.eq(0),
                 )
-            ).Elif(self.columns_caputred >= (im_w),
+            ).Elif(self.columns_caputred >= (line_w),
                 self.overflow.eq(1),
             ).Else(
                 self.underflow.eq(0),
@@ -124,102 +261,40 @@ class DemosaicCache(Module):
                 ).Else(
                     self.columns_caputred.eq(0),
                 )
-            ).Elif((self.columns_caputred > im_w) | self.frame_sync_incorrect,
+            ).Elif((self.columns_caputred > line_w) | self.frame_sync_incorrect,
                 self.columns_caputred.eq(0),
             )
         ]
 
-        # fill ememory with zeros
+        # writer may overwrite only lines which are not needed by the kernel anymore
         self.comb += [
             If(self.collected_lines - self.processed_lines < self.mem_chunks-mem_treshold,
-               self.raw_ready.eq(~self.push_zeros & ~self.f_reset & ~self.frame_sync_incorrect),
+               self.raw_ready.eq(~self.f_reset & ~self.frame_sync_incorrect & ~self.size_error),
             ).Else(
                self.raw_ready.eq(0),
             )
         ]
-        # fill last few lines with zeros
-        # this in neccessary to correctly decode last few lines
-        # depends on the decoded kernel size
-        self.comb += [
-           self.push_zeros.eq((self.collected_lines >= im_h) 
-               & (self.collected_lines <= (im_h+mem_treshold))),
-        ]
-
-        #reset all cache line except the first one
-        for i in range(1, len(self.mem_bank.ports)):
-            self.sync += [
-                If(self.memory_reset,
-                    self.hold_reset.eq(1), 
-                    If(~self.frame_sync_incorrect,
-                        If((self.adrs[i] < im_w-1) ,
-                            self.adrs[i].eq(self.adrs[i]+1),
-                        ).Elif(self.adrs[i] == im_w-1,
-                            self.f_reset.eq(0), 
-                            self.hold_reset.eq(0), 
-                            self.adrs[i].eq(0),
-                        )
-                    )
-                )
-            ]
-            self.comb += [
-                If(self.memory_reset,
-                    self.mem_bank.ports[i].we.eq(1),
-                )
-            ]
 
+        # addresses count pixel stream words, the lowest bits select the lane of a memory word
+        w_lane = self.wadr[:lane_bits]
+        if dpc is not None:
+            dpc_lane = Signal(max(lane_bits, 1))
+            self.sync += dpc_lane.eq(self.dpc.adr[:lane_bits])
         for i in range(len(self.mem_bank.ports)):
+            lane = self.adrs[i][:lane_bits]
+            r_lanes = Array(self.mem_bank.rports[i].dat_r[j*self.bpp*ppc:(j+1)*self.bpp*ppc] for j in range(lanes))
             self.comb += [
-                self.mem_bank.ports[i].adr.eq(self.adrs[i]),
-                self.r_data[i].eq(self.mem_bank.ports[i].dat_r),
-            ]
-
-        #receive data from stream
-        cases = {}
-        for i in range(len(self.mem_bank.ports)):
-            cases[i] = [
-                If(self.push_zeros,
-                    self.mem_bank.ports[i].dat_w.eq(0),
-                ).Elif(~self.memory_reset,
-                    self.mem_bank.ports[i].dat_w.eq(self.raw_data),
-                ).Else(
-                    self.mem_bank.ports[0].dat_w.eq(self.raw_data),
-                    [self.mem_bank.ports[i].dat_w.eq(0)] if i != 0 else [],
-                ),
-                If(self.collected_lines - self.processed_lines < self.mem_chunks-mem_treshold,
-                   If((self.raw_valid | self.push_zeros) & ~self.f_reset,
-                       If(self.adrs[i] < im_w,
-                          self.mem_bank.ports[i].we.eq(1),
-                       ).Else(
-                          self.mem_bank.ports[(i+1)%self.mem_chunks].we.eq(1),
-                       )
-                   ).Else(
-                       self.mem_bank.ports[i].we.eq(0),
-                   )
-                ).Else(
-                   self.mem_bank.ports[i].we.eq(0),
-                )
-            ]
-        self.comb += Case(self.current_chunk, cases)
-
-        cases = {}
-        for i in range(self.mem_chunks):
-            cases[i] = [
-                If(self.collected_lines - self.processed_lines < self.mem_chunks-mem_treshold,
-                    If((self.raw_valid | self.push_zeros) & ~self.f_reset & ~self.frame_sync_incorrect,
-                        If(self.adrs[i] < im_w-1,
-                           self.adrs[i].eq(self.adrs[i]+1),
-                        ).Elif((self.current_chunk < self.mem_chunks-1),
-                            self.adrs[i].eq(0), # set addr to 0, cause FSM requires it
-                            self.current_chunk.eq(self.current_chunk+1),
-                            self.collected_lines.eq(self.collected_lines+1),
-                        ).Else(
-                            self.collected_lines.eq(self.collected_lines+1),
-                            self.adrs[i].eq(0),
-                            self.current_chunk.eq(0),
-                        ),
-                    ).Elif(self.f_reset,
-                        self.adrs[i].eq(0), # set addr to 0, cause FSM requires it
-                    )
-                )
+                self.we[i].eq(self.write & (self.current_chunk == i)),
+                self.mem_bank.ports[i].adr.eq((self.wadr if dpc is None else
+                                               Mux(self.current_chunk == i, self.wadr, self.dpc.adr))[lane_bits:]),
+                self.mem_bank.ports[i].dat_w.eq(Replicate(self.raw_data, lanes)),
+                self.mem_bank.rports[i].adr.eq((self.adrs_next[i] if sync_read else self.adrs[i])[lane_bits:]),
+                self.r_data[i].eq(r_lanes[lane] if lanes > 1 else r_lanes[0]),
             ]
-        self.sync += Case(self.current_chunk, cases)
+            if dpc is not None:
+                w_lanes = Array(self.mem_bank.ports[i].dat_r[j*self.bpp*ppc:(j+1)*self.bpp*ppc] for j in range(lanes))
+                self.comb += self.dpc_lines[i].eq(w_lanes[dpc_lane] if lanes > 1 else w_lanes[0])
+            if lanes > 1:
+                self.comb += self.mem_bank.ports[i].we.eq(self.we[i] << w_lane)
+            else:
+                self.comb += self.mem_bank.ports[i].we.eq(self.we[i])
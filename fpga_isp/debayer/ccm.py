@@ -0,0 +1,100 @@
+from migen import *
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class ColorCorrection(Module, AutoCSR):
+    # fractional bits of the coefficients
+    frac = 10
+
+    # multiplies the RGB pixels by a 3x3 matrix and adds an offset per color, clipped to
+    # zero and the largest color value, ppc pixels of pix_width bits with colors of bpp bits,
+    # blue in the LSBs, in three pipeline stages: the products, registered as in a DSP block,
+    # their sums and the clipping, the CSRs are copied to shadow registers at the frame start
+    def __init__(self, bpp, pix_width, ppc=1):
+        self.sink = sink = stream.Endpoint([("data", pix_width*ppc)])
+        self.source = source = stream.Endpoint([("data", pix_width*ppc)])
+
+        unity = 1 << self.frac
+        # a CSR per output color, the coefficients of red, green and blue of the input
+        rows = []
+        for color, name in [("r", "red"), ("g", "green"), ("b", "blue")]:
+            row = CSRStorage(description="Coefficients of {}, signed 6.10 fixed point, 0x400 is unity".format(name),
+                fields=[
+                    CSRField(c, size=16, description="Coefficient of the input {}".format(n), reset=unity if c == color else 0)
+                    for c, n in [("r", "red"), ("g", "green"), ("b", "blue")]
+            ])
+            setattr(self, name, row)
+            rows.append(row)
+        self.offsets = CSRStorage(description="Offsets added to the colors, signed, in color values",
+            fields=[
+                CSRField(c, size=16, description="Offset of {}".format(n))
+                for c, n in [("r", "red"), ("g", "green"), ("b", "blue")]
+        ])
+
+        *values, offsets = frame_settings(self, sink, rows + [self.offsets])
+        coefs = [[value[16*i:16*(i+1)] for i in range(3)] for value in values]
+
+        advance = Signal()
+        valid = Signal(3)
+        first = Signal(3)
+        last = Signal(3)
+        self.comb += [
+            advance.eq(pipeline_advance(valid[2], source.ready)),
+            sink.ready.eq(advance),
+            source.valid.eq(valid[2]),
+            source.first.eq(first[2]),
+            source.last.eq(last[2]),
+        ]
+        self.sync += If(advance,
+            valid.eq(Cat(sink.valid, valid[:2])),
+            first.eq(Cat(sink.first, first[:2])),
+            last.eq(Cat(sink.last, last[:2])),
+        )
+
+        # stage 1 registers the offsets of the frame along with the products
+        offset = [Signal((16, True)) for _ in range(3)]
+        self.sync += If(advance, [o.eq(offsets[16*i:16*(i+1)]) for i, o in enumerate(offset)])
+
+        max_value = 2**bpp-1
+        width = max(bpp+17, 16+self.frac)+2
+        for j in range(ppc):
+            pix = sink.data[j*pix_width:(j+1)*pix_width]
+            colors = []
+            for c in range(3):
+                color = Signal((bpp+1, True))
+                self.comb += color.eq(pix[(2-c)*bpp:(3-c)*bpp])
+                colors.append(color)
+            result = []
+            for k in range(3):
+                # stage 1: the products of the row
+                products = [Signal((bpp+17, True)) for _ in range(3)]
+                for i in range(3):
+                    coef = Signal((16, True))
+                    self.comb += coef.eq(coefs[k][i])
+                    self.sync += If(advance, products[i].eq(coef*colors[i]))
+                # stage 2: their sum with the offset, rounded
+                total = Signal((width, True))
+                self.sync += If(advance, total.eq(products[0] + products[1] + products[2] + (offset[k] << self.frac) + (unity >> 1)))
+                # stage 3: clipped
+                clipped = Signal(bpp)
+                self.sync += If(advance,
+                    If(total < 0,
+                        clipped.eq(0),
+                    ).Elif(total[self.frac:] > max_value,
+                        clipped.eq(max_value),
+                    ).Else(
+                        clipped.eq(total[self.frac:]),
+                    ),
+                )
+                result.append(clipped)
+            # padding above the colors is delayed with them
+            pad = [Signal(pix_width-3*bpp) for _ in range(3)]
+            self.sync += If(advance,
+                pad[0].eq(pix[3*bpp:]),
+                pad[1].eq(pad[0]),
+                pad[2].eq(pad[1]),
+            )
+            r, g, b = result
+            self.comb += source.data[j*pix_width:(j+1)*pix_width].eq(Cat(b, g, r, pad[2]))
@@ -7,20 +7,83 @@ class Bayer_t(IntEnum):
     GRGB = 2
     RGBG = 3
 
+# colors of the 2x2 cell of a pattern, green in a line with red is G0 and with blue G1
+layouts = {
+    Bayer_t.RGGB: [["R", "G0"], ["G1", "B"]],
+    Bayer_t.BGGR: [["B", "G1"], ["G0", "R"]],
+    Bayer_t.GRGB: [["G0", "R"], ["G1", "B"]],
+    Bayer_t.RGBG: [["R", "G0"], ["B", "G1"]],
+}
+
 class Demosaic_t(IntEnum):
     RESET = 0
     NEAREST = 1
     BILINEAR = 2
     EDGE_DIRECTED = 4
+    MALVAR = 8
+
+# settings of a frame, the CSRs are copied to shadow registers when the first beat of a frame
+# is taken, that beat already uses the new values and the rest of the frame the copies
+def frame_settings(module, sink, csrs):
+    start = sink.valid & sink.ready & sink.first
+    settings = []
+    for csr in csrs:
+        shadow = Signal(len(csr.storage), reset=csr.storage.reset.value)
+        module.sync += If(start, shadow.eq(csr.storage))
+        settings.append(Mux(sink.first, csr.storage, shadow))
+    return settings
+
+# all registers of a pipeline are loaded together, when its output word is empty or taken
+def pipeline_advance(valid, ready):
+    return ~valid | ready
 
 class Bayer_kernel:
-    def __init__(self, bpp, width, height):
+    def __init__(self, bpp, width, height, offset=0, colors=None):
         self.bpp = bpp
-        self.colors = Array(Signal(bpp*width) for _ in range(height))
+        self.offset = offset
+        if colors is None:
+            colors = Array(Signal(bpp*width) for _ in range(height))
+        self.colors = colors
 
     def row(self, row):
         return self.colors[row]
 
     def cell(self, row, col):
-        idx = self.bpp*col
+        idx = self.bpp*(col+self.offset)
         return self.colors[row][idx:idx+self.bpp]
+
+    # view of the same shift registers moved by given number of columns,
+    # used to decode neighbouring pixels when processing more than one pixel per clock
+    def lane(self, offset):
+        return Bayer_kernel(self.bpp, 0, 0, offset=self.offset+offset, colors=self.colors)
+
+    # shift in a word of pixels, the first pixel in the word is the leftmost one
+    # so it has to land in the oldest (highest) cell
+    def push(self, row, data):
+        pixels = [data[i:i+self.bpp] for i in range(0, len(data), self.bpp)]
+        return Cat(*reversed(pixels), self.colors[row])
+
+# packing of the raw input stream, MIPI CSI-2 RAW10 holds 4 pixels in 5 bytes,
+# RAW12 2 pixels in 3 bytes, NONE is one pixel per byte or 16-bit container
+class Packing_t(IntEnum):
+    NONE = 0
+    RAW10 = 1
+    RAW12 = 2
+
+# pixel format of the output stream, XRGB is a pixel per 32 or 64-bit container,
+# RGB888 packs 4 pixels in 3 32-bit words, RGB565 2 pixels in a word,
+# YUYV is YUV 4:2:2 with 16 bits per pixel, YUV420_LINES is YUV 4:2:0 in line
+# pairs, a YUYV line carrying the chroma of the pair followed by a Y8 line,
+# not the semi-planar NV12, and Y8 is only the 8-bit luma
+class Format_t(IntEnum):
+    XRGB = 0
+    RGB888 = 1
+    RGB565 = 2
+    YUYV = 3
+    YUV420_LINES = 4
+    Y8 = 5
+
+# color space conversion matrices of the YUV formats
+class Matrix_t(IntEnum):
+    BT601 = 0
+    BT709 = 1
@@ -0,0 +1,137 @@
+from migen import *
+import math
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+
+# value rounded down to a multiple of n, a power of 2
+def align_down(value, n):
+    bits = int(math.log(n, 2))
+    return Cat(C(0, bits), value[bits:]) if bits else value
+
+class Crop(Module, AutoCSR):
+    # lines and pixels of the frame kept around the region for the kernels of the demosaicers
+    margin = 2
+
+    # region of interest of frames of cols x rows pixels, ppc pixels per word: the raw pixels
+    # outside of a window around the region are dropped ahead of the white balance and the cache,
+    # the window keeps the margin within the frame, so the region decodes as in the whole frame,
+    # and the decoded margin is dropped again from the RGB pixels, lines of which end with last,
+    # the cache and the demosaicers take frames of the window size, cols and rows of the module,
+    # the offsets are rounded down to even pixels and lines to keep the Bayer phase of the frame
+    # and to the pixels per clock, the CSRs are used at once, as the image size, between frames
+    def __init__(self, cols, rows, bpp, pix_width, ppc=1, size=(0, 0)):
+        self.sink = sink = stream.Endpoint([("data", bpp*ppc)])
+        self.source = source = stream.Endpoint([("data", bpp*ppc)])
+        self.rgb_sink = rgb_sink = stream.Endpoint([("data", pix_width*ppc)])
+        self.rgb_source = rgb_source = stream.Endpoint([("data", pix_width*ppc)])
+
+        x_align = max(2, ppc)
+        self.ctl = CSRStorage(description="Crop control register",
+            fields=[
+                CSRField("enable", size=1, description="Decode only the region, otherwise the whole frame", reset=0),
+        ])
+        self.offset = CSRStorage(description="Top left corner of the region in the frame",
+            fields=[
+                CSRField("x", size=13, description="Column, rounded down to a multiple of {}".format(x_align)),
+                CSRField("y", size=13, description="Line, rounded down to a multiple of 2"),
+        ])
+        self.size = CSRStorage(description="Size of the region, it must lie within the frame",
+            fields=[
+                CSRField("width", size=13, description="Width in pixels, rounded down to a multiple of the pixels per clock", reset=size[0]),
+                CSRField("height", size=13, description="Height in lines", reset=size[1]),
+        ])
+
+        # window size and the lines of the region, for the stages after the crop
+        self.cols = Signal(13)
+        self.rows = Signal(13)
+        self.height = Signal(13)
+
+        # region, the whole frame when disabled, and the window around it, the pixels
+        # of the margin are rounded up as the offsets
+        log_ppc = int(math.log(ppc, 2))
+        enable = self.ctl.fields.enable
+        margin_x = -(-self.margin//x_align)*x_align
+        margin_y = self.margin
+        x = Signal(13)
+        y = Signal(13)
+        width = Signal(13)
+        x0 = Signal(13)
+        y0 = Signal(13)
+        x1 = Signal(14)
+        y1 = Signal(14)
+        right = Signal(15)
+        bottom = Signal(15)
+        self.comb += [
+            x.eq(Mux(enable, align_down(self.offset.fields.x, x_align), 0)),
+            y.eq(Mux(enable, align_down(self.offset.fields.y, 2), 0)),
+            width.eq(Mux(enable, align_down(self.size.fields.width, ppc), cols)),
+            self.height.eq(Mux(enable, self.size.fields.height, rows)),
+            x0.eq(Mux(x > margin_x, x - margin_x, 0)),
+            y0.eq(Mux(y > margin_y, y - margin_y, 0)),
+            right.eq(x + width + margin_x),
+            bottom.eq(y + self.height + margin_y),
+            x1.eq(Mux(right < cols, right, cols)),
+            y1.eq(Mux(bottom < rows, bottom, rows)),
+            self.cols.eq(x1 - x0),
+            self.rows.eq(y1 - y0),
+        ]
+
+        # raw words of the frame, lines of cols pixels, a frame starts with first
+        # or after rows lines, as in the cache
+        col = Signal(13)
+        line = Signal(13)
+        col_in = Mux(sink.first, 0, col)
+        line_in = Mux(sink.first, 0, line)
+        line_w = cols >> log_ppc
+        self.sync += If(sink.valid & sink.ready,
+            If(col_in == line_w-1,
+                col.eq(0),
+                line.eq(Mux(line_in == rows-1, 0, line_in + 1)),
+            ).Else(
+                col.eq(col_in + 1),
+                line.eq(line_in),
+            ),
+        )
+        keep = Signal()
+        self.comb += [
+            keep.eq(~enable | (col_in >= (x0 >> log_ppc)) & (col_in < (x1 >> log_ppc)) & (line_in >= y0) & (line_in < y1)),
+            source.valid.eq(sink.valid & keep),
+            source.data.eq(sink.data),
+            source.first.eq(Mux(enable, (col_in == (x0 >> log_ppc)) & (line_in == y0), sink.first)),
+            source.last.eq(sink.last),
+            sink.ready.eq(source.ready | ~keep),
+        ]
+
+        # decoded words of the window, frames end after their rows lines
+        fire = rgb_sink.valid & rgb_sink.ready
+        first = rgb_sink.first
+        rgb_col = Signal(13)
+        rgb_line = Signal(13)
+        rgb_col_in = Mux(first, 0, rgb_col)
+        rgb_line_in = Mux(first, 0, rgb_line)
+        self.sync += If(fire,
+            If(rgb_sink.last,
+                rgb_col.eq(0),
+                rgb_line.eq(Mux(rgb_line_in == self.rows-1, 0, rgb_line_in + 1)),
+            ).Else(
+                rgb_col.eq(rgb_col_in + 1),
+                rgb_line.eq(rgb_line_in),
+            ),
+        )
+        left = Signal(13)
+        top = Signal(13)
+        end = Signal(13)
+        inside = Signal()
+        self.comb += [
+            left.eq((x - x0) >> log_ppc),
+            top.eq(y - y0),
+            end.eq(left + (width >> log_ppc) - 1),
+            inside.eq(~enable | (rgb_col_in >= left) & (rgb_col_in <= end) &
+                                (rgb_line_in >= top) & (rgb_line_in < top + self.height)),
+            rgb_source.valid.eq(rgb_sink.valid & inside),
+            rgb_source.data.eq(rgb_sink.data),
+            rgb_source.first.eq(Mux(enable, (rgb_col_in == left) & (rgb_line_in == top), rgb_sink.first)),
+            rgb_source.last.eq(Mux(enable, rgb_col_in == end, rgb_sink.last)),
+            rgb_sink.ready.eq(rgb_source.ready | ~inside),
+        ]
@@ -0,0 +1,96 @@
+from migen import *
+
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class RGB2YUV(Module):
+    # limited range coefficients scaled by 256, rows Y, Cb, Cr and columns R, G, B
+    coefficients = {
+        Matrix_t.BT601: [[66, 129, 25], [-38, -74, 112], [112, -94, -18]],
+        Matrix_t.BT709: [[47, 157, 16], [-26, -87, 112], [112, -102, -10]],
+    }
+    yuv_formats = [Format_t.YUYV, Format_t.YUV420_LINES, Format_t.Y8]
+
+    # converts ppc pixels of pix_width bits with colors of bpp bits, blue in the LSBs,
+    # to YUV pixels with the luma in the LSBs and the chroma above, in two pipeline stages,
+    # the chroma is co-sited with the even pixels: Cb on even and Cr on odd pixels,
+    # in YUV420_LINES the odd lines carry only the luma, other formats pass through
+    def __init__(self, matrix, fmt, bpp, pix_width, ppc=1):
+        assert(bpp >= 8 and ppc in [1, 2, 4])
+        self.sink = sink = stream.Endpoint([("data", pix_width*ppc)])
+        self.source = source = stream.Endpoint([("data", pix_width*ppc)])
+        # the luma only line in YUV420_LINES, along with the source
+        self.luma_only = Signal()
+
+        yuv = Signal()
+        self.comb += yuv.eq(Cat(*[fmt == f for f in self.yuv_formats]) != 0)
+
+        advance = Signal()
+        valid = Signal(2)
+        first = Signal(2)
+        last = Signal(2)
+        odd_line = Signal(2)
+        self.comb += advance.eq(pipeline_advance(valid[1], source.ready))
+
+        # parity of the line and, with a pixel per clock, of the pixel of the input beat,
+        # a frame starts with an even line and lines with an even pixel
+        line = Signal()
+        pixel = Signal()
+        odd_line_in = Mux(sink.first, 0, line)
+        odd_pixel_in = Mux(sink.first, 0, pixel)
+        self.sync += If(sink.valid & sink.ready,
+            line.eq(odd_line_in ^ sink.last),
+            pixel.eq(~sink.last & ~odd_pixel_in),
+        )
+
+        # stage 1: the products of the colors summed per component
+        sums = [[Signal((bpp+10, True)) for _ in range(3)] for _ in range(ppc)]
+        for j in range(ppc):
+            pix = sink.data[j*pix_width:(j+1)*pix_width]
+            b, g, r = [pix[c*bpp:(c+1)*bpp] for c in range(3)]
+            for k in range(3):
+                coef = [Mux(matrix == Matrix_t.BT709, C(c709, (9, True)), C(c601, (9, True)))
+                        for c601, c709 in zip(self.coefficients[Matrix_t.BT601][k], self.coefficients[Matrix_t.BT709][k])]
+                self.sync += If(advance, sums[j][k].eq(coef[0]*r + coef[1]*g + coef[2]*b + 128))
+        odd_pixel = Signal()
+        self.sync += If(advance,
+            valid[0].eq(sink.valid),
+            first[0].eq(sink.first),
+            last[0].eq(sink.last),
+            odd_line[0].eq(odd_line_in),
+            odd_pixel.eq(odd_pixel_in),
+        )
+
+        # stage 2: scaled, offset and the chroma of the pixel pair picked
+        y = [s[0][8:] + (16 << (bpp-8)) for s in sums]
+        cb = [s[1][8:] + (128 << (bpp-8)) for s in sums]
+        cr = [s[2][8:] + (128 << (bpp-8)) for s in sums]
+        # Cr of the even pixel of the previous beat, for a pixel per clock
+        cr_prev = Signal(bpp)
+        self.sync += If(advance & valid[0], cr_prev.eq(cr[0]))
+        data = Signal(pix_width*ppc)
+        for j in range(ppc):
+            if ppc == 1:
+                c = Mux(odd_pixel, cr_prev, cb[0])
+            else:
+                c = cr[j-1] if j % 2 else cb[j]
+            self.sync += If(advance, data[j*pix_width:(j+1)*pix_width].eq(Cat(y[j][:bpp], c[:bpp])))
+        self.sync += If(advance,
+            valid[1].eq(valid[0]),
+            first[1].eq(first[0]),
+            last[1].eq(last[0]),
+            odd_line[1].eq(odd_line[0]),
+        )
+
+        self.comb += [
+            If(yuv,
+                sink.ready.eq(advance),
+                source.valid.eq(valid[1]),
+                source.first.eq(first[1]),
+                source.last.eq(last[1]),
+                source.data.eq(data),
+                self.luma_only.eq((fmt == Format_t.YUV420_LINES) & odd_line[1]),
+            ).Else(
+                sink.connect(source),
+            ),
+        ]
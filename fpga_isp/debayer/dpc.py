@@ -0,0 +1,147 @@
+from migen import *
+
+from litex.soc.interconnect import stream
+
+# smaller and larger of two values
+def min2(a, b):
+    return Mux(a < b, a, b)
+
+def max2(a, b):
+    return Mux(a < b, b, a)
+
+# median of 3 and of 5 values in compare and select steps
+def median3(a, b, c):
+    return max2(min2(a, b), min2(max2(a, b), c))
+
+def median5(a, b, c, d, e):
+    return median3(e, max2(min2(a, b), min2(c, d)), min2(max2(a, b), max2(c, d)))
+
+class DefectCorrection(Module):
+    # replaces hot and dead raw pixels in front of the cache line buffers, ppc pixels of bpp bits,
+    # a pixel differing by more than threshold from all of its same color neighbours becomes their median,
+    # the neighbours are the pixels 2 left and right in the line and the 3 pixels 2 lines above,
+    # read corrected from the cache `lines` (the read data of each line buffer, of the address in
+    # adr from the cycle before), `chunk` is the line buffer written by the cache, lines of line_w words
+    # end by their count as in the cache, the words are delayed until their right neighbours came,
+    # the line ends are not waited for, so the stream keeps its rate, neighbours outside of the line
+    # are mirrored and the first two lines of a frame, without lines above, are passed through
+    def __init__(self, bpp, ppc, line_w, enable, threshold, lines, chunk, adr_width):
+        self.sink = sink = stream.Endpoint([("data", bpp*ppc)])
+        self.source = source = stream.Endpoint([("data", bpp*ppc)])
+        # line buffer address of the input word of the next cycle
+        self.adr = Signal(adr_width)
+        mem_chunks = len(lines)
+
+        # words of the neighbours on each side, the output word is in the middle of the slots,
+        # the newest in slot 0 and the ones already sent behind it
+        side = (2 + ppc-1)//ppc
+        slots = 2*side+1
+        valid = [Signal() for _ in range(slots)]
+        first = [Signal() for _ in range(slots)]
+        last = [Signal() for _ in range(slots)]
+        end = [Signal() for _ in range(slots)]
+        data = [Signal(bpp*ppc) for _ in range(slots)]
+        above = [Signal(bpp*ppc) for _ in range(slots)]
+        # the word has lines above in the frame
+        has_above = [Signal() for _ in range(slots)]
+
+        # the newest words of the line end, no more input is needed for them
+        tail = Signal()
+        self.comb += tail.eq(Cat(*[valid[k] & end[k] & (Cat(*valid[:k]) == 0) if k else valid[0] & end[0]
+                                   for k in range(side+1)]) != 0)
+        # the right neighbours of the output word are there or behind the line end
+        ahead = Cat(*[valid[k] | (Cat(*[valid[m] & end[m] for m in range(k+1, side+1)]) != 0) for k in range(side)])
+        shift = Signal()
+        self.comb += [
+            # a word is sent only along with a shift, so no slot is empty in a line
+            source.valid.eq(valid[side] & (ahead == 2**side-1) & (sink.valid | tail)),
+            source.first.eq(first[side]),
+            source.last.eq(last[side]),
+            sink.ready.eq(~valid[side] | (source.valid & source.ready)),
+            shift.eq(sink.ready & (sink.valid | tail)),
+        ]
+
+        # column and line of the input word, lines counted up to 2
+        col = Signal(adr_width)
+        line = Signal(2)
+        col_in = Mux(sink.first, 0, col)
+        line_in = Mux(sink.first, 0, line)
+        end_in = col_in == line_w-1
+        accept = sink.valid & shift
+        self.sync += If(accept,
+            If(end_in,
+                col.eq(0),
+                line.eq(Mux(line_in == 2, 2, line_in + 1)),
+            ).Else(
+                col.eq(col_in + 1),
+                line.eq(line_in),
+            ),
+        )
+        self.comb += self.adr.eq(Mux(accept, Mux(end_in, 0, col_in + 1), col_in))
+
+        # the line 2 above the input word, lines of the words not yet written are ahead of the chunk
+        pending = sum(valid[k] & end[k] for k in range(side+1))
+        chunks = Array(lines[k % mem_chunks] for k in range(2*mem_chunks+side))
+        above_in = chunks[chunk + pending + mem_chunks-2]
+
+        self.sync += If(shift,
+            valid[0].eq(sink.valid),
+            first[0].eq(sink.first),
+            last[0].eq(sink.last),
+            end[0].eq(end_in),
+            data[0].eq(sink.data),
+            above[0].eq(above_in),
+            has_above[0].eq(line_in == 2),
+            [s[k+1].eq(s[k]) for s in [valid, first, last, end, data, above, has_above] for k in range(slots-1)],
+        )
+
+        # neighbour of lane j given pixels away, in the line or in the line above,
+        # and whether it is in the same line
+        def neighbour(words, j, offset):
+            pos = j + offset
+            slot = side - pos//ppc
+            pixel = pos % ppc
+            value = words[slot][pixel*bpp:(pixel+1)*bpp]
+            if slot == side:
+                return value, 1
+            elif slot < side:
+                # right, the output word and the ones before the neighbour may not end the line
+                crossed = Cat(*[end[k] for k in range(slot+1, side+1)]) != 0
+            else:
+                # left, the words from the neighbour to the one before the output word may not end a line
+                crossed = Cat(*[end[k] for k in range(side+1, slot+1)]) != 0
+            return value, valid[slot] & ~crossed
+
+        out = []
+        for j in range(ppc):
+            pixel = data[side][j*bpp:(j+1)*bpp]
+            neighbours = []
+            for words in [data, above]:
+                left, has_left = neighbour(words, j, -2)
+                right, has_right = neighbour(words, j, 2)
+                # missing neighbours are mirrored
+                l = Signal(bpp)
+                r = Signal(bpp)
+                self.comb += [
+                    l.eq(Mux(has_left, left, Mux(has_right, right, pixel))),
+                    r.eq(Mux(has_right, right, Mux(has_left, left, pixel))),
+                ]
+                neighbours += [l, r]
+            up = above[side][j*bpp:(j+1)*bpp]
+            neighbours.insert(2, up)
+            lo = Signal(bpp)
+            hi = Signal(bpp)
+            median = Signal(bpp)
+            corrected = Signal(bpp)
+            self.comb += [
+                lo.eq(min2(min2(min2(neighbours[0], neighbours[1]), min2(neighbours[2], neighbours[3])), neighbours[4])),
+                hi.eq(max2(max2(max2(neighbours[0], neighbours[1]), max2(neighbours[2], neighbours[3])), neighbours[4])),
+                median.eq(median5(*neighbours)),
+                If(enable & has_above[side] & ((pixel > hi + threshold) | (pixel + threshold < lo)),
+                    corrected.eq(median),
+                ).Else(
+                    corrected.eq(pixel),
+                ),
+            ]
+            out.append(corrected)
+        self.comb += source.data.eq(Cat(*out))
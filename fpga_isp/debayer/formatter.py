@@ -0,0 +1,110 @@
+from migen import *
+
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class OutputFormatter(Module):
+    # bits of the color MSBs kept by a format, blue, green and red,
+    # YUV pixels of the color space converter hold the luma and chroma in place of blue and green
+    formats = {
+        Format_t.RGB888:       (8, 8, 8),
+        Format_t.RGB565:       (5, 6, 5),
+        Format_t.YUYV:         (8, 8),
+        Format_t.YUV420_LINES: (8, 8),
+        Format_t.Y8:           (8,),
+    }
+
+    # a pixel of given format, the first color in the LSBs, blue by default, red in BGR mode,
+    # XRGB pixels keep the container and in BGR mode are aligned to its MSBs,
+    # YUV pixels start with the luma, or with the chroma in BGR mode
+    @staticmethod
+    def format_pixel(fmt, b, g, r, bgr, pix_width):
+        colors = [b, g, r]
+        if fmt == Format_t.XRGB:
+            pad = [C(0, pix_width-3*len(b))] if pix_width > 3*len(b) else []
+            return Mux(bgr, Cat(*pad, r, g, b), Cat(b, g, r, *pad))
+        colors = [c[len(c)-bits:] for c, bits in zip(colors, OutputFormatter.formats[fmt])]
+        return Mux(bgr, Cat(*reversed(colors)), Cat(*colors))
+
+    # packs the pixels of the demosaicers, ppc pixels of pix_width bits with colors of bpp bits,
+    # into words of width bits in the selected format, the first pixel in the LSBs,
+    # every line starts in a new word, the last word of a line is padded with zeros
+    # words are filled in a gearbox buffer, one word per cycle is given out,
+    # so the pixel rate of ppc is kept while width bits hold ppc pixels of the format,
+    # the YUV formats are packed only with yuv set, YUV420_LINES is packed as YUYV
+    def __init__(self, fmt, bgr, bpp, pix_width, ppc=1, width=32, yuv=False):
+        assert(width in [32, 64, 128] and bpp >= 8)
+        self.sink = sink = stream.Endpoint([("data", pix_width*ppc)])
+        self.source = source = stream.Endpoint([("data", width)])
+
+        wbytes = width//8
+        in_bytes = pix_width*ppc//8
+        depth = wbytes + in_bytes
+        buf = Signal(8*depth)
+        level = Signal(max=depth+1)
+        first = Signal()
+        flush = Signal()
+
+        # packed pixels of a beat and their number of bytes
+        beat = Signal(8*in_bytes)
+        nbytes = Signal(max=in_bytes+1)
+        cases = {}
+        for f in Format_t:
+            if f in [Format_t.YUYV, Format_t.YUV420_LINES, Format_t.Y8] and not yuv:
+                continue
+            pixels = []
+            for i in range(ppc):
+                pixel = sink.data[i*pix_width:(i+1)*pix_width]
+                b, g, r = [pixel[c*bpp:(c+1)*bpp] for c in range(3)]
+                pixels.append(self.format_pixel(f, b, g, r, bgr, pix_width))
+            bits = pix_width if f == Format_t.XRGB else sum(self.formats[f])
+            cases[f] = [beat.eq(Cat(*pixels)), nbytes.eq(bits*ppc//8)]
+        cases["default"] = cases[Format_t.XRGB]
+        self.comb += Case(fmt, cases)
+
+        # a word is given out when full, or partially filled at the end of a line
+        rest = Signal(8*depth)
+        left = Signal(max=depth+1)
+        take = Signal()
+        self.comb += [
+            source.valid.eq((level >= wbytes) | flush & (level != 0)),
+            source.data.eq(buf[:width]),
+            source.first.eq(first),
+            source.last.eq(flush & (level <= wbytes)),
+            take.eq(source.valid & source.ready),
+            rest.eq(buf),
+            left.eq(level),
+            If(take,
+                If(level > wbytes,
+                    rest.eq(buf[width:]),
+                    left.eq(level - wbytes),
+                ).Else(
+                    rest.eq(0),
+                    left.eq(0),
+                ),
+            ),
+            # the next line waits until the previous one is given out
+            sink.ready.eq((left + nbytes <= depth) & ~(flush & (left != 0))),
+        ]
+
+        self.sync += [
+            If(take,
+                first.eq(0),
+                If(left == 0,
+                    flush.eq(0),
+                ),
+            ),
+            If(sink.valid & sink.ready,
+                Case(left, {n: buf.eq(Cat(rest[:8*n], beat)) for n in range(depth+1)}),
+                level.eq(left + nbytes),
+                If(sink.first,
+                    first.eq(1),
+                ),
+                If(sink.last,
+                    flush.eq(1),
+                ),
+            ).Else(
+                buf.eq(rest),
+                level.eq(left),
+            ),
+        ]
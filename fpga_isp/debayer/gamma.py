@@ -0,0 +1,99 @@
+from migen import *
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class GammaLUT(Module, AutoCSR):
+    # per channel lookup tables of the RGB pixels, ppc pixels of pix_width bits with colors
+    # of bpp bits, blue in the LSBs, read from block RAM in one pipeline stage,
+    # every table has two banks, the pixels are looked up in the active one while
+    # the CPU uploads the other, the banks are swapped at the next frame start
+    def __init__(self, bpp, pix_width, ppc=1):
+        self.sink = sink = stream.Endpoint([("data", pix_width*ppc)])
+        self.source = source = stream.Endpoint([("data", pix_width*ppc)])
+
+        self.ctl = CSRStorage(description="Lookup table control",
+            fields=[
+                CSRField("enable", size=1, description="Look up the pixels, applies from the next frame", reset=0),
+                CSRField("swap", size=1, description="Use the uploaded bank from the next frame", pulse=True),
+        ])
+        self.adr = CSRStorage(description="Upload address, in the bank not in use",
+            fields=[
+                CSRField("index", size=bpp, description="Entry of the table"),
+                CSRField("channel", size=2, description="Table: 0 - red, 1 - green, 2 - blue, 3 - all tables"),
+        ])
+        self.data = CSRStorage(bpp, description="Writes the entry at the upload address and moves to the next entry")
+        self.status = CSRStatus(description="Lookup table status",
+            fields=[
+                CSRField("bank", size=1, description="Bank in use"),
+                CSRField("pending", size=1, description="Swap requested, waiting for the next frame"),
+        ])
+
+        ctl, = frame_settings(self, sink, [self.ctl])
+        offsets = {f.name: f.offset for f in self.ctl.fields.fields}
+        enable_in = ctl[offsets["enable"]]
+        # a requested swap flips the bank at the frame start
+        bank = Signal()
+        pending = Signal()
+        bank_in = Mux(sink.first & pending, ~bank, bank)
+        self.sync += [
+            If(self.ctl.fields.swap,
+                pending.eq(1),
+            ),
+            If(sink.valid & sink.ready & sink.first,
+                bank.eq(bank_in),
+                pending.eq(0),
+            ),
+        ]
+        self.comb += [
+            self.status.fields.bank.eq(bank),
+            self.status.fields.pending.eq(pending),
+        ]
+
+        # upload, the index moves on with every written entry
+        index = Signal(bpp)
+        self.sync += [
+            If(self.adr.re,
+                index.eq(self.adr.fields.index),
+            ).Elif(self.data.re,
+                index.eq(index + 1),
+            ),
+        ]
+
+        advance = Signal()
+        enabled = Signal()
+        data = Signal(pix_width*ppc)
+        self.comb += [
+            advance.eq(pipeline_advance(source.valid, source.ready)),
+            sink.ready.eq(advance),
+        ]
+        self.sync += If(advance,
+            source.valid.eq(sink.valid),
+            source.first.eq(sink.first),
+            source.last.eq(sink.last),
+            enabled.eq(enable_in),
+            data.eq(sink.data),
+        )
+
+        # a table per lane and channel, both banks start as identity
+        looked_up = []
+        for j in range(ppc):
+            pixel = sink.data[j*pix_width:(j+1)*pix_width]
+            colors = []
+            # blue, green and red from the LSBs
+            for c, channel in enumerate([2, 1, 0]):
+                mem = Memory(bpp, 2*2**bpp, init=list(range(2**bpp))*2)
+                rport = mem.get_port(has_re=True)
+                wport = mem.get_port(write_capable=True)
+                self.specials += mem, rport, wport
+                self.comb += [
+                    rport.adr.eq(Cat(pixel[c*bpp:(c+1)*bpp], bank_in)),
+                    rport.re.eq(advance),
+                    wport.adr.eq(Cat(index, ~bank)),
+                    wport.dat_w.eq(self.data.storage),
+                    wport.we.eq(self.data.re & ((self.adr.fields.channel == channel) | (self.adr.fields.channel == 3))),
+                ]
+                colors.append(rport.dat_r)
+            looked_up.append(Cat(*colors, data[j*pix_width+3*bpp:(j+1)*pix_width]))
+        self.comb += source.data.eq(Mux(enabled, Cat(*looked_up), data))
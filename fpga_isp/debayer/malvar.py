@@ -0,0 +1,372 @@
+from migen import *
+import math
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.base import *
+from fpga_isp.debayer.common import *
+from fpga_isp.debayer.cache import *
+from litex.soc.interconnect.csr_eventmanager import *
+
+# Malvar-He-Cutler linear demosaic, bilinear interpolation corrected by the
+# laplacian of the center color, 5x5 kernel with coefficients multiple of 1/16
+class MalvarHeCutler(DemosaicBase):
+    # cache line buffers and the lines kept for the kernel, also used by DemosaicWrapper
+    cache_chunks = 6
+    cache_treshold = 2
+    # stages registering the filter sums, their difference and the clipped value
+    # after the kernel sums, used with a decode stage of more than one register stage
+    filter_stages = 3
+
+    def __init__(self, im_w, im_h, pattern, streamout, enable=Signal(1,reset=1), streamin=None, cache=None, ppc=1, sync_read=False,
+                 max_width=None, max_height=None, pack=None, rotate=False, pipeline=0, out_bpp=None):
+        def fetch_next_col(i):
+            return [[NextValue(colors.row(r+2), colors.push(r+2, cache.line_data(i, r))) for r in range(-2,3)],
+                    cache.fetch_adrs(i, range(-2,3)),]
+
+        def fetch_null_col(i):
+            return [NextValue(colors.row(r), Cat(Signal(cache.bpp*ppc), colors.row(r))) for r in range(0,5)]
+
+        def fetch_next_col_on_new_line(i):
+            return [[NextValue(colors.row(r+1), colors.push(r+1, cache.line_data(i, r))) for r in range(-1,4)],
+                    cache.fetch_adrs(i, range(-1,4)),]
+
+        def reset_adrs(i):
+            return [If(colors_to_decode == 1,
+                    cache.fetch_adrs(i, range(-2,3), rewind=True),
+                ),]
+
+        def reset_algorithm(state=None):
+            return [
+                    NextValue(self.working, 0),
+                    NextValue(colors_to_decode, null_cols),
+                    NextValue(self.first_pixel, 1),
+                    NextValue(self.rgb_valid, 0),
+                    NextValue(self.rgb_first, 0),
+                    [NextValue(colors.row(r), Signal(cache.bpp*window_width)) for r in range(5)],
+                    NextState(state or self.reset_state),
+                ]
+
+        # constant multiplication with shifts and adds only
+        def times(value, k):
+            terms = [value << i for i in range(k.bit_length()) if (k >> i) & 1]
+            return sum(terms[1:], terms[0])
+
+        # positive and negative taps are summed separately, so the filter
+        # is computed without signed arithmetic and clipped to the pixel range,
+        # with a deeper decode stage the sums, their difference and the clipped
+        # value are registered each, once for every filter and lane
+        def clip(name, colors, pos, neg, shift):
+            if not self.post_stages:
+                val = (pos - neg) >> shift
+                return Mux(pos <= neg, 0, Mux(val > 2**cache.bpp-1, 2**cache.bpp-1, val))
+            key = (name,) + self.cells_key([colors.cell(2,2)])
+            if key not in self.sums:
+                pos, neg = self.delay(pos, 1), self.delay(neg, 1)
+                diff, under = self.delay(pos - neg, 1), self.delay(pos <= neg, 1)
+                val = diff >> shift
+                self.sums[key] = self.delay(Mux(under, 0, Mux(val > 2**cache.bpp-1, 2**cache.bpp-1, val)), 1)
+            return self.sums[key]
+
+        # green at red or blue
+        def green(colors):
+            return clip("green", colors, times(self.cell_sum(colors.cell(2,2)), 4)
+                + times(self.cell_sum(colors.cell(1,2), colors.cell(3,2), colors.cell(2,1), colors.cell(2,3)), 2),
+                self.cell_sum(colors.cell(0,2), colors.cell(4,2), colors.cell(2,0), colors.cell(2,4)), 3)
+
+        # red or blue at green, with the samples left and right of the center
+        def horizontal(colors):
+            return clip("horizontal", colors, times(self.cell_sum(colors.cell(2,2)), 10)
+                + times(self.cell_sum(colors.cell(2,1), colors.cell(2,3)), 8)
+                + self.cell_sum(colors.cell(0,2), colors.cell(4,2)),
+                times(self.cell_sum(colors.cell(2,0), colors.cell(2,4))
+                    + self.cell_sum(colors.cell(1,1), colors.cell(1,3), colors.cell(3,1), colors.cell(3,3)), 2), 4)
+
+        # red or blue at green, with the samples above and below the center
+        def vertical(colors):
+            return clip("vertical", colors, times(self.cell_sum(colors.cell(2,2)), 10)
+                + times(self.cell_sum(colors.cell(1,2), colors.cell(3,2)), 8)
+                + self.cell_sum(colors.cell(2,0), colors.cell(2,4)),
+                times(self.cell_sum(colors.cell(0,2), colors.cell(4,2))
+                    + self.cell_sum(colors.cell(1,1), colors.cell(1,3), colors.cell(3,1), colors.cell(3,3)), 2), 4)
+
+        # red at blue or blue at red
+        def diagonal(colors):
+            return clip("diagonal", colors, times(self.cell_sum(colors.cell(2,2)), 12)
+                + times(self.cell_sum(colors.cell(1,1), colors.cell(1,3), colors.cell(3,1), colors.cell(3,3)), 4),
+                times(self.cell_sum(colors.cell(0,2), colors.cell(4,2), colors.cell(2,0), colors.cell(2,4)), 3), 4)
+
+        # decode ppc adjacent pixels, each lane sees the kernel shifted by its position
+        def get_decoder(pattern, state):
+            color = state[len("DECODE_"):]
+            return [get_lane_decoder(pattern, "DECODE_"+self.lane_color(color, j),
+                                     colors.lane(self.lane_offset(j, kernel_width//2)),
+                                     r_val[j], g_val[j], b_val[j]) for j in range(ppc)]
+
+        # the filters are defined for Bayer patterns only, the patterns with green
+        # columns are interpolated from the nearest samples without the correction
+        def get_lane_decoder(pattern, state, colors, r_val, g_val, b_val):
+            if state == "DECODE_R":
+                return [If((pattern == Bayer_t.RGGB) | (pattern == Bayer_t.BGGR),
+                            self.assign(r_val, self.mean(colors.cell(2,2))),
+                            self.assign(g_val, green(colors)),
+                            self.assign(b_val, diagonal(colors)),
+                        ).Else(
+                            self.assign(r_val, self.mean(colors.cell(2,2))),
+                            self.assign(g_val, self.mean(colors.cell(2,1),
+                                colors.cell(2,3))),
+                            self.assign(b_val, self.mean(colors.cell(1,2),
+                                colors.cell(3,2))),
+                        ),]
+            elif state == "DECODE_G0":
+                return [If((pattern == Bayer_t.RGGB) | (pattern == Bayer_t.BGGR),
+                            self.assign(r_val, horizontal(colors)),
+                            self.assign(g_val, self.mean(colors.cell(2,2))),
+                            self.assign(b_val, vertical(colors)),
+                        ).Else(
+                            self.assign(r_val, self.mean(colors.cell(2,1),
+                                colors.cell(2,3))),
+                            self.assign(g_val, self.mean(colors.cell(2,2))),
+                            self.assign(b_val, self.mean(colors.cell(1,1),
+                                colors.cell(1,3),
+                                colors.cell(3,1),
+                                colors.cell(3,3))),
+                        ),]
+            elif state == "DECODE_G1":
+                return [If((pattern == Bayer_t.RGGB) | (pattern == Bayer_t.BGGR),
+                            self.assign(r_val, vertical(colors)),
+                            self.assign(g_val, self.mean(colors.cell(2,2))),
+                            self.assign(b_val, horizontal(colors)),
+                        ).Else(
+                            self.assign(r_val, self.mean(colors.cell(1,1),
+                                colors.cell(1,3),
+                                colors.cell(3,1),
+                                colors.cell(3,3))),
+                            self.assign(g_val, self.mean(colors.cell(2,2))),
+                            self.assign(b_val, self.mean(colors.cell(2,1),
+                                colors.cell(2,3))),
+                        ),]
+            elif state == "DECODE_B":
+                return [If((pattern == Bayer_t.RGGB) | (pattern == Bayer_t.BGGR),
+                            self.assign(r_val, diagonal(colors)),
+                            self.assign(g_val, green(colors)),
+                            self.assign(b_val, self.mean(colors.cell(2,2))),
+                        ).Else(
+                            self.assign(r_val, self.mean(colors.cell(1,2),
+                                colors.cell(3,2))),
+                            self.assign(g_val, self.mean(colors.cell(2,1),
+                                colors.cell(2,3))),
+                            self.assign(b_val, self.mean(colors.cell(2,2))),
+                        ),]
+
+        assert(streamin != None and cache == None or streamin == None and cache != None)
+        if streamin != None:
+            self.submodules.ev = EventManager()
+            self.ev.error = EventSourcePulse(description="data underflow/overflow")
+            self.submodules.cache = cache = DemosaicCache(bpp=len(streamin.data)//ppc,
+                                                          mem_chunks=self.cache_chunks,
+                                                          streamin=streamin,
+                                                          im_w=im_w,
+                                                          im_h=im_h,
+                                                          mem_treshold=Signal(2,reset=self.cache_treshold),
+                                                          enable=enable,
+                                                          u_reset=self.ev.irq,
+                                                          ppc=ppc,
+                                                          sync_read=sync_read,
+                                                          max_width=max_width,
+                                                          max_height=max_height,
+                                                          pack=pack)
+        super().__init__(cache=cache, im_w=im_w, im_h=im_h, min_lines_req=2, streamout=streamout, active=enable, rotate=rotate, pipeline=pipeline,
+                         post_stages=self.filter_stages if pipeline > 1 else 0, out_bpp=out_bpp)
+        assert(cache.mem_chunks > self.min_lines_required)
+
+        assert(ppc == cache.ppc)
+        kernel_width=5
+        kernel_height=5
+        window_width = self.window_width(kernel_width//2, kernel_width//2)
+        colors = Bayer_kernel(cache.bpp, window_width, kernel_height)
+
+        # number of null columns pushed at the end of line
+        null_cols = self.fetch_ahead(kernel_width//2)
+        colors_to_decode = Signal(2,reset=null_cols)
+        # multiply by 2 to avoid data overflow during arithmetic operations in the decoding process
+        r_val = [Signal(2*cache.bpp) for _ in range(ppc)]
+        g_val = [Signal(2*cache.bpp) for _ in range(ppc)]
+        b_val = [Signal(2*cache.bpp) for _ in range(ppc)]
+        self.comb += [
+            If(enable,
+                self.rgb_data.eq(self.pack_rgb(r_val, g_val, b_val)),
+            )
+        ]
+
+        self.sync += [
+            If(cache.f_reset & ~cache.raw_first,
+                self.working.eq(0),
+                colors_to_decode.eq(null_cols),
+                self.rgb_valid.eq(0),
+                self.rgb_first.eq(0),
+                self.first_pixel.eq(1),
+                [colors.row(r).eq(Signal(cache.bpp*window_width)) for r in range(5)],
+            )
+        ]
+
+        self.submodules.demo_fsm = demo_fsm = FSM(reset_state=self.reset_state)
+        for i in self.chunks():
+            demo_fsm.act(self.state("FETCH_SYNC", i),
+                If(cache.force_reset,
+                    reset_algorithm(),
+                ).Elif(self.chunk_moved(cache.read_chunk, i),
+                    # previous frame decoded by another demosaicer
+                    self.follow_chunk(cache.read_chunk, "FETCH_SYNC"),
+                ).Elif(enable,
+                    If(self.rgb_ready,
+                        NextValue(self.working, 1),
+                        NextValue(self.rgb_valid, 0),
+                        NextValue(self.rgb_last,0),
+                        If(cache.processed_lines == im_h,
+                            reset_algorithm(self.state("FETCH_SYNC", i)),
+                            cache.next_frame(),
+                        ).Else(
+                            If((cache.collected_lines - cache.processed_lines > self.min_lines_required) | (cache.collected_lines >= im_h),
+                                If(~cache.frame_sync_incorrect, fetch_next_col(i)),
+                                If(cache.line_adr(i) == self.fetch_ahead(kernel_width//2),
+                                    If(pattern == Bayer_t.RGGB,
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_R", i), self.state("FETCH_DECODE_G1", i)),
+                                    ).Elif(pattern == Bayer_t.BGGR,
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_B", i), self.state("FETCH_DECODE_G0", i)),
+                                    ).Elif(pattern == Bayer_t.RGBG,
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_R", i), self.state("FETCH_DECODE_B", i)),
+                                    ).Else(
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_G0", i), self.state("FETCH_DECODE_G1", i)),
+                                    )
+                                )
+                            )
+                        )
+                    )
+                )
+            )
+            demo_fsm.act(self.state("FETCH_DECODE_R", i),
+                If(~cache.force_reset & ~cache.frame_sync_incorrect,
+                    If(enable,
+                        If(self.rgb_ready,
+                            self.decode(get_decoder, pattern, "DECODE_R"),
+                            NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
+                            If(colors_to_decode>0,
+                                If(cache.line_adr(i) < cache.line_w,
+                                    fetch_next_col(i),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("R"), i)),
+                                ).Else(
+                                    fetch_null_col(i),
+                                    reset_adrs(i),
+                                    NextValue(colors_to_decode,colors_to_decode-1),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("R"), i)),
+                                )
+                            ).Else(
+                                NextValue(self.rgb_last,1),
+                                NextValue(colors_to_decode,null_cols),
+                                If(self.next_line_ready(cache, im_h), fetch_next_col_on_new_line(i)),
+                                cache.line_read.eq(1),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
+                            )
+                        )
+                    )
+                ).Else(
+                    reset_algorithm(),
+                )
+            )
+
+            demo_fsm.act(self.state("FETCH_DECODE_G0", i),
+                If(~cache.force_reset& ~cache.frame_sync_incorrect,
+                    If(enable,
+                        If(self.rgb_ready,
+                            self.decode(get_decoder, pattern, "DECODE_G0"),
+                            NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
+                            If(colors_to_decode>0,
+                                If(cache.line_adr(i) < cache.line_w,
+                                    fetch_next_col(i),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G0"), i)),
+                                ).Else(
+                                    fetch_null_col(i),
+                                    reset_adrs(i),
+                                    NextValue(colors_to_decode,colors_to_decode-1),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G0"), i)),
+                                )
+                            ).Else(
+                                NextValue(self.rgb_last,1),
+                                NextValue(colors_to_decode,null_cols),
+                                If(self.next_line_ready(cache, im_h), fetch_next_col_on_new_line(i)),
+                                cache.line_read.eq(1),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
+                            )
+                        )
+                    )
+                ).Else(
+                    reset_algorithm(),
+                )
+            )
+
+            demo_fsm.act(self.state("FETCH_DECODE_G1", i),
+                If(~cache.force_reset& ~cache.frame_sync_incorrect,
+                    If(enable,
+                        If(self.rgb_ready,
+                            self.decode(get_decoder, pattern, "DECODE_G1"),
+                            NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
+                            If(colors_to_decode>0,
+                                If(cache.line_adr(i) < cache.line_w,
+                                    fetch_next_col(i),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G1"), i)),
+                                ).Else(
+                                    NextValue(colors_to_decode, colors_to_decode-1),
+                                    fetch_null_col(i),
+                                    reset_adrs(i),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G1"), i)),
+                                )
+                            ).Else(
+                                NextValue(self.rgb_last,1),
+                                NextValue(colors_to_decode,null_cols),
+                                cache.line_read.eq(1),
+                                If(self.next_line_ready(cache, im_h), fetch_next_col_on_new_line(i)),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
+                            )
+                        )
+                    )
+                ).Else(
+                    reset_algorithm(),
+                )
+            )
+
+            demo_fsm.act(self.state("FETCH_DECODE_B", i),
+                If(~cache.force_reset& ~cache.frame_sync_incorrect,
+                    If(enable,
+                        If(self.rgb_ready,
+                            self.decode(get_decoder, pattern, "DECODE_B"),
+                            NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
+                            If(colors_to_decode>0,
+                                If(cache.line_adr(i) < cache.line_w,
+                                    fetch_next_col(i),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("B"), i)),
+                                ).Else(
+                                    fetch_null_col(i),
+                                    reset_adrs(i),
+                                    NextValue(colors_to_decode,colors_to_decode-1),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("B"), i)),
+                                )
+                            ).Else(
+                                NextValue(self.rgb_last,1),
+                                NextValue(colors_to_decode,null_cols),
+                                cache.line_read.eq(1),
+                                If(self.next_line_ready(cache, im_h), fetch_next_col_on_new_line(i)),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
+                            )
+                        )
+                    )
+                ).Else(
+                    reset_algorithm(),
+                )
+            )
+
+        self.decode_stage(get_decoder, pattern)
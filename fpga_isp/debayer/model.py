@@ -0,0 +1,306 @@
+import numpy as np
+
+from fpga_isp.debayer.common import *
+
+# reference model of the demosaicers, decodes whole frames exactly as the hardware does:
+# pixels outside of the frame read as zeros, means are truncated by shifts and
+# the colors of the non Bayer patterns come from the same neighbours as in the cores
+
+class Kernel:
+    # kernel of given size over the whole frame, the cell at row r and column c
+    # of the hardware kernel holds the pixel r-cy lines below and cx-c columns right
+    # of the decoded one, (cy, cx) being the kernel center
+    def __init__(self, raw, rows, cols, center, bpp=8):
+        h, w = raw.shape
+        cy, cx = center
+        self.h, self.w = h, w
+        self.cols = cols
+        # 16 bits hold the largest filter sums of 8 bit pixels
+        self.padded = np.zeros((h+rows-1, w+cols-1), dtype=np.int16 if bpp <= 8 else np.int32)
+        self.padded[cy:cy+h, cols-1-cx:cols-1-cx+w] = raw
+
+    def cell(self, row, col):
+        x = self.cols-1-col
+        return self.padded[row:row+self.h, x:x+self.w]
+
+    def mean(self, *cells):
+        return sum(self.cell(*c) for c in cells) >> int(np.log2(len(cells)))
+
+def nearest(k, bayer, bpp):
+    m = k.mean
+    if bayer:
+        return {
+            "R":  (m((0,1)), m((0,0)), m((1,0))),
+            "G0": (m((0,0)), m((0,1)), m((1,1))),
+            "G1": (m((1,1)), m((0,1)), m((0,0))),
+            "B":  (m((1,0)), m((0,0)), m((0,1))),
+        }
+    return {
+        "R":  (m((0,1)), m((0,0)), m((1,1))),
+        "G0": (m((0,0)), m((0,1)), m((1,0))),
+        "G1": (m((1,0)), m((0,1)), m((0,0))),
+        "B":  (m((1,1)), m((0,0)), m((0,1))),
+    }
+
+def bilinear(k, bayer, bpp):
+    m = k.mean
+    cross = ((1,0), (1,2), (0,1), (2,1))
+    corners = ((0,0), (0,2), (2,0), (2,2))
+    if bayer:
+        return {
+            "R":  (m((1,1)), m(*cross), m(*corners)),
+            "G0": (m((1,0), (1,2)), m((1,1)), m((0,1), (2,1))),
+            "G1": (m((0,1), (2,1)), m((1,1)), m((1,0), (1,2))),
+            "B":  (m(*corners), m(*cross), m((1,1))),
+        }
+    return {
+        "R":  (m((1,1)), m((1,0), (1,2), (0,0), (2,2)), m((0,1), (2,1))),
+        "G0": (m((1,0), (1,2)), m((1,1)), m(*corners)),
+        "G1": (m(*corners), m((1,1)), m((1,0), (1,2))),
+        "B":  (m((0,1), (2,1)), m((1,0), (1,2), (0,0), (2,2)), m((1,1))),
+    }
+
+def edge_directed(k, bayer, bpp):
+    m = k.mean
+    h_abs = np.abs(m((2,0), (2,4)) - m((2,2)))
+    v_abs = np.abs(m((0,2), (4,2)) - m((2,2)))
+    # green interpolated along the smaller gradient
+    def green(vertical, both):
+        return np.where(h_abs < v_abs, m((2,1), (2,3)), np.where(h_abs > v_abs, m(*vertical), m(*both)))
+    diagonal = ((1,1), (1,3), (3,1), (3,3))
+    if bayer:
+        g = green(((1,2), (3,2)), ((1,2), (2,3), (2,1), (3,2)))
+        return {
+            "R":  (m((2,2)), g, m(*diagonal)),
+            "G0": (m((2,1), (2,3)), m((2,2)), m((1,2), (3,2))),
+            "G1": (m((1,2), (3,2)), m((2,2)), m((2,1), (2,3))),
+            "B":  (m(*diagonal), g, m((2,2))),
+        }
+    g = green(((1,3), (3,3)), diagonal)
+    return {
+        "R":  (m((2,2)), g, m((1,2), (3,2))),
+        "G0": (m((2,1), (2,3)), m((2,2)), m((1,3), (3,1))),
+        "G1": (m((1,3), (3,1)), m((2,2)), m((2,1), (2,3))),
+        "B":  (m((1,2), (3,2)), g, m((2,2))),
+    }
+
+def malvar(k, bayer, bpp):
+    m = k.mean
+    if not bayer:
+        return {
+            "R":  (m((2,2)), m((2,1), (2,3)), m((1,2), (3,2))),
+            "G0": (m((2,1), (2,3)), m((2,2)), m((1,1), (1,3), (3,1), (3,3))),
+            "G1": (m((1,1), (1,3), (3,1), (3,3)), m((2,2)), m((2,1), (2,3))),
+            "B":  (m((1,2), (3,2)), m((2,1), (2,3)), m((2,2))),
+        }
+    s = lambda *cells: sum(k.cell(*c) for c in cells)
+    def clip(pos, neg, shift):
+        return np.where(pos <= neg, 0, np.minimum((pos - neg) >> shift, 2**bpp-1))
+    center = s((2,2))
+    diagonal = s((1,1), (1,3), (3,1), (3,3))
+    green = clip(4*center + 2*s((1,2), (3,2), (2,1), (2,3)), s((0,2), (4,2), (2,0), (2,4)), 3)
+    horizontal = clip(10*center + 8*s((2,1), (2,3)) + s((0,2), (4,2)), 2*(s((2,0), (2,4)) + diagonal), 4)
+    vertical = clip(10*center + 8*s((1,2), (3,2)) + s((2,0), (2,4)), 2*(s((0,2), (4,2)) + diagonal), 4)
+    cross = clip(12*center + 4*diagonal, 3*s((0,2), (4,2), (2,0), (2,4)), 4)
+    return {
+        "R":  (center, green, cross),
+        "G0": (horizontal, center, vertical),
+        "G1": (vertical, center, horizontal),
+        "B":  (cross, green, center),
+    }
+
+# kernel rows, columns and center of each demosaicer
+decoders = {
+    Demosaic_t.NEAREST:       (nearest, 2, 2, (0,1)),
+    Demosaic_t.BILINEAR:      (bilinear, 3, 3, (1,1)),
+    Demosaic_t.EDGE_DIRECTED: (edge_directed, 5, 5, (2,2)),
+    Demosaic_t.MALVAR:        (malvar, 5, 5, (2,2)),
+}
+
+# decode a raw frame of shape (height, width), returns (height, width, 3) RGB frame,
+# the colors are cut to their out_bpp most significant bits
+def demosaic(raw, algorithm, pattern, bpp=8, out_bpp=None):
+    decoder, rows, cols, center = decoders[Demosaic_t(algorithm)]
+    raw = np.asarray(raw)
+    h, w = raw.shape
+    k = Kernel(raw, rows, cols, center, bpp)
+    bayer = Bayer_t(pattern) in [Bayer_t.RGGB, Bayer_t.BGGR]
+    colors = decoder(k, bayer, bpp)
+    rgb = np.zeros((h, w, 3), dtype=np.int32)
+    # every pixel of the 2x2 cell is decoded as its color
+    for y, line in enumerate(layouts[Bayer_t(pattern)]):
+        for x, state in enumerate(line):
+            for i, value in enumerate(colors[state]):
+                rgb[y::2, x::2, i] = value[y::2, x::2]
+    if out_bpp is None:
+        out_bpp = bpp
+    dtype = np.uint8 if out_bpp <= 8 else np.uint16
+    return ((rgb & (2**bpp-1)) >> (bpp-out_bpp)).astype(dtype)
+
+# pixels of the output stream in line order, blue in the LSBs, red above green
+def to_words(rgb, bpp=8):
+    rgb = rgb.astype(np.uint64)
+    return ((rgb[..., 0] << 2*bpp) | (rgb[..., 1] << bpp) | rgb[..., 2]).reshape(-1)
+
+# MIPI packed bytes of a raw frame of 10 or 12-bit pixels in line order
+def pack(raw, packing):
+    if Packing_t(packing) == Packing_t.RAW10:
+        p = np.asarray(raw, dtype=np.uint16).reshape(-1, 4)
+        low = sum((p[:, i] & 0x3) << 2*i for i in range(4))
+        return np.column_stack([p >> 2, low]).astype(np.uint8).reshape(-1)
+    p = np.asarray(raw, dtype=np.uint16).reshape(-1, 2)
+    low = (p[:, 0] & 0xf) | (p[:, 1] & 0xf) << 4
+    return np.column_stack([p >> 4, low]).astype(np.uint8).reshape(-1)
+
+# limited range YUV of a decoded frame, the luma and the chroma of every pixel,
+# Cb on even pixels and Cr of the even pixel on odd pixels
+def yuv(rgb, matrix, bpp=8):
+    coefficients = {
+        Matrix_t.BT601: [[66, 129, 25], [-38, -74, 112], [112, -94, -18]],
+        Matrix_t.BT709: [[47, 157, 16], [-26, -87, 112], [112, -102, -10]],
+    }[Matrix_t(matrix)]
+    r, g, b = [rgb[..., i].astype(np.int64) for i in range(3)]
+    y, cb, cr = [(kr*r + kg*g + kb*b + 128 >> 8) + (offset << bpp-8)
+                 for (kr, kg, kb), offset in zip(coefficients, (16, 128, 128))]
+    c = np.empty_like(y)
+    c[:, 0::2] = cb[:, 0::2]
+    c[:, 1::2] = cr[:, 0::2]
+    return y, c
+
+# output words of given width of a decoded frame in the format of the output formatter,
+# the first pixel in the LSBs, every line starts in a new word padded with zeros
+def format_words(rgb, fmt, width=32, bpp=8, bgr=False, matrix=Matrix_t.BT601):
+    fmt = Format_t(fmt)
+    if fmt in [Format_t.YUYV, Format_t.YUV420_LINES, Format_t.Y8]:
+        y, c = [v.astype(object) >> bpp-8 for v in yuv(rgb, matrix, bpp)]
+        samples = [c, y] if bgr else [y, c]
+        lines = []
+        for k in range(len(y)):
+            # in YUV420_LINES the lines after the chroma line carry only the luma
+            if fmt == Format_t.Y8 or fmt == Format_t.YUV420_LINES and k % 2:
+                lines.append((y[k], 8))
+            else:
+                lines.append((samples[0][k] | samples[1][k] << 8, 16))
+    else:
+        colors = [rgb[..., i].astype(object) for i in reversed(range(3))]
+        if fmt == Format_t.XRGB:
+            pix_width = 32 if 3*bpp <= 32 else 64
+            bits = (bpp, bpp, bpp)
+            pad = pix_width - 3*bpp
+        else:
+            bits = {Format_t.RGB888: (8, 8, 8), Format_t.RGB565: (5, 6, 5)}[fmt]
+            colors = [c >> bpp-n for c, n in zip(colors, bits)]
+            pix_width = sum(bits)
+            pad = 0
+        if bgr:
+            colors.reverse()
+            bits = bits[::-1]
+        else:
+            pad = 0
+        pixels = (colors[0] | colors[1] << bits[0] | colors[2] << bits[0]+bits[1]) << pad
+        lines = [(line, pix_width) for line in pixels]
+    words = []
+    for line, pix_width in lines:
+        data = sum(int(p) << pix_width*i for i, p in enumerate(line))
+        n = (len(line)*pix_width + width-1)//width
+        words.extend((data >> width*i) & (2**width-1) for i in range(n))
+    return words
+
+# black level subtracted from a raw frame and the colors multiplied by their gains
+# in 8.8 fixed point, as the white balance stage does, gains of R, G0, G1 and B
+def white_balance(raw, pattern, black, gains, bpp=8):
+    raw = np.asarray(raw, dtype=np.int64)
+    out = np.maximum(raw - black, 0)
+    for y, line in enumerate(layouts[Bayer_t(pattern)]):
+        for x, color in enumerate(line):
+            gain = gains[["R", "G0", "G1", "B"].index(color)]
+            out[y::2, x::2] = np.minimum(out[y::2, x::2]*gain >> 8, 2**bpp-1)
+    return out
+
+# decoded frame looked up in the tables of red, green and blue
+def gamma(rgb, luts):
+    return np.stack([np.asarray(luts[c])[rgb[..., c]] for c in range(3)], axis=-1).astype(rgb.dtype)
+
+# decoded frame multiplied by a 3x3 matrix, rows of red, green and blue in signed 6.10 fixed point,
+# plus the offsets of red, green and blue, rounded and clipped as the color correction stage does
+def color_correction(rgb, matrix, offsets, bpp=8):
+    rgb = np.asarray(rgb, dtype=np.int64)
+    out = np.stack([sum(matrix[k][i]*rgb[..., i] for i in range(3)) + (offsets[k] << 10) + 512 >> 10 for k in range(3)],
+                   axis=-1)
+    return np.clip(out, 0, 2**bpp-1).astype(np.uint8 if bpp <= 8 else np.uint16)
+
+# histograms of the luma, red, green and blue of a decoded frame in bins of the color MSBs,
+# shape (4, bins), and the sums of red, green and blue over a grid of zones of given size
+# in pixels from the top left, row after row, shape (zones_y*zones_x, 3)
+def statistics(rgb, bpp=8, bins=64, zones=(8, 8), zone_size=(1, 1)):
+    rgb = np.asarray(rgb, dtype=np.int64)
+    r, g, b = [rgb[..., i] for i in range(3)]
+    luma = 77*r + 150*g + 29*b >> 8
+    shift = bpp - int(np.log2(bins))
+    hist = np.array([np.bincount((c >> shift).reshape(-1), minlength=bins) for c in [luma, r, g, b]])
+    sums = np.zeros((zones[1], zones[0], 3), dtype=np.int64)
+    for zy in range(zones[1]):
+        for zx in range(zones[0]):
+            zone = rgb[zy*zone_size[1]:(zy+1)*zone_size[1], zx*zone_size[0]:(zx+1)*zone_size[0]]
+            sums[zy, zx] = zone.reshape(-1, 3).sum(axis=0)
+    return hist, sums.reshape(-1, 3)
+
+# hot and dead pixels of a raw frame replaced as the defect pixel correction does: a pixel
+# differing by more than threshold from all of its same color neighbours, 2 pixels left and right
+# and the 3 pixels 2 lines above, already corrected, becomes their median, neighbours outside
+# of the line are mirrored, the first two lines are kept
+def defect_correction(raw, threshold, bpp=8):
+    out = np.array(raw, dtype=np.int64)
+    h, w = out.shape
+    x = np.arange(w)
+    def sides(row):
+        left = np.where(x >= 2, row[np.maximum(x-2, 0)], row[np.minimum(x+2, w-1)])
+        right = np.where(x+2 < w, row[np.minimum(x+2, w-1)], left)
+        # lines of one or two pixels have no neighbours
+        left = np.where((x < 2) & (x+2 >= w), row, left)
+        right = np.where((x < 2) & (x+2 >= w), row, right)
+        return left, right
+    for y in range(2, h):
+        pixel = out[y].copy()
+        left, right = sides(pixel)
+        up_left, up_right = sides(out[y-2])
+        neighbours = np.stack([left, right, out[y-2], up_left, up_right])
+        defect = (pixel > neighbours.max(axis=0) + threshold) | (pixel + threshold < neighbours.min(axis=0))
+        out[y] = np.where(defect, np.sort(neighbours, axis=0)[2], pixel)
+    return out
+
+# decoded frame downscaled to size (width, height) as the scaler does, mode 0 bilinear with
+# the steps in 4.12 fixed point, the output pixel x of line y taken at x*step of the line at
+# y*step, weights of 8 bits, mode 1 and 2 the rounded averages of 2x2 and 4x4 bins
+def scale(rgb, mode, size, step=(0x1000, 0x1000), bpp=8):
+    rgb = np.asarray(rgb, dtype=np.int64)
+    width, height = size
+    if mode:
+        n = 2 if mode == 1 else 4
+        bins = rgb[:height*n, :width*n].reshape(height, n, width, n, 3).sum(axis=(1, 3))
+        out = bins + n*n//2 >> 2*(n//2)
+    else:
+        def interpolate(frame, count, step, axis):
+            pos = np.arange(count)*step
+            i, f = pos >> 12, pos & 0xfff
+            left = np.take(frame, i, axis=axis)
+            right = np.take(frame, i + (f != 0), axis=axis)
+            shape = [-1 if a == axis else 1 for a in range(frame.ndim)]
+            w = (f >> 4).reshape(shape)
+            return np.where((f == 0).reshape(shape), right, left*(256 - w) + right*w + 128 >> 8)
+        out = interpolate(interpolate(rgb, width, step[0], 1), height, step[1], 0)
+    return out.astype(np.uint8 if bpp <= 8 else np.uint16)
+
+# window of a raw frame of shape (height, width) decoded for the region of given offset (x, y)
+# and size (width, height) as the crop stage does, the offsets rounded down to even and to ppc,
+# the width to ppc, with a margin of 2 lines and of 2 pixels rounded up to even and to ppc
+# within the frame, returns the slices of the window in the frame and of the region in the window
+def crop_window(shape, offset, size, ppc=1, margin=2):
+    height, width = shape
+    align = max(2, ppc)
+    x, y = offset[0]//align*align, offset[1]//2*2
+    w, h = size[0]//ppc*ppc, size[1]
+    margin_x = -(-margin//align)*align
+    x0, y0 = max(x - margin_x, 0), max(y - margin, 0)
+    x1, y1 = min(x + w + margin_x, width), min(y + h + margin, height)
+    return (np.s_[y0:y1, x0:x1], np.s_[y - y0:y - y0 + h, x - x0:x - x0 + w])
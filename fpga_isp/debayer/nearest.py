@@ -9,134 +9,160 @@ from fpga_isp.debayer.cache import *
 from litex.soc.interconnect.csr_eventmanager import *
 
 class NearestNeighbour(DemosaicBase):
-    def __init__(self, im_w, im_h, pattern, streamout, enable=Signal(1,reset=1), streamin=None, cache=None):
+    # cache line buffers and the lines kept for the kernel, also used by DemosaicWrapper
+    cache_chunks = 4
+    cache_treshold = 0
+
+    def __init__(self, im_w, im_h, pattern, streamout, enable=Signal(1,reset=1), streamin=None, cache=None, ppc=1, sync_read=False,
+                 max_width=None, max_height=None, pack=None, rotate=False, pipeline=0, out_bpp=None):
         def fetch_next_col(i):
-            return [[NextValue(colors.row(r), Cat(cache.r_data[(i+r)%cache.mem_chunks], colors.row(r))) for r in range(0,2)],
-                    [NextValue(cache.adrs[(i+r)%cache.mem_chunks], cache.adrs[(i+r)%cache.mem_chunks]+1) for r in range(0,2)],]
+            return [[NextValue(colors.row(r), colors.push(r, cache.line_data(i, r))) for r in range(0,2)],
+                    cache.fetch_adrs(i, range(0,2)),]
 
         def fetch_null_col(i):
-            return [[NextValue(colors.row(r), Cat(Signal(cache.bpp), colors.row(r))) for r in range(0,2)],
-                    [NextValue(cache.adrs[(i+r)%cache.mem_chunks], 0) for r in range(0,2)],]
+            return [[NextValue(colors.row(r), Cat(Signal(cache.bpp*ppc), colors.row(r))) for r in range(0,2)],
+                    cache.fetch_adrs(i, range(0,2), rewind=True),]
 
         def fetch_col_on_new_line(i):
-            return [[NextValue(colors.row(r), Cat(cache.r_data[(i+(r+1))%cache.mem_chunks], colors.row(r))) for r in range(0,2)],
-                    [NextValue(cache.adrs[(i+(r+1))%cache.mem_chunks], cache.adrs[(i+(r+1))%cache.mem_chunks]+1) for r in range(0,2)],]
+            return [[NextValue(colors.row(r), colors.push(r, cache.line_data(i, r+1))) for r in range(0,2)],
+                    cache.fetch_adrs(i, range(1,3)),]
 
-        def reset_algorithm():
+        def reset_algorithm(state=None):
             return [
                     NextValue(self.working, 0),
                     NextValue(self.first_pixel, 1),
                     NextValue(self.rgb_first, 0),
                     NextValue(last_color_decoded,0),
                     NextValue(self.rgb_valid, 0),
-                    [NextValue(colors.row(r), Signal(cache.bpp*kernel_width)) for r in range(2)],
-                    NextState("FETCH_SYNC0"),
+                    [NextValue(colors.row(r), Signal(cache.bpp*window_width)) for r in range(2)],
+                    NextState(state or self.reset_state),
                 ]
 
+        # decode ppc adjacent pixels, each lane sees the kernel shifted by its position
         def get_decoder(pattern, state):
+            color = state[len("DECODE_"):]
+            return [get_lane_decoder(pattern, "DECODE_"+self.lane_color(color, j),
+                                     colors.lane(self.lane_offset(j, kernel_width-1)),
+                                     r_val[j], g_val[j], b_val[j]) for j in range(ppc)]
+
+        def get_lane_decoder(pattern, state, colors, r_val, g_val, b_val):
             if state == "DECODE_R":
                 return [If((pattern == Bayer_t.RGGB) | pattern == Bayer_t.BGGR,
-                            NextValue(r_val, colors.cell(0,1)),
-                            NextValue(g_val, colors.cell(0,0)),
-                            NextValue(b_val, colors.cell(1,0)),
+                            self.assign(r_val, self.mean(colors.cell(0,1))),
+                            self.assign(g_val, self.mean(colors.cell(0,0))),
+                            self.assign(b_val, self.mean(colors.cell(1,0))),
                         ).Else(
-                            NextValue(r_val, colors.cell(0,1)),
-                            NextValue(g_val, colors.cell(0,0)),
-                            NextValue(b_val, colors.cell(1,1)),
+                            self.assign(r_val, self.mean(colors.cell(0,1))),
+                            self.assign(g_val, self.mean(colors.cell(0,0))),
+                            self.assign(b_val, self.mean(colors.cell(1,1))),
                         ),]
             elif state == "DECODE_G0":
                 return [If((pattern == Bayer_t.RGGB) | pattern == Bayer_t.BGGR,
-                            NextValue(r_val, colors.cell(0,0)),
-                            NextValue(g_val, colors.cell(0,1)),
-                            NextValue(b_val, colors.cell(1,1)),
+                            self.assign(r_val, self.mean(colors.cell(0,0))),
+                            self.assign(g_val, self.mean(colors.cell(0,1))),
+                            self.assign(b_val, self.mean(colors.cell(1,1))),
                         ).Else(
-                            NextValue(r_val, colors.cell(0,0)),
-                            NextValue(g_val, colors.cell(0,1)),
-                            NextValue(b_val, colors.cell(1,0)),
+                            self.assign(r_val, self.mean(colors.cell(0,0))),
+                            self.assign(g_val, self.mean(colors.cell(0,1))),
+                            self.assign(b_val, self.mean(colors.cell(1,0))),
                         ),]
             elif state == "DECODE_G1":
                 return [If((pattern == Bayer_t.RGGB) | pattern == Bayer_t.BGGR,
-                            NextValue(r_val, colors.cell(1,1)),
-                            NextValue(g_val, colors.cell(0,1)),
-                            NextValue(b_val, colors.cell(0,0)),
+                            self.assign(r_val, self.mean(colors.cell(1,1))),
+                            self.assign(g_val, self.mean(colors.cell(0,1))),
+                            self.assign(b_val, self.mean(colors.cell(0,0))),
                         ).Else(
-                            NextValue(r_val, colors.cell(1,0)),
-                            NextValue(g_val, colors.cell(0,1)),
-                            NextValue(b_val, colors.cell(0,0)),
+                            self.assign(r_val, self.mean(colors.cell(1,0))),
+                            self.assign(g_val, self.mean(colors.cell(0,1))),
+                            self.assign(b_val, self.mean(colors.cell(0,0))),
                         ),]
             elif state == "DECODE_B":
                 return [If((pattern == Bayer_t.RGGB) | pattern == Bayer_t.BGGR,
-                            NextValue(r_val, colors.cell(1,0)),
-                            NextValue(g_val, colors.cell(0,0)),
-                            NextValue(b_val, colors.cell(0,1)),
+                            self.assign(r_val, self.mean(colors.cell(1,0))),
+                            self.assign(g_val, self.mean(colors.cell(0,0))),
+                            self.assign(b_val, self.mean(colors.cell(0,1))),
                         ).Else(
-                            NextValue(r_val, colors.cell(1,1)),
-                            NextValue(g_val, colors.cell(0,0)),
-                            NextValue(b_val, colors.cell(0,1)),
+                            self.assign(r_val, self.mean(colors.cell(1,1))),
+                            self.assign(g_val, self.mean(colors.cell(0,0))),
+                            self.assign(b_val, self.mean(colors.cell(0,1))),
                         ),]
 
         assert(streamin != None and cache == None or streamin == None and cache != None)
         if streamin != None:
             self.submodules.ev = EventManager()
             self.ev.error = EventSourcePulse(description="data underflow/overflow")
-            self.submodules.cache = cache = DemosaicCache(bpp=8,
-                                                          mem_chunks=4,
+            self.submodules.cache = cache = DemosaicCache(bpp=len(streamin.data)//ppc,
+                                                          mem_chunks=self.cache_chunks,
                                                           streamin=streamin,
                                                           im_w=im_w,
                                                           im_h=im_h,
-                                                          mem_treshold=Signal(1,reset=0),
+                                                          mem_treshold=Signal(1,reset=self.cache_treshold),
                                                           enable=enable,
-                                                          u_reset=self.ev.irq)
-        super().__init__(cache=cache, im_w=im_w, im_h=im_h, min_lines_req=1, streamout=streamout, active=enable)
+                                                          u_reset=self.ev.irq,
+                                                          ppc=ppc,
+                                                          sync_read=sync_read,
+                                                          max_width=max_width,
+                                                          max_height=max_height,
+                                                          pack=pack)
+        super().__init__(cache=cache, im_w=im_w, im_h=im_h, min_lines_req=1, streamout=streamout, active=enable, rotate=rotate, pipeline=pipeline, out_bpp=out_bpp)
         assert(cache.mem_chunks > self.min_lines_required)
 
+        assert(ppc == cache.ppc)
         kernel_width=2
         kernel_height=2
-        colors = Bayer_kernel(cache.bpp, kernel_width, kernel_height)
+        # the kernel looks only at the right and bottom neighbours
+        window_width = self.window_width(0, kernel_width-1)
+        colors = Bayer_kernel(cache.bpp, window_width, kernel_height)
 
         last_color_decoded = Signal(reset=0)
-        r_val = Signal(cache.bpp)
-        g_val = Signal(cache.bpp)
-        b_val = Signal(cache.bpp)
+        r_val = [Signal(cache.bpp) for _ in range(ppc)]
+        g_val = [Signal(cache.bpp) for _ in range(ppc)]
+        b_val = [Signal(cache.bpp) for _ in range(ppc)]
         self.comb += [
                 If(enable,
-                    self.rgb_data.eq(Cat(b_val, g_val, r_val))
+                    self.rgb_data.eq(self.pack_rgb(r_val, g_val, b_val))
                 )
         ]
         self.sync +=[
-            If(cache.force_reset & ~cache.hold_reset & ~cache.raw_first,
+            If(cache.f_reset & ~cache.raw_first,
                 self.working.eq(0),
                 self.first_pixel.eq(1),
                 self.rgb_first.eq(0),
                 self.rgb_valid.eq(0),
                 last_color_decoded.eq(0),
-                [colors.row(r).eq(Signal(cache.bpp*kernel_width)) for r in range(2)],
+                [colors.row(r).eq(Signal(cache.bpp*window_width)) for r in range(2)],
             )
         ]
 
-        self.submodules.demo_fsm = demo_fsm = FSM(reset_state="FETCH_SYNC0")
+        self.submodules.demo_fsm = demo_fsm = FSM(reset_state=self.reset_state)
 
-        for i in range(cache.mem_chunks):
-            demo_fsm.act("FETCH_SYNC{}".format(i),
-                If(enable,
+        for i in self.chunks():
+            demo_fsm.act(self.state("FETCH_SYNC", i),
+                If(cache.force_reset,
+                    reset_algorithm(),
+                ).Elif(self.chunk_moved(cache.read_chunk, i),
+                    # previous frame decoded by another demosaicer
+                    self.follow_chunk(cache.read_chunk, "FETCH_SYNC"),
+                ).Elif(enable,
                     If(self.rgb_ready,
                         NextValue(self.working, 1),
                         NextValue(self.rgb_valid, 0),
                         NextValue(self.rgb_last,0),
                         If(cache.processed_lines == im_h,
-                            reset_algorithm(),
+                            reset_algorithm(self.state("FETCH_SYNC", i)),
+                            cache.next_frame(),
                         ).Else(
-                            If((cache.collected_lines - cache.processed_lines > self.min_lines_required) | (cache.processed_lines == im_h-1),
+                            If((cache.collected_lines - cache.processed_lines > self.min_lines_required) | (cache.collected_lines >= im_h),
                                 If(~cache.frame_sync_incorrect, fetch_next_col(i)),
-                                If(cache.adrs[i] == kernel_width-1,
+                                If(cache.line_adr(i) == self.fetch_ahead(kernel_width-1),
                                     If(pattern == Bayer_t.RGGB,
-                                        NextState(["FETCH_DECODE_R{}", "FETCH_DECODE_G1{}"][i%2].format(i)),
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_R", i), self.state("FETCH_DECODE_G1", i)),
                                     ).Elif(pattern == Bayer_t.BGGR,
-                                        NextState(["FETCH_DECODE_B{}", "FETCH_DECODE_G0{}"][i%2].format(i)),
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_B", i), self.state("FETCH_DECODE_G0", i)),
                                     ).Elif(pattern == Bayer_t.RGBG,
-                                        NextState(["FETCH_DECODE_R{}", "FETCH_DECODE_B{}"][i%2].format(i)),
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_R", i), self.state("FETCH_DECODE_B", i)),
                                     ).Else(
-                                        NextState(["FETCH_DECODE_G0{}", "FETCH_DECODE_G1{}"][i%2].format(i)),
+                                        self.first_color(cache.processed_lines, self.state("FETCH_DECODE_G0", i), self.state("FETCH_DECODE_G1", i)),
                                     )
                                 )
                             )
@@ -144,28 +170,28 @@ class NearestNeighbour(DemosaicBase):
                     )
                 )
             )
-            demo_fsm.act("FETCH_DECODE_R{}".format(i),
+            demo_fsm.act(self.state("FETCH_DECODE_R", i),
                 If(~cache.force_reset & ~cache.frame_sync_incorrect,
                     If(enable,
                         If(self.rgb_ready ,
-                            get_decoder(pattern, "DECODE_R"),
+                            self.decode(get_decoder, pattern, "DECODE_R"),
                             NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
                             If(~last_color_decoded,
-                                If(cache.adrs[i] < im_w,
+                                If(cache.line_adr(i) < cache.line_w,
                                     fetch_next_col(i),
-                                    self.first_pix(),
-                                    NextState("FETCH_DECODE_G0{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("R"), i)),
                                 ).Else(
                                     fetch_null_col(i),
                                     NextValue(last_color_decoded,1),
-                                    NextState("FETCH_DECODE_G0{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("R"), i)),
                                 )
                             ).Else(
-                                NextValue(cache.processed_lines, cache.processed_lines+1),
+                                cache.line_read.eq(1),
                                 NextValue(last_color_decoded,0),
                                 NextValue(self.rgb_last,1),
-                                fetch_col_on_new_line(i),
-                                NextState("FETCH_SYNC{}".format((i+1)%cache.mem_chunks)),
+                                If(self.next_line_ready(cache, im_h), fetch_col_on_new_line(i)),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
                             )
                         )
                     )
@@ -174,28 +200,28 @@ class NearestNeighbour(DemosaicBase):
                 )
             )
 
-            demo_fsm.act("FETCH_DECODE_G0{}".format(i),
+            demo_fsm.act(self.state("FETCH_DECODE_G0", i),
                 If(~cache.force_reset& ~cache.frame_sync_incorrect,
                     If(enable,
                         If(self.rgb_ready ,
-                            get_decoder(pattern, "DECODE_G0"),
+                            self.decode(get_decoder, pattern, "DECODE_G0"),
                             NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
                             If(~last_color_decoded,
-                                If(cache.adrs[i] < im_w,
+                                If(cache.line_adr(i) < cache.line_w,
                                     fetch_next_col(i),
-                                    self.first_pix(),
-                                    NextState("FETCH_DECODE_R{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G0"), i)),
                                 ).Else(
                                     fetch_null_col(i),
                                     NextValue(last_color_decoded,1),
-                                    NextState("FETCH_DECODE_R{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G0"), i)),
                                 )
                             ).Else(
-                                NextValue(cache.processed_lines, cache.processed_lines+1),
+                                cache.line_read.eq(1),
                                 NextValue(last_color_decoded,0),
                                 NextValue(self.rgb_last,1),
-                                fetch_col_on_new_line(i),
-                                NextState("FETCH_SYNC{}".format((i+1)%cache.mem_chunks)),
+                                If(self.next_line_ready(cache, im_h), fetch_col_on_new_line(i)),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
                             )
                         )
                     )
@@ -204,28 +230,28 @@ class NearestNeighbour(DemosaicBase):
                 )
             )
 
-            demo_fsm.act("FETCH_DECODE_G1{}".format(i),
+            demo_fsm.act(self.state("FETCH_DECODE_G1", i),
                 If(~cache.force_reset& ~cache.frame_sync_incorrect,
                     If(enable,
                         If(self.rgb_ready ,
-                            get_decoder(pattern, "DECODE_G1"),
+                            self.decode(get_decoder, pattern, "DECODE_G1"),
                             NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
                             If(~last_color_decoded,
-                                If(cache.adrs[i] < im_w,
+                                If(cache.line_adr(i) < cache.line_w,
                                     fetch_next_col(i),
-                                    self.first_pix(),
-                                    NextState("FETCH_DECODE_B{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G1"), i)),
                                 ).Else(
                                     fetch_null_col(i),
                                     NextValue(last_color_decoded,1),
-                                    NextState("FETCH_DECODE_B{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("G1"), i)),
                                 )
                             ).Else(
-                                NextValue(cache.processed_lines, cache.processed_lines+1),
+                                cache.line_read.eq(1),
                                 NextValue(last_color_decoded,0),
                                 NextValue(self.rgb_last,1),
-                                fetch_col_on_new_line(i),
-                                NextState("FETCH_SYNC{}".format((i+1)%cache.mem_chunks)),
+                                If(self.next_line_ready(cache, im_h), fetch_col_on_new_line(i)),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
                             )
                         )
                     )
@@ -234,28 +260,28 @@ class NearestNeighbour(DemosaicBase):
                 )
             )
 
-            demo_fsm.act("FETCH_DECODE_B{}".format(i),
+            demo_fsm.act(self.state("FETCH_DECODE_B", i),
                 If(~cache.force_reset & ~cache.frame_sync_incorrect,
                     If(enable,
                         If(self.rgb_ready,
-                            get_decoder(pattern, "DECODE_B"),
+                            self.decode(get_decoder, pattern, "DECODE_B"),
                             NextValue(self.rgb_valid, 1),
+                            self.first_pix(),
                             If(~last_color_decoded,
-                                If(cache.adrs[i] < im_w,
+                                If(cache.line_adr(i) < cache.line_w,
                                     fetch_next_col(i),
-                                    self.first_pix(),
-                                    NextState("FETCH_DECODE_G1{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("B"), i)),
                                 ).Else(
                                     fetch_null_col(i),
                                     NextValue(last_color_decoded,1),
-                                    NextState("FETCH_DECODE_G1{}".format(i)),
+                                    NextState(self.state("FETCH_DECODE_"+self.next_color("B"), i)),
                                 )
                             ).Else(
-                                NextValue(cache.processed_lines, cache.processed_lines+1),
+                                cache.line_read.eq(1),
                                 NextValue(last_color_decoded,0),
                                 NextValue(self.rgb_last,1),
-                                fetch_col_on_new_line(i),
-                                NextState("FETCH_SYNC{}".format((i+1)%cache.mem_chunks)),
+                                If(self.next_line_ready(cache, im_h), fetch_col_on_new_line(i)),
+                                NextState(self.state("FETCH_SYNC", self.next_chunk(i))),
                             )
                         )
                     )
@@ -263,3 +289,5 @@ class NearestNeighbour(DemosaicBase):
                     reset_algorithm(),
                 )
             )
+
+        self.decode_stage(get_decoder, pattern)
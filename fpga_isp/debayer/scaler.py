@@ -0,0 +1,293 @@
+from migen import *
+import math
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class Scaler(Module, AutoCSR):
+    # fractional bits of the steps and positions, and of the interpolation weights
+    frac = 12
+    weight = 8
+
+    # downscales the RGB pixels, ppc pixels of pix_width bits with colors of bpp bits,
+    # blue in the LSBs, lines end with last and frames start with first, by 2x2 or 4x4 binning
+    # or bilinear at an arbitrary ratio, the output pixel x of line y is taken at x*step
+    # of the input line y*step, only the retained pixels are sent, packed ppc to a beat,
+    # the last beat of a line padded with zeros, lines go through a line buffer of
+    # max_width pixels, which keeps the previous line or the running sums of the bins,
+    # the CSRs are copied to shadow registers at the frame start,
+    # by default the output is the input of the given size
+    def __init__(self, bpp, pix_width, ppc=1, max_width=2**13-1, size=(2**13-1, 2**13-1)):
+        self.sink = sink = stream.Endpoint([("data", pix_width*ppc)])
+        self.source = source = stream.Endpoint([("data", pix_width*ppc)])
+        one = 1 << self.frac
+
+        self.ctl = CSRStorage(description="Scaler control",
+            fields=[
+                CSRField("mode", size=2, description="Scaling: 0 - bilinear by the steps, 1 - 2x2 binning, 2 and 3 - 4x4 binning",
+                         reset=0),
+        ])
+        self.size = CSRStorage(description="Output size, the pixels and lines past it are dropped",
+            fields=[
+                CSRField("width", size=13, description="Output width in pixels, a multiple of the pixels per clock "
+                                                       "for the output formatter", reset=size[0]),
+                CSRField("height", size=13, description="Output height in lines", reset=size[1]),
+        ])
+        self.step = CSRStorage(description="Bilinear steps in input pixels per output pixel, unsigned 4.12 fixed point, "
+                                           "0x1000 (no scaling) or more, the last output pixel and line "
+                                           "may not be taken past the last input pixel and line",
+            fields=[
+                CSRField("x", size=16, description="Horizontal step", reset=one),
+                CSRField("y", size=16, description="Vertical step", reset=one),
+        ])
+
+        # the packer holds the input for a cycle when a line end leaves two beats to send
+        advance = Signal()
+        flush = Signal()
+        valid1 = Signal()
+        valid2 = Signal()
+        self.comb += [
+            advance.eq(pipeline_advance(source.valid, source.ready)),
+            sink.ready.eq(advance & ~flush),
+        ]
+        accept = sink.valid & sink.ready
+        first = sink.first
+
+        settings = frame_settings(self, sink, [self.ctl, self.size, self.step])
+        offsets = {f.name: f.offset for csr in [self.ctl, self.size, self.step] for f in csr.fields.fields}
+        mode = settings[0][offsets["mode"]:offsets["mode"]+2]
+        width = settings[1][offsets["width"]:offsets["width"]+13]
+        height = settings[1][offsets["height"]:offsets["height"]+13]
+        step_x = settings[2][offsets["x"]:offsets["x"]+16]
+        step_y = settings[2][offsets["y"]:offsets["y"]+16]
+        box = mode != 0
+        # bins of 2 or 4, pixel and line index in a bin
+        mask = Mux(mode == 1, 1, 3)
+
+        # stage 0, beat and line in the frame, output pixel and line counts and positions
+        pos_width = 13 + self.frac + 2
+        ppc_bits = int(math.log(ppc, 2))
+        col = Signal(13)
+        line = Signal(13)
+        xo = Signal(13)
+        yo = Signal(13)
+        sx = Signal(pos_width)
+        sy = Signal(pos_width)
+        new_line = Signal(reset=1)
+        col_in = Mux(first | new_line, 0, col)
+        line_in = Mux(first, 0, line)
+        xo_in = Mux(first | new_line, 0, xo)
+        yo_in = Mux(first, 0, yo)
+        sx_in = Mux(first | new_line, 0, sx)
+        sy_in = Mux(first, 0, sy)
+
+        # the line is sent at the last line of a bin, or at the one below the position,
+        # right at it when the position is on a line
+        fy = sy_in[:self.frac]
+        v_emit = Signal()
+        v_start = Signal()
+        self.comb += [
+            v_emit.eq(Mux(box, (line_in & mask) == mask, line_in == sy_in[self.frac:] + (fy != 0)) & (yo_in < height)),
+            v_start.eq((line_in & mask) == 0),
+        ]
+
+        # stage 0, horizontally scaled pixels, the sums of the bins are kept over the beats
+        hw = bpp + 2
+        colors = lambda pix: [pix[c*bpp:(c+1)*bpp] for c in range(3)]
+        pixels = [colors(sink.data[j*pix_width:(j+1)*pix_width]) for j in range(ppc)]
+        acc = [Signal(hw) for _ in range(3)]
+        prev = [Signal(bpp) for _ in range(3)]
+        # the positions of the next ppc output pixels
+        positions = [sx_in + k*step_x for k in range(ppc+1)]
+        sums = acc
+        raw_emit = []
+        values = []
+        for j in range(ppc):
+            i = Cat(C(j, ppc_bits), col_in) if ppc > 1 else col_in
+            # binning
+            start = (i & mask) == 0
+            s = [Signal(hw) for _ in range(3)]
+            self.comb += [s[c].eq(Mux(start, 0, sums[c]) + pixels[j][c]) for c in range(3)]
+            sums = s
+            # bilinear, the pixel is right of the position of an output pixel, or at it
+            matches = [p[self.frac:] + (p[:self.frac] != 0) == i for p in positions[:ppc]]
+            fx = Signal(self.frac)
+            self.comb += [If(m, fx.eq(p[:self.frac])) for m, p in zip(matches, positions)]
+            left = pixels[j-1] if j else prev
+            bilinear = [Signal(bpp) for _ in range(3)]
+            self.comb += [bilinear[c].eq(self.interpolate(left[c], pixels[j][c], fx)) for c in range(3)]
+            emit = Signal()
+            value = Signal(3*hw)
+            self.comb += [
+                emit.eq(Mux(box, (i & mask) == mask, Cat(*matches) != 0)),
+                value.eq(Mux(box, Cat(*s), Cat(*[Cat(b, Signal(hw-bpp)) for b in bilinear]))),
+            ]
+            raw_emit.append(emit)
+            values.append(value)
+
+        # pixels past the output width are dropped, the others are packed in order
+        emits = []
+        count = C(0)
+        compact = [Signal(3*hw) for _ in range(ppc)]
+        for j in range(ppc):
+            e = Signal()
+            self.comb += e.eq(raw_emit[j] & (xo_in + count < width))
+            self.comb += [If(e & (count == k), compact[k].eq(values[j])) for k in range(ppc)]
+            emits.append(e)
+            count = count + e
+        n = Signal(ppc_bits+1)
+        self.comb += n.eq(count)
+        xo_next = xo_in + n
+        done = (n != 0) & (xo_next == width)
+
+        self.sync += If(accept,
+            col.eq(col_in + 1),
+            xo.eq(xo_next),
+            sx.eq(Array(positions)[n]),
+            [a.eq(s) for a, s in zip(acc, sums)],
+            [p.eq(c) for p, c in zip(prev, pixels[-1])],
+            new_line.eq(sink.last),
+            line.eq(line_in + sink.last),
+            yo.eq(yo_in + (sink.last & v_emit)),
+            sy.eq(Mux(sink.last & v_emit, sy_in + step_y, sy_in)),
+        )
+
+        # stage 1, packed pixels of the beat and the line
+        first1 = Signal()
+        end1 = Signal()
+        n1 = Signal(ppc_bits+1)
+        c1 = [Signal(3*hw) for _ in range(ppc)]
+        vinfo = [v_emit, v_start, mode, fy]
+        vinfo1 = [Signal(len(v)) for v in vinfo]
+        self.sync += If(advance & ~flush,
+            valid1.eq(sink.valid),
+            first1.eq(first),
+            end1.eq(sink.last | done),
+            n1.eq(n),
+            [a.eq(b) for a, b in zip(c1, compact)],
+            [a.eq(b) for a, b in zip(vinfo1, vinfo)],
+        )
+
+        # packer, the pixels of the beats staged until a beat is full or the line ends
+        cnt = Signal(ppc_bits+1)
+        st = [Signal(3*hw) for _ in range(ppc)]
+        total = Signal(ppc_bits+2)
+        self.comb += total.eq(cnt + Mux(valid1, n1, 0))
+        zero = Signal(3*hw)
+        padded = Array(c1 + [zero]*(3*ppc))
+        merged = [Mux(l < cnt, st[l], padded[(l - cnt)[:ppc_bits+2]]) if l < ppc else padded[(l - cnt)[:ppc_bits+2]]
+                  for l in range(2*ppc)]
+        end = valid1 & end1
+        full = total >= ppc
+        rest = total - ppc
+        # the line values of the beat sent by a flush
+        vinfo_p = [Signal(len(v)) for v in vinfo]
+        pfirst = Signal()
+        pidx = Signal(13)
+
+        # stage 2, packed beat and its index in the line
+        first2 = Signal()
+        last2 = Signal()
+        idx2 = Signal(13)
+        p2 = [Signal(3*hw) for _ in range(ppc)]
+        vinfo2 = [Signal(len(v)) for v in vinfo]
+        load2 = Signal()
+        last_new = Signal()
+        self.comb += [
+            load2.eq(Mux(flush, 1, full | (end & (total != 0)))),
+            last_new.eq(Mux(flush, 1, end & (~full | (rest == 0)))),
+        ]
+        self.sync += If(advance,
+            valid2.eq(load2),
+            If(load2,
+                first2.eq(pfirst | (~flush & valid1 & first1)),
+                pfirst.eq(0),
+                last2.eq(last_new),
+                idx2.eq(pidx),
+                pidx.eq(Mux(last_new, 0, pidx + 1)),
+            ).Else(
+                pfirst.eq(pfirst | (valid1 & first1)),
+            ),
+            If(flush,
+                [a.eq(Mux(l < cnt, s, 0)) for l, (a, s) in enumerate(zip(p2, st))],
+                [a.eq(b) for a, b in zip(vinfo2, vinfo_p)],
+                cnt.eq(0),
+                flush.eq(0),
+            ).Else(
+                [a.eq(merged[l]) for l, a in enumerate(p2)],
+                [a.eq(b) for a, b in zip(vinfo2, vinfo1)],
+                [a.eq(b) for a, b in zip(vinfo_p, vinfo1)],
+                If(full,
+                    [s.eq(merged[ppc+l]) for l, s in enumerate(st)],
+                    cnt.eq(rest),
+                    flush.eq(end & (rest != 0)),
+                ).Elif(end,
+                    cnt.eq(0),
+                ).Else(
+                    [s.eq(merged[l]) for l, s in enumerate(st)],
+                    cnt.eq(total),
+                ),
+            ),
+        )
+
+        # line buffer of the previous line, or the running sums of the bins, a beat per entry,
+        # the entry of the beat is read when the beat is loaded, the write of that cycle is forwarded
+        vw = bpp + 4
+        mem = Memory(3*vw*ppc, (max_width + ppc-1)//ppc)
+        rport = mem.get_port()
+        wport = mem.get_port(write_capable=True)
+        self.specials += mem, rport, wport
+        fwd = Signal()
+        fwd_data = Signal(3*vw*ppc)
+        buf = Signal(3*vw*ppc)
+        self.comb += [
+            rport.adr.eq(Mux(advance, pidx, idx2)),
+            buf.eq(Mux(fwd, fwd_data, rport.dat_r)),
+            wport.adr.eq(idx2),
+            wport.we.eq(advance & valid2),
+        ]
+        self.sync += If(advance,
+            fwd.eq(wport.we & (idx2 == pidx)),
+            fwd_data.eq(wport.dat_w),
+        )
+
+        # stage 3, vertically scaled pixels of the lines sent
+        v_emit2, v_start2, mode2, fy2 = vinfo2
+        written = []
+        out = []
+        for l in range(ppc):
+            for c in range(3):
+                cur = p2[l][c*hw:(c+1)*hw]
+                above = buf[(3*l+c)*vw:(3*l+c+1)*vw]
+                vsum = Signal(vw)
+                result = Signal(bpp)
+                self.comb += [
+                    vsum.eq(Mux(v_start2, 0, above) + cur),
+                    If(mode2 == 0,
+                        result.eq(self.interpolate(above[:bpp], cur[:bpp], fy2)),
+                    ).Elif(mode2 == 1,
+                        result.eq((vsum + 2) >> 2),
+                    ).Else(
+                        result.eq((vsum + 8) >> 4),
+                    ),
+                ]
+                written.append(Mux(mode2 == 0, cur, vsum))
+                out.append(result)
+        self.comb += wport.dat_w.eq(Cat(*[Cat(w, Signal(vw-len(w))) if len(w) < vw else w for w in written]))
+
+        ofirst = Signal()
+        self.sync += If(advance,
+            source.valid.eq(valid2 & v_emit2),
+            source.first.eq(first2 | ofirst),
+            source.last.eq(last2),
+            source.data.eq(Cat(*[Cat(*out[3*l:3*(l+1)], Signal(pix_width-3*bpp)) for l in range(ppc)])),
+            If(valid2,
+                ofirst.eq((ofirst | first2) & ~v_emit2),
+            ),
+        )
+
+    # a pixel between left and right at frac, right itself when frac is zero
+    def interpolate(self, left, right, frac):
+        w = frac[self.frac-self.weight:]
+        return Mux(frac == 0, right, (left*((1 << self.weight) - w) + right*w + (1 << self.weight-1)) >> self.weight)
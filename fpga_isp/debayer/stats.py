@@ -0,0 +1,203 @@
+from migen import *
+import math
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect.csr_eventmanager import *
+from fpga_isp.debayer.common import *
+
+class Statistics(Module, AutoCSR):
+    # luma weights of red, green and blue, scaled by 256
+    luma = (77, 150, 29)
+    # bits of a histogram bin and of the sum of a color in a zone
+    count_width = 32
+
+    # passive tap on a stream of RGB pixels, ppc pixels of pix_width bits with colors of bpp bits,
+    # blue in the LSBs, lines end with last and frames of im_h lines start with first,
+    # builds per frame histograms of the luma, red, green and blue in bins of the color MSBs
+    # and the sums of the colors over a grid of zones in block RAM, every result has two banks:
+    # the frame is accumulated in one bank while the CPU reads the last frame from the other one,
+    # the banks are swapped and the done event is raised at the end of a frame,
+    # entries not written in a frame read as zero, so no bank has to be cleared,
+    # a counter is read and written back a cycle later, the write of the previous
+    # cycle is forwarded, the CPU reads through the write port when it is free
+    def __init__(self, tap, im_h, bpp, pix_width, ppc=1, bins=64, zones=(8, 8), size=None):
+        hist_bits = int(math.log(bins, 2))
+        zone_bits = [int(math.log(n, 2)) for n in zones]
+        assert(2**hist_bits == bins and hist_bits <= bpp)
+        assert(all(2**b == n for b, n in zip(zone_bits, zones)))
+        # by default the zones cover a frame of the given size
+        zone_w, zone_h = (ppc, 1) if size is None else (max(size[0]//zones[0]//ppc, 1)*ppc, max(size[1]//zones[1], 1))
+
+        self.zones = CSRStorage(description="Size of the zones, the grid starts at the first pixel of a frame, "
+                                            "the pixels right of or below the grid are not summed",
+            fields=[
+                CSRField("width", size=13, description="Zone width in pixels, a multiple of the pixels per clock", reset=zone_w),
+                CSRField("height", size=13, description="Zone height in lines", reset=zone_h),
+        ])
+        self.adr = CSRStorage(description="Read address of the results of the last frame",
+            fields=[
+                CSRField("bin", size=hist_bits, description="Bin of the histogram"),
+                CSRField("channel", size=2, description="Histogram: 0 - luma, 1 - red, 2 - green, 3 - blue"),
+                CSRField("zone", size=max(sum(zone_bits), 1), description="Zone, {} zones per row".format(zones[0])),
+        ])
+        self.hist = CSRStatus(self.count_width, description="Pixels in the bin at the read address")
+        self.zone = CSRStatus(description="Sums of the colors in the zone at the read address",
+            fields=[
+                CSRField(c, size=self.count_width, description="Sum of {}".format(n))
+                for c, n in [("r", "red"), ("g", "green"), ("b", "blue")]
+        ])
+        self.status = CSRStatus(description="Statistics status",
+            fields=[
+                CSRField("ready", size=1, description="The results at the read address are valid, "
+                                                      "cleared for a few cycles when the address is written or a frame is done"),
+        ])
+        self.submodules.ev = EventManager()
+        self.ev.done = EventSourcePulse(description="Frame done, its results can be read")
+
+        # frame progress, the bank flips after the last line
+        fire = tap.valid & tap.ready
+        first = tap.first
+        bank = Signal()
+        line = Signal(13)
+        line_in = Mux(first, 0, line)
+        frame_end = Signal()
+        self.comb += frame_end.eq(fire & tap.last & (line_in == im_h-1))
+        self.sync += [
+            If(fire,
+                line.eq(Mux(tap.last, line_in + 1, line_in)),
+            ),
+            If(frame_end,
+                line.eq(0),
+                bank.eq(~bank),
+            ),
+        ]
+        # the bank accumulating the frame is emptied when it starts, again or after a cut frame
+        clear = Signal()
+        clear_bank = Signal()
+        self.comb += [
+            clear.eq(frame_end | (fire & first)),
+            clear_bank.eq(Mux(frame_end, ~bank, bank)),
+        ]
+        done = Signal()
+        self.sync += done.eq(frame_end)
+        self.comb += self.ev.done.trigger.eq(done)
+
+        # zone of the beat, the zone counters stop one past the grid
+        xin = Signal(13)
+        yin = Signal(13)
+        zx = Signal(zone_bits[0]+1)
+        zy = Signal(zone_bits[1]+1)
+        xin_in = Mux(first, 0, xin)
+        yin_in = Mux(first, 0, yin)
+        zx_in = Mux(first, 0, zx)
+        zy_in = Mux(first, 0, zy)
+        zone_w_beats = self.zones.fields.width >> int(math.log(ppc, 2))
+        self.sync += If(fire,
+            If(tap.last,
+                xin.eq(0),
+                zx.eq(0),
+                If(yin_in == self.zones.fields.height-1,
+                    yin.eq(0),
+                    zy.eq(zy_in + (zy_in != zones[1])),
+                ).Else(
+                    yin.eq(yin_in + 1),
+                    zy.eq(zy_in),
+                ),
+            ).Else(
+                If(xin_in == zone_w_beats-1,
+                    xin.eq(0),
+                    zx.eq(zx_in + (zx_in != zones[0])),
+                ).Else(
+                    xin.eq(xin_in + 1),
+                    zx.eq(zx_in),
+                ),
+                yin.eq(yin_in),
+                zy.eq(zy_in),
+            ),
+        )
+
+        # stage 1 holds the beat while its counters are read
+        valid1 = Signal()
+        bank1 = Signal()
+        inside1 = Signal()
+        zone1 = Signal(max(sum(zone_bits), 1))
+        self.sync += [
+            valid1.eq(fire),
+            bank1.eq(bank),
+            inside1.eq((zx_in < zones[0]) & (zy_in < zones[1])),
+            zone1.eq(Cat(zx_in[:zone_bits[0]], zy_in[:zone_bits[1]])),
+        ]
+
+        # the CPU reads the other bank when no counter is written, the value of the address
+        # is there a cycle later when neither the address nor the bank changed meanwhile
+        read = Signal()
+        self.sync += [
+            read.eq(~valid1 & ~self.adr.re & ~frame_end),
+            If(self.adr.re | frame_end,
+                self.status.fields.ready.eq(0),
+            ).Elif(read,
+                self.status.fields.ready.eq(1),
+            ),
+        ]
+
+        # counters read at stage 0, written at stage 1, entries of the bank not written
+        # since it was cleared read as zero, returns the value read by the CPU
+        def accumulate(width, adr0, adr1, we, increment, cpu_adr):
+            depth = 2**len(adr1)
+            mem = Memory(width, depth)
+            rport = mem.get_port()
+            wport = mem.get_port(write_capable=True)
+            self.specials += mem, rport, wport
+            written = Array(Signal() for _ in range(depth))
+            last_we = Signal()
+            last_adr = Signal(len(adr1))
+            last_value = Signal(width)
+            value = Signal(width)
+            self.comb += [
+                rport.adr.eq(adr0),
+                value.eq(increment(Mux(last_we & (last_adr == adr1), last_value, Mux(written[adr1], rport.dat_r, 0)))),
+                wport.adr.eq(Mux(valid1, adr1, cpu_adr)),
+                wport.dat_w.eq(value),
+                wport.we.eq(we),
+            ]
+            self.sync += [
+                If(we,
+                    written[adr1].eq(1),
+                ),
+                last_we.eq(we),
+                last_adr.eq(adr1),
+                last_value.eq(value),
+                If(clear,
+                    [If(clear_bank == i >> (len(adr1)-1), w.eq(0)) for i, w in enumerate(written)],
+                    If(bank1 == clear_bank, last_we.eq(0)),
+                ),
+            ]
+            return Mux(written[cpu_adr], wport.dat_r, 0)
+
+        # histograms, a table per lane and channel
+        counts = [[] for _ in range(4)]
+        for j in range(ppc):
+            pix = tap.data[j*pix_width:(j+1)*pix_width]
+            b, g, r = [pix[c*bpp:(c+1)*bpp] for c in range(3)]
+            luma = Signal(bpp)
+            self.comb += luma.eq((self.luma[0]*r + self.luma[1]*g + self.luma[2]*b) >> 8)
+            for c, color in enumerate([luma, r, g, b]):
+                bin0 = color[bpp-hist_bits:]
+                bin1 = Signal(hist_bits)
+                self.sync += bin1.eq(bin0)
+                counts[c].append(accumulate(self.count_width, Cat(bin0, bank), Cat(bin1, bank1), valid1,
+                                            lambda v: v + 1, Cat(self.adr.fields.bin, ~bank)))
+        hist = Signal(self.count_width)
+        self.comb += hist.eq(Array(sum(lanes) for lanes in counts)[self.adr.fields.channel])
+        self.sync += If(read, self.hist.status.eq(hist))
+
+        # zone sums of red, green and blue of the beat, from the MSBs
+        sums1 = [Signal(bpp+2) for _ in range(3)]
+        for c, s in enumerate(sums1):
+            self.sync += s.eq(sum(tap.data[j*pix_width+(2-c)*bpp:j*pix_width+(3-c)*bpp] for j in range(ppc)))
+        w = self.count_width
+        zone0 = Cat(zx_in[:zone_bits[0]], zy_in[:zone_bits[1]])
+        sums = accumulate(3*w, Cat(zone0, bank), Cat(zone1, bank1), valid1 & inside1,
+                          lambda v: Cat(*[(v[k*w:(k+1)*w] + s)[:w] for k, s in enumerate(sums1)]),
+                          Cat(self.adr.fields.zone[:sum(zone_bits)], ~bank))
+        self.sync += If(read, [getattr(self.zone.fields, c).eq(sums[k*w:(k+1)*w]) for k, c in enumerate("rgb")])
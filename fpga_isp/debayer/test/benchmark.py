@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import sys
+import json
+import random
+import argparse
+
+from migen import *
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.wrapper import *
+from fpga_isp.debayer.common import *
+
+algorithms = {
+    "Nearest"  : Demosaic_t.NEAREST,
+    "Bilinear" : Demosaic_t.BILINEAR,
+    "Edge"     : Demosaic_t.EDGE_DIRECTED,
+    "Malvar"   : Demosaic_t.MALVAR,
+}
+
+# backpressure profiles, tell whether a stream side is active in the given cycle
+class Profile:
+    def __init__(self, name, seed):
+        self.name = name
+        self.rnd = random.Random(seed)
+        self.active = True
+        self.left = 0
+
+    def __call__(self, cycle):
+        if self.name == "none":
+            return True
+        elif self.name == "random":
+            return self.rnd.random() < 0.7
+        elif self.name == "periodic":
+            return cycle % 4 != 3
+        elif self.name == "bursty":
+            # active and idle runs of random length, mostly active
+            if self.left == 0:
+                self.active = not self.active
+                self.left = self.rnd.randint(8, 64) if self.active else self.rnd.randint(1, 16)
+            self.left -= 1
+            return self.active
+        raise ValueError(self.name)
+
+profiles = ["none", "random", "bursty", "periodic"]
+
+class Bench(Module):
+    def __init__(self, algorithm, width, height, pattern, ppc=1, **kw):
+        self.raw = raw = stream.Endpoint([("data", 32)])
+        self.rgb = rgb = stream.Endpoint([("data", 32*ppc)])
+        self.submodules.wrapper = DemosaicWrapper(algorithm, raw, rgb, width, height, pattern,
+                                                  in_reverse=True, ppc=ppc, algorithms=[algorithm], **kw)
+
+def run(alg, width, height, pattern, upstream, downstream, frames=2, ppc=1, seed=0, timeout=10000,
+        sync_read=False, rotate=False, pipeline=0):
+    rnd = random.Random(seed)
+    bench = Bench(algorithms[alg], width, height, pattern, ppc, sync_read=sync_read, rotate=rotate, pipeline=pipeline)
+    raw, rgb = bench.raw, bench.rgb
+    frame_words = width*height//4
+    words = [rnd.randrange(2**32) for _ in range(frames*frame_words)]
+    up = Profile(upstream, seed+1)
+    down = Profile(downstream, seed+2)
+    # cycles of the first accepted input word of each frame and of each output word
+    first_in = []
+    out = []
+
+    @passive
+    def sender():
+        cycle = 0
+        yield raw.last.eq(1)
+        for i, word in enumerate(words):
+            while not up(cycle):
+                yield raw.valid.eq(0)
+                yield
+                cycle += 1
+            yield raw.data.eq(word)
+            yield raw.valid.eq(1)
+            yield raw.first.eq(i % frame_words == 0)
+            yield
+            cycle += 1
+            while not (yield raw.ready):
+                yield
+                cycle += 1
+            if i % frame_words == 0:
+                first_in.append(cycle)
+        yield raw.valid.eq(0)
+
+    def receiver():
+        cycle = 0
+        progress = 0
+        while len(out) < frames*width*height//ppc and cycle - progress < timeout:
+            ready = down(cycle)
+            yield rgb.ready.eq(ready)
+            yield
+            cycle += 1
+            if ready and (yield rgb.valid):
+                out.append(cycle)
+                progress = cycle
+
+    run_simulation(bench, [sender(), receiver()])
+
+    res = {
+        "algorithm"  : alg,
+        "pattern"    : Bayer_t(pattern).name,
+        "size"       : "{}x{}".format(width, height),
+        "upstream"   : upstream,
+        "downstream" : downstream,
+        "ppc"        : ppc,
+        "sync_read"  : sync_read,
+        "rotate"     : rotate,
+        "pipeline"   : pipeline,
+        "frames"     : frames,
+        "seed"       : seed,
+        "hung"       : len(out) < frames*width*height//ppc,
+    }
+    if res["hung"]:
+        return res
+    line_words = width//ppc
+    out_frames = [out[f*height*line_words:(f+1)*height*line_words] for f in range(frames)]
+    # cycles per output line above the words of the line, within a frame
+    line_ends = [[o[(k+1)*line_words-1] for k in range(height)] for o in out_frames]
+    line_times = [e[k+1]-e[k] for e in line_ends for k in range(height-1)]
+    gaps = [out_frames[f+1][0]-out_frames[f][-1]-1 for f in range(frames-1)]
+    res.update({
+        "cycles"           : out[-1]-first_in[0]+1,
+        "pixels_per_cycle" : round(frames*width*height/(out[-1]-first_in[0]+1), 4),
+        "latency"          : max(o[0]-i for o, i in zip(out_frames, first_in)),
+        "line_overhead"    : round(sum(line_times)/len(line_times)-line_words, 2) if line_times else 0,
+        "frame_gap"        : max(gaps) if gaps else 0,
+    })
+    return res
+
+# a result is compared only with the baseline of the same configuration
+config = ["algorithm", "pattern", "size", "upstream", "downstream", "ppc", "sync_read", "rotate", "pipeline", "frames", "seed"]
+
+def key(res):
+    return tuple(res[k] for k in config)
+
+# throughput may not drop and latency may not grow by more than the tolerance,
+# a result without a baseline fails, as the baseline was taken for other settings,
+# and so does one with a hung baseline, which was taken on a broken build
+def regressions(results, baseline, tolerance):
+    base = {key(r): r for r in baseline}
+    failed = []
+    for r in results:
+        b = base.get(key(r))
+        if r["hung"]:
+            failed.append((r, "hung"))
+        elif b is None:
+            failed.append((r, "missing from the baseline"))
+        elif b["hung"]:
+            failed.append((r, "baseline hung"))
+        elif r["pixels_per_cycle"] < b["pixels_per_cycle"]*(1-tolerance):
+            failed.append((r, "pixels_per_cycle {} < {}".format(r["pixels_per_cycle"], b["pixels_per_cycle"])))
+        elif r["latency"] > b["latency"]*(1+tolerance)+1:
+            failed.append((r, "latency {} > {}".format(r["latency"], b["latency"])))
+    return failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Demosaicer throughput and latency benchmark")
+    parser.add_argument("--algorithm", nargs="+", default=list(algorithms), choices=list(algorithms))
+    parser.add_argument("--pattern", nargs="+", default=["RGGB"], choices=[p.name for p in Bayer_t])
+    parser.add_argument("--size", nargs="+", default=["32x8", "64x16"], help="image sizes, WIDTHxHEIGHT")
+    parser.add_argument("--upstream", nargs="+", default=["none", "random"], choices=profiles, help="input valid profiles")
+    parser.add_argument("--downstream", nargs="+", default=profiles, choices=profiles, help="output ready profiles")
+    parser.add_argument("--frames", type=int, default=2, help="frames sent back to back in every run")
+    parser.add_argument("--ppc", type=int, default=1, help="pixels processed per clock: 1, 2 or 4")
+    parser.add_argument("--sync_read", action="store_true", help="use line buffers with synchronous read")
+    parser.add_argument("--rotate", action="store_true", help="decode with a rotating line index")
+    parser.add_argument("--pipeline", type=int, default=0, help="register stages of the decode adder trees")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to a JSON file")
+    parser.add_argument("--baseline", help="fail on a regression against the results in a JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="allowed relative regression")
+    args = parser.parse_args()
+
+    results = []
+    for alg in args.algorithm:
+        for pattern in args.pattern:
+            for size in args.size:
+                width, height = map(int, size.split("x"))
+                for upstream in args.upstream:
+                    for downstream in args.downstream:
+                        res = run(alg, width, height, Bayer_t[pattern], upstream, downstream, args.frames, args.ppc, args.seed,
+                                  sync_read=args.sync_read, rotate=args.rotate, pipeline=args.pipeline)
+                        results.append(res)
+                        print(" ".join("{}={}".format(k, v) for k, v in res.items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failed = regressions(results, json.load(f), args.tolerance)
+        for r, reason in failed:
+            print("REGRESSION {}: {}".format(" ".join(map(str, key(r))), reason))
+        if failed:
+            sys.exit(1)
@@ -138,6 +138,53 @@ def get_result(algorithm, pattern=Bayer_t.RGGB):
             ]
         raise ValueError
 
+    elif algorithm == Demosaic_t.MALVAR:
+        if pattern == Bayer_t.RGGB:
+            return [
+                0x010101, 0x010202, 0x030303, 0x050404, 0x0a0909, 0x0a0a09,
+                0x030505, 0x030506, 0x060708, 0x080708, 0x0c0b0c, 0x090b0b,
+                0x010202, 0x000204, 0x030405, 0x040405, 0x0c0c0d, 0x0b0c0d,
+                0x020505, 0x020406, 0x050708, 0x070608, 0x0e0d0f, 0x090c0d,
+                0x010202, 0x000204, 0x030305, 0x040405, 0x0e0e10, 0x0d0e10,
+                0x020505, 0x020406, 0x050708, 0x070608, 0x0f0f11, 0x0b0d0f,
+                0x010303, 0x000204, 0x030405, 0x030405, 0x0e1012, 0x0c0e12,
+                0x030505, 0x020406, 0x050708, 0x040608, 0x0c0f12, 0x0a0b0f,
+            ]
+        elif pattern == Bayer_t.BGGR:
+            return [
+                0x010101, 0x020201, 0x030303, 0x040405, 0x09090a, 0x090a0a,
+                0x050503, 0x060503, 0x080706, 0x080708, 0x0c0b0c, 0x0b0b09,
+                0x020201, 0x040200, 0x050403, 0x050404, 0x0d0c0c, 0x0d0c0b,
+                0x050502, 0x060402, 0x080705, 0x080607, 0x0f0d0e, 0x0d0c09,
+                0x020201, 0x040200, 0x050303, 0x050404, 0x100e0e, 0x100e0d,
+                0x050502, 0x060402, 0x080705, 0x080607, 0x110f0f, 0x0f0d0b,
+                0x030301, 0x040200, 0x050403, 0x050403, 0x12100e, 0x120e0c,
+                0x050503, 0x060402, 0x080705, 0x080604, 0x120f0c, 0x0f0b0a,
+            ]
+        elif pattern == Bayer_t.RGBG:
+            return [
+                0x010102, 0x020203, 0x030303, 0x060404, 0x0a0705, 0x050a02,
+                0x010305, 0x020606, 0x030707, 0x070809, 0x0b090b, 0x050b05,
+                0x010105, 0x020206, 0x030307, 0x070409, 0x0c080c, 0x060c06,
+                0x010305, 0x020606, 0x030707, 0x08080a, 0x0d0a0d, 0x060d06,
+                0x010105, 0x020206, 0x030307, 0x08040a, 0x0e090e, 0x070e07,
+                0x010305, 0x020606, 0x030707, 0x08080b, 0x0e0b0f, 0x070f07,
+                0x010105, 0x020206, 0x030307, 0x08040b, 0x0e090f, 0x070e07,
+                0x000305, 0x010606, 0x010707, 0x04080b, 0x070b0f, 0x030f07,
+            ]
+        elif pattern == Bayer_t.GRGB:
+            return [
+                0x010101, 0x020203, 0x030303, 0x040604, 0x070a04, 0x0a0505,
+                0x010503, 0x020606, 0x030707, 0x040908, 0x070b09, 0x0b050b,
+                0x010103, 0x020206, 0x030307, 0x040708, 0x080c0a, 0x0c060c,
+                0x010503, 0x020606, 0x030707, 0x040a08, 0x080d0a, 0x0d060d,
+                0x010103, 0x020206, 0x030307, 0x040808, 0x090e0b, 0x0e070e,
+                0x010503, 0x020606, 0x030707, 0x040b08, 0x090f0b, 0x0e070f,
+                0x010103, 0x020206, 0x030307, 0x040808, 0x090e0b, 0x0e070f,
+                0x000503, 0x010606, 0x010707, 0x020b08, 0x040f0b, 0x07070f,
+            ]
+        raise ValueError
+
 def get_img_description(algorithm):
     if algorithm == Demosaic_t.NEAREST:
         return {
@@ -163,6 +210,14 @@ def get_img_description(algorithm):
             "pattern" : Bayer_t.RGGB,
             "data"    : []
         }
+    elif algorithm == Demosaic_t.MALVAR:
+        return {
+            "name"    : "dummy",
+            "width"   : 6,
+            "height"  : 8,
+            "pattern" : Bayer_t.RGGB,
+            "data"    : []
+        }
 
 def get_img_data(algorithm):
     if algorithm == Demosaic_t.NEAREST:
@@ -198,6 +253,21 @@ def get_img_data(algorithm):
             0x0e0e0506,
             0x07080f0f
         ]
+    elif algorithm == Demosaic_t.MALVAR:
+        return [
+            0x01020304,
+            0x0a0a0506,
+            0x07080b0b,
+            0x01020304,
+            0x0c0c0506,
+            0x07080d0d,
+            0x01020304,
+            0x0e0e0506,
+            0x07080f0f,
+            0x01020304,
+            0x0e0e0506,
+            0x07080f0f
+        ]
 def load_image():
     with open("im.gray", "rb") as f:
         im = f.read()
@@ -219,10 +289,24 @@ class TB(Module):
     bayer_raw_layout = [("data",   32)]
     bayer_rgb_layout = [("data",   32)]
     AXI_W=4
-    def __init__(self, im, algorithm):
+    def __init__(self, im, algorithm, ppc=1, sync_read=False, rotate=False, pipeline=0, algorithms=None, perf_counters=False, bpp=8, out_bpp=None,
+                 packing=Packing_t.NONE, out_width=None, out_format=Format_t.XRGB, csc=False, matrix=Matrix_t.BT601,
+                 white_balance=False, gamma=False, ccm=False, stats=False, dpc=False, scaler=False, crop=False,
+                 max_width=None, max_height=None, pack=None):
         # create image streams
+        self.ppc = ppc
+        # pixels deeper than 8 bits are sent in 16-bit containers, or MIPI packed
+        self.pixels_per_word = 4 if bpp <= 8 else 2
+        if packing != Packing_t.NONE:
+            self.pixels_per_word = 32/MipiUnpacker.formats[packing][0]
+        self.pix_width = DemosaicWrapper.pixel_width(bpp if out_bpp is None else out_bpp)
+        # formatted output words are received whole
+        self.pixels_per_beat = ppc
+        if out_width is not None:
+            self.pix_width = out_width
+            self.pixels_per_beat = 1
         self.raw = raw = stream.Endpoint(self.bayer_raw_layout) # input raw bayer image
-        self.rgb = rgb = stream.Endpoint(self.bayer_rgb_layout) # outpur processed rgb image
+        self.rgb = rgb = stream.Endpoint([("data", self.pix_width*self.pixels_per_beat)]) # outpur processed rgb image
         self.wrapper = DemosaicWrapper(algorithm,
                                        raw,
                                        rgb,
@@ -230,8 +314,33 @@ class TB(Module):
                                        im["height"],
                                        im["pattern"],
                                        in_reverse=True,
-                                       out_reverse=False)
+                                       out_reverse=False,
+                                       ppc=ppc,
+                                       sync_read=sync_read,
+                                       max_width=max_width,
+                                       max_height=max_height,
+                                       pack=pack,
+                                       rotate=rotate,
+                                       pipeline=pipeline,
+                                       algorithms=algorithms,
+                                       perf_counters=perf_counters,
+                                       bpp=bpp,
+                                       out_bpp=out_bpp,
+                                       unpacker=packing != Packing_t.NONE,
+                                       packing=packing,
+                                       out_width=out_width,
+                                       out_format=out_format,
+                                       csc=csc,
+                                       matrix=matrix,
+                                       white_balance=white_balance,
+                                       gamma=gamma, ccm=ccm, stats=stats, dpc=dpc, scaler=scaler, crop=crop)
         self.error_occured=0
+        # frames taken whole by rec_compare
+        self.frames_received=0
+
+    # split output word into separate pixels
+    def get_pixels(self, word):
+        return [(word >> (self.pix_width*i)) & (2**self.pix_width-1) for i in range(self.pixels_per_beat)]
     def set_algorithm(self, algorithm):
         return self.wrapper.demo_ctl.fields.algorithm.eq(algorithm)
 
@@ -253,33 +362,86 @@ class TB(Module):
     def set_im_h(self, rows):
         return self.wrapper.demo_im_ctl.fields.rows.eq(rows)
 
+    def set_im_size(self, cols, rows):
+        yield from self.wrapper.demo_im_ctl.write(cols | rows << 13)
+
     def set_pattern(self, pattern):
         return self.wrapper.demo_ctl.fields.pattern.eq(pattern)
 
+    def set_white_balance(self, black, gains):
+        yield self.wrapper.wb.black.storage.eq(black)
+        yield self.wrapper.wb.gains.storage.eq(sum(g << 16*i for i, g in enumerate(gains)))
+
+    # matrix rows and offsets of red, green and blue
+    def set_color_correction(self, matrix, offsets):
+        ccm = self.wrapper.ccm
+        for row, csr in zip(matrix, [ccm.red, ccm.green, ccm.blue]):
+            yield csr.storage.eq(sum((c & 0xffff) << 16*i for i, c in enumerate(row)))
+        yield ccm.offsets.storage.eq(sum((o & 0xffff) << 16*i for i, o in enumerate(offsets)))
+
+    def set_defect_correction(self, threshold):
+        yield from self.wrapper.dpc_ctl.write(1 | threshold << 1)
+
+    # scaling mode, output width and height, and the bilinear steps
+    def set_scaler(self, mode, size, step):
+        scaler = self.wrapper.scaler
+        yield from scaler.ctl.write(mode)
+        yield from scaler.size.write(size[0] | size[1] << 13)
+        yield from scaler.step.write(step[0] | step[1] << 16)
+
+    def set_crop(self, offset, size):
+        crop = self.wrapper.crop
+        yield from crop.offset.write(offset[0] | offset[1] << 13)
+        yield from crop.size.write(size[0] | size[1] << 13)
+        yield from crop.ctl.write(1)
+
+    def set_stats_zones(self, width, height):
+        yield from self.wrapper.stats.zones.write(width | height << 13)
+
+    # upload the tables of red, green and blue and use them from the next frame
+    def upload_gamma(self, luts):
+        gamma = self.wrapper.gamma
+        for channel, lut in enumerate(luts):
+            yield from gamma.adr.write(channel << len(gamma.adr.fields.index))
+            for value in lut:
+                yield from gamma.data.write(value)
+        yield from gamma.ctl.write(0b11)
+
+    def get_size_error(self):
+        return self.wrapper.ev.size_error.status
+
     def get_algorithm(self):
         return (self.wrapper.demo_ctl.fields.algorithm)
 
     def get_busy(self):
         return (self.wrapper.demo_ctl.fields.busy)
 
-def main_generator(dut, ims, algorithm, image=False, irqs=[]):
+def main_generator(dut, ims, algorithm, image=False, irqs=[], wait_busy=True):
     if irqs == []:
        irqs = [0 for _ in range(len(ims))]
        breaked = False
     for c, pack in enumerate(zip(ims, irqs)):
         im = pack[0]
         irq = pack[1]
-        im["data"] = get_img_data(algorithm) if not image else load_image()
+        if image:
+            im["data"] = load_image()
+        elif not im["data"]:
+            im["data"] = get_img_data(algorithm)
         yield dut.raw.last.eq(~irq)
-        if irq:
-            yield from dut.enable_irq()
-        else:
-            yield from dut.disable_irq()
-        while (yield dut.get_busy()) and not breaked:
-            yield
-        breaked = False
-        yield dut.set_pattern(im["pattern"])
-        size = im["width"]*im["height"]/4
+        # frames sent back to back keep the configuration of the first one,
+        # the CSR writes would stall the stream between the frames
+        if wait_busy or c == 0:
+            if irq:
+                yield from dut.enable_irq()
+            else:
+                yield from dut.disable_irq()
+            # a demosaicer with the output ready is busy waiting for the first frame,
+            # a cropped frame may be decoded before all of its lines are sent
+            while wait_busy and c > 0 and (yield dut.get_busy()) and not breaked and dut.frames_received < c:
+                yield
+            breaked = False
+            yield dut.set_pattern(im["pattern"])
+        size = im["width"]*im["height"]/dut.pixels_per_word
         i = 0
         while i < size:
             val = im["data"][i]
@@ -301,9 +463,11 @@ def main_generator(dut, ims, algorithm, image=False, irqs=[]):
                     break
             i+=1
 
-        yield dut.raw.valid.eq(0)
-        yield dut.raw.last.eq(0)
-        yield
+        # next frame starts right after the last word of this one
+        if wait_busy or c == len(ims)-1:
+            yield dut.raw.valid.eq(0)
+            yield dut.raw.last.eq(0)
+            yield
         while dut.error_occured != 0:
             yield;
         print("Gnerator DONE {}/{}".format(c+1, len(ims)))
@@ -314,10 +478,10 @@ def rec_save(dut, to_rec, rec_times=1):
     yield dut.rgb.ready.eq(1)
     yield
     for c in range(rec_times):
-        for i in range(int(to_rec)):
+        for i in range(int(to_rec/dut.ppc)):
             while(yield dut.rgb.valid == 0):
                 yield
-            data.append((yield dut.rgb.data))
+            data.extend(dut.get_pixels((yield dut.rgb.data)))
             yield
 
         with open("deb{}.rgb".format(c), "wb") as f:
@@ -335,17 +499,18 @@ def rec_compare(dut, to_rec, algorithm, ims, rec_times=1):
     data = []
     yield dut.rgb.ready.eq(1)
     for c in range(rec_times):
-        for i in range(int(to_rec)):
+        for i in range(int(to_rec/dut.pixels_per_beat)):
             while(yield dut.rgb.valid == 0):
                 yield
-            data.append((yield dut.rgb.data))
+            data.extend(dut.get_pixels((yield dut.rgb.data)))
             yield
         chunks.append(data)
         data = []
+        dut.frames_received += 1
         print("Receiver DONE {}/{}".format(c+1, rec_times))
         #each chunk has to be same
         for chunk, im in zip(chunks, ims):
-            good_res = get_result(algorithm, im["pattern"])
+            good_res = im["result"] if "result" in im else get_result(algorithm, im["pattern"])
             if good_res != chunk:
                 print("Chunks differ")
                 for i in range(len(good_res)):
@@ -359,10 +524,10 @@ def rec_compare_irq(dut, to_rec, algorithm, ims, irqs):
     data = []
     for c in range(len(irqs)):
         yield dut.rgb.ready.eq(1)
-        for i in range(int(to_rec)):
+        for i in range(int(to_rec/dut.ppc)):
             while(yield dut.rgb.valid == 0) and not dut.error_occured:
                 yield
-            data.append((yield dut.rgb.data))
+            data.extend(dut.get_pixels((yield dut.rgb.data)))
             yield
             if dut.error_occured:
                 dut.error_occured=0
@@ -435,10 +600,10 @@ def rec_shuffle(dut, algs):
         im = get_img_description(algorithm)
         to_rec = im["width"]*im["height"]
 
-        for i in range(int(to_rec)):
+        for i in range(int(to_rec/dut.ppc)):
             while(yield dut.rgb.valid == 0):
                 yield
-            data.append((yield dut.rgb.data))
+            data.extend(dut.get_pixels((yield dut.rgb.data)))
             yield
         print("Receiver DONE {}/{}".format(n+1, len(algs)))
 
@@ -450,6 +615,79 @@ def rec_shuffle(dut, algs):
         data = []
 
 
+def check_perf(dut, im, frames):
+    perf = dut.wrapper.perf
+    while (yield perf.frames.status) < frames:
+        yield
+    in_words = yield perf.in_words.status
+    lines = yield perf.lines.status
+    frame_cycles = yield perf.frame_cycles.status
+    dropped = yield perf.dropped.status
+    print("in_words {} in_stalls {} out_stalls {} frame_cycles {} lines {}".format(in_words,
+        (yield perf.in_stalls.status), (yield perf.out_stalls.status), frame_cycles, lines))
+    words = im["width"]*im["height"]//dut.ppc
+    if in_words != words or lines != im["height"] or frame_cycles < words or dropped != 0:
+        print("Performance counters differ")
+        exit(1)
+    print("Perf DONE")
+
+
+# reads the statistics after the given frames and compares them with the histograms and zone sums
+def check_stats(dut, expected, frames):
+    stats = dut.wrapper.stats
+    done = 0
+    while done < frames:
+        done += (yield stats.ev.done.trigger)
+        yield
+    hist, sums = expected
+    offsets = {f.name: f.offset for f in stats.adr.fields.fields}
+    def read(**fields):
+        yield from stats.adr.write(sum(v << offsets[k] for k, v in fields.items()))
+        # ready drops a cycle after the write, as a bus read comes
+        yield
+        while not (yield stats.status.fields.ready):
+            yield
+    for channel, counts in enumerate(hist):
+        for i, count in enumerate(counts):
+            yield from read(bin=i, channel=channel)
+            if (yield stats.hist.status) != count:
+                print("Histogram {} differs at bin {}: {} != {}".format(channel, i, (yield stats.hist.status), count))
+                exit(1)
+    for zone, colors in enumerate(sums):
+        yield from read(zone=zone)
+        res = []
+        for c in "rgb":
+            res.append((yield getattr(stats.zone.fields, c)))
+        if res != list(colors):
+            print("Zone {} differs: {} != {}".format(zone, res, list(colors)))
+            exit(1)
+    print("Stats DONE")
+
+
+# a frame larger than the line buffers is refused, its input stalled with size_error set
+# and nothing decoded, the frames sent after the size is fixed are decoded whole
+def generator_size_error(dut, ims, algorithm, cycles=100):
+    im = ims[0]
+    yield from dut.set_im_size(im["width"]+2, im["height"]+2)
+    yield dut.raw.data.eq(0)
+    yield dut.raw.valid.eq(1)
+    yield dut.raw.first.eq(1)
+    for _ in range(cycles):
+        yield
+        if (yield dut.raw.ready) or (yield dut.rgb.valid) or not (yield dut.get_size_error()):
+            print("Oversized frame not refused")
+            exit(1)
+    yield dut.raw.valid.eq(0)
+    yield dut.raw.first.eq(0)
+    yield from dut.set_im_size(im["width"], im["height"])
+    yield
+    if (yield dut.get_size_error()):
+        print("size_error kept after the size is fixed")
+        exit(1)
+    print("Size error DONE")
+    yield from main_generator(dut, ims, algorithm)
+
+
 def generator_with_im_break(dut, ims, algorithm, image=False, bim=[]):
     if bim == []:
        bim = [-1 for _ in range(len(ims))]
@@ -463,7 +701,7 @@ def generator_with_im_break(dut, ims, algorithm, image=False, bim=[]):
             yield
         breaked = False
         yield dut.set_pattern(im["pattern"])
-        size = im["width"]*im["height"]/4
+        size = im["width"]*im["height"]/dut.pixels_per_word
         i = 0
         while i < size:
             val = im["data"][i]
@@ -494,14 +732,18 @@ def rec_compare_im_b(dut, to_rec, algorithm, ims, bim):
     data = []
     for c in range(len(bim)):
         yield dut.rgb.ready.eq(1)
-        for i in range(int(to_rec)):
+        for i in range(int(to_rec/dut.ppc)):
             while (yield dut.rgb.valid == 0) and not dut.error_occured:
                 yield
-            data.append((yield dut.rgb.data))
+            data.extend(dut.get_pixels((yield dut.rgb.data)))
             yield
             if dut.error_occured:
                 dut.error_occured=0
                 data=[]
+                # with a pipelined decoder pixels of the broken frame may still
+                # come out, the next frame starts after its first word is sent
+                while not (yield dut.raw.first):
+                    yield
                 while not (yield dut.rgb.first) or (yield dut.raw.first):
                     yield
                 yield dut.rgb.ready.eq(0)
@@ -534,12 +776,37 @@ def rec_compare_im_b(dut, to_rec, algorithm, ims, bim):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="LiteX SoC on Zybo Z7")
-    parser.add_argument("--algorithm", help="one of Nearest, Bilinear, Edge")
+    parser.add_argument("--algorithm", help="one of Nearest, Bilinear, Edge, Malvar")
     parser.add_argument("--shuffle", action="store_true", help="test force algorihtm switch")
     parser.add_argument("--test_patterns", action="store_true", help="test all algorithms with avaliable patterns")
     parser.add_argument("--image", action="store_true", help="debayer real image")
     parser.add_argument("--irqs", action="store_true", help="debayer with irq enabled, simulate error")
     parser.add_argument("--imb", action="store_true", help="test unexpected image height")
+    parser.add_argument("--back_to_back", action="store_true", help="send frames without waiting for the demosaicer")
+    parser.add_argument("--ppc", type=int, default=1, help="pixels processed per clock: 1, 2 or 4")
+    parser.add_argument("--sync_read", action="store_true", help="use line buffers with synchronous read")
+    parser.add_argument("--pack", type=int, default=None, help="pixels stored in a line buffer word: 1, 2 or 4, a multiple of ppc")
+    parser.add_argument("--rotate", action="store_true", help="decode with a rotating line index instead of per line buffer states")
+    parser.add_argument("--pipeline", type=int, default=0, help="register stages of the decode adder trees")
+    parser.add_argument("--max_size", action="store_true", help="size the line buffers for the test image only")
+    parser.add_argument("--size_error", action="store_true", help="send a frame above the maximum size, then frames of the test image")
+    parser.add_argument("--single", action="store_true", help="build only the tested demosaicer")
+    parser.add_argument("--perf", action="store_true", help="check the performance counters")
+    parser.add_argument("--random", metavar="WxH", help="decode random images of given size and compare them with the reference model")
+    parser.add_argument("--bpp", type=int, default=8, help="raw pixel depth of the random images")
+    parser.add_argument("--out_bpp", type=int, default=None, help="output color depth of the random images")
+    parser.add_argument("--packing", default="NONE", choices=[p.name for p in Packing_t], help="MIPI packing of the random images")
+    parser.add_argument("--out_width", type=int, default=None, help="output word width of the formatter for the random images: 32, 64 or 128")
+    parser.add_argument("--format", default="XRGB", choices=[f.name for f in Format_t], help="output format of the random images")
+    parser.add_argument("--matrix", default="BT601", choices=[m.name for m in Matrix_t], help="YUV conversion matrix of the random images")
+    parser.add_argument("--wb", action="store_true", help="apply random black level and white balance gains to the random images")
+    parser.add_argument("--dpc", action="store_true", help="add hot and dead pixels to the random images and correct them")
+    parser.add_argument("--stats", action="store_true", help="check the statistics of the last random image")
+    parser.add_argument("--ccm", action="store_true", help="apply a random color correction matrix to the random images")
+    parser.add_argument("--gamma", action="store_true", help="apply random lookup tables to the random images")
+    parser.add_argument("--crop", action="store_true", help="decode a random region of the random images")
+    parser.add_argument("--reset_width", type=int, help="build for random images of the given width and set the image size CSR to theirs")
+    parser.add_argument("--scale", choices=["bilinear", "bin2", "bin4"], help="downscale the random images, bilinear to a random size")
     args = parser.parse_args()
     algorithm = None
 
@@ -550,9 +817,12 @@ if __name__ == "__main__":
             algorithm=Demosaic_t.BILINEAR
         elif args.algorithm == "Edge":
             algorithm=Demosaic_t.EDGE_DIRECTED
+        elif args.algorithm == "Malvar":
+            algorithm=Demosaic_t.MALVAR
         else:
             raise ValueError
 
+    algorithms = [algorithm] if args.single and algorithm else None
     tb = None
     generators = []
     if args.image:
@@ -563,7 +833,7 @@ if __name__ == "__main__":
             "pattern" : Bayer_t.RGGB,
             "data"    : []
         }
-        tb = TB(im, algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack)
         ims = [im]
         generators = [
             main_generator(tb, ims, algorithm, image=True),
@@ -573,11 +843,12 @@ if __name__ == "__main__":
         algs = [Demosaic_t.NEAREST,
                 Demosaic_t.EDGE_DIRECTED,
                 Demosaic_t.BILINEAR,
+                Demosaic_t.MALVAR,
                 Demosaic_t.NEAREST,
                 Demosaic_t.EDGE_DIRECTED]
         algorithm = algs[0]
         im = get_img_description(algorithm)
-        tb = TB(im, algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack)
         generators = [
             generator_shuffle(tb, algs),
             rec_shuffle(tb, algs)
@@ -590,7 +861,7 @@ if __name__ == "__main__":
         rgbg["pattern"] = Bayer_t.RGBG
         grgb = copy.deepcopy(rggb)
         grgb["pattern"] = Bayer_t.GRGB
-        tb = TB(rggb, algorithm)
+        tb = TB(rggb, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack)
         ims = [rggb, bggr, rgbg, grgb]
         generators = [
             main_generator(tb, ims, algorithm),
@@ -598,16 +869,163 @@ if __name__ == "__main__":
         ]
     elif args.irqs and args.algorithm:
         im = get_img_description(algorithm)
-        tb = TB(im, algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack)
         irqs = [  1,  0,  0,  1,  0, 1, 0, 1, 1, 1, 0, 0, 0]
         ims  = [ im, im, im, im, im, im, im, im, im, im, im, im ,im]
         generators = [
             main_generator(tb, ims, algorithm, irqs=irqs),
             rec_compare_irq(tb, im["width"]*im["height"], algorithm, ims, irqs)
         ]
+    elif args.back_to_back and args.algorithm:
+        im = get_img_description(algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack)
+        ims = [im, im, im, im]
+        generators = [
+            main_generator(tb, ims, algorithm, wait_busy=False),
+            rec_compare(tb, im["width"]*im["height"], algorithm, ims, len(ims))
+        ]
+    elif args.random and args.algorithm:
+        import random
+        import numpy as np
+        from fpga_isp.debayer.model import (demosaic, to_words, pack, format_words, white_balance, gamma,
+                                            color_correction, statistics, defect_correction, scale, crop_window)
+        width, height = map(int, args.random.split("x"))
+        packing = Packing_t[args.packing]
+        # black level and gains of R, G0, G1 and B, the same for all images
+        black = random.randrange(2**args.bpp//8)
+        gains = [random.randrange(0x80, 0x200) for _ in range(4)]
+        # random tone curves of red, green and blue
+        out_bpp = args.out_bpp or args.bpp
+        luts = [[random.randrange(2**out_bpp) for _ in range(2**out_bpp)] for _ in range(3)]
+        # color correction around unity with negative terms, and small offsets
+        ccm = [[random.randrange(-0x200, 0x200) + (0x500 if i == k else 0) for i in range(3)] for k in range(3)]
+        offsets = [random.randrange(-2**out_bpp//8, 2**out_bpp//8) for _ in range(3)]
+        # zones of a few pixels, some of the grid outside of the images
+        zone_size = (args.ppc*random.randint(1, 2), random.randint(1, 2))
+        # hot and dead pixels of the sensor
+        threshold = random.randrange(2**args.bpp//16, 2**args.bpp//4)
+        def add_defects(raw, bits):
+            defects = np.random.randint(0, 32, raw.shape)
+            return np.where(defects == 0, 2**bits-1, np.where(defects == 1, 0, raw))
+        # region of the images, the offsets keep the Bayer phase, the width whole beats
+        x_align = max(2, args.ppc)
+        x = x_align*random.randint(0, (width-args.ppc)//x_align)
+        y = 2*random.randint(0, (height-1)//2)
+        region = ((x, y), (args.ppc*random.randint(1, (width-x)//args.ppc), random.randint(1, height-y)))
+        window, roi = crop_window((height, width), *region, args.ppc)
+        out_w, out_h = region[1] if args.crop else (width, height)
+        # output size and bilinear steps, the last pixel and line taken within the images,
+        # the formatter takes whole beats, without it the lines are padded to whole beats with zeros
+        scale_mode = ["bilinear", "bin2", "bin4"].index(args.scale) if args.scale else 0
+        align = args.ppc if args.out_width else 1
+        if scale_mode:
+            n = 2*scale_mode
+            out_size = ((out_w//n)//align*align, out_h//n)
+            steps = (0x1000, 0x1000)
+            if not all(out_size):
+                parser.error("{} needs images of at least {} lines of {} pixels".format(args.scale, n, n*align))
+        else:
+            out_size = (align*random.randint(1, out_w//align), random.randint(1, out_h))
+            steps = tuple(random.randint(0x1000, min(((size-1) << 12)//(out-1), 0xffff)) if out > 1 else 0x1000
+                          for size, out in zip((out_w, out_h), out_size))
+        ims = []
+        for pattern in Bayer_t:
+            if packing == Packing_t.NONE:
+                raw = np.array([random.randrange(2**args.bpp) for _ in range(width*height)]).reshape(height, width)
+                if args.dpc:
+                    raw = add_defects(raw, args.bpp)
+                data = raw.astype(">u1" if args.bpp <= 8 else ">u2").reshape(-1).view(">u4")
+            else:
+                # packed pixels are aligned to the MSBs of bpp bits
+                bits = MipiUnpacker.formats[packing][0]
+                packed = np.array([random.randrange(2**bits) for _ in range(width*height)]).reshape(height, width)
+                if args.dpc:
+                    packed = add_defects(packed, bits)
+                data = pack(packed, packing).view(">u4")
+                raw = packed << args.bpp-bits if bits <= args.bpp else packed >> bits-args.bpp
+            ims.append({
+                "name"    : "random",
+                "width"   : width,
+                "height"  : height,
+                "pattern" : pattern,
+                "data"    : [int(w) for w in data],
+            })
+            if args.crop:
+                raw = raw[window]
+            if args.wb:
+                raw = white_balance(raw, pattern, black, gains, args.bpp)
+            if args.dpc:
+                raw = defect_correction(raw, threshold, args.bpp)
+            rgb = demosaic(raw, algorithm, pattern, args.bpp, args.out_bpp)
+            if args.crop:
+                rgb = rgb[roi]
+            # the statistics are taken ahead of the color correction
+            ims[-1]["stats"] = statistics(rgb, out_bpp, zone_size=zone_size)
+            if args.ccm:
+                rgb = color_correction(rgb, ccm, offsets, out_bpp)
+            if args.gamma:
+                rgb = gamma(rgb, luts)
+            if args.scale:
+                rgb = scale(rgb, scale_mode, out_size, steps, out_bpp)
+                if not args.out_width:
+                    rgb = np.pad(rgb, ((0, 0), (0, -out_size[0] % args.ppc), (0, 0)))
+            if args.out_width:
+                ims[-1]["result"] = format_words(rgb, Format_t[args.format], args.out_width, args.out_bpp or args.bpp,
+                                                 matrix=Matrix_t[args.matrix])
+            else:
+                ims[-1]["result"] = [int(p) for p in to_words(rgb, args.out_bpp or args.bpp)]
+        # the image size CSR may be set wider than its reset value
+        built = ims[0]
+        if args.reset_width:
+            built = dict(ims[0], width=args.reset_width)
+        tb = TB(built, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack, bpp=args.bpp, out_bpp=args.out_bpp,
+                packing=packing, out_width=args.out_width, out_format=Format_t[args.format],
+                csc=Format_t[args.format] in RGB2YUV.yuv_formats, matrix=Matrix_t[args.matrix], white_balance=args.wb, gamma=args.gamma, ccm=args.ccm, stats=args.stats, dpc=args.dpc,
+                scaler=args.scale is not None, crop=args.crop)
+        def generator():
+            if args.reset_width:
+                yield from tb.set_im_size(width, height)
+            if args.gamma:
+                yield from tb.upload_gamma(luts)
+            # the region is set ahead of the frames, as the image size
+            if args.crop:
+                yield from tb.set_crop(*region)
+            yield from main_generator(tb, ims, algorithm)
+        generators = [
+            generator(),
+            rec_compare(tb, len(ims[0]["result"]), algorithm, ims, len(ims))
+        ]
+        if args.wb:
+            generators.append(tb.set_white_balance(black, gains))
+        if args.ccm:
+            generators.append(tb.set_color_correction(ccm, offsets))
+        if args.dpc:
+            generators.append(tb.set_defect_correction(threshold))
+        if args.scale:
+            generators.append(tb.set_scaler(scale_mode, out_size, steps))
+        if args.stats:
+            generators += [tb.set_stats_zones(*zone_size), check_stats(tb, ims[-1]["stats"], len(ims))]
+    elif args.perf and args.algorithm:
+        im = get_img_description(algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack, perf_counters=True)
+        ims = [im, im]
+        generators = [
+            main_generator(tb, ims, algorithm),
+            rec_compare(tb, im["width"]*im["height"], algorithm, ims, len(ims)),
+            check_perf(tb, im, len(ims))
+        ]
+    elif args.size_error and args.algorithm:
+        im = get_img_description(algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack,
+                max_width=im["width"], max_height=im["height"])
+        ims = [im, im]
+        generators = [
+            generator_size_error(tb, ims, algorithm),
+            rec_compare(tb, im["width"]*im["height"], algorithm, ims, len(ims))
+        ]
     elif args.imb and args.algorithm:
         im = get_img_description(algorithm)
-        tb = TB(im, algorithm)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack)
         break_im_line= [4, im["height"]*im["width"]/TB.AXI_W, 2, im["height"]*im["width"]/TB.AXI_W]
         ims  = [im, im, im, im]
         generators = [
@@ -616,7 +1034,10 @@ if __name__ == "__main__":
         ]
     else:
         im = get_img_description(algorithm)
-        tb = TB(im, algorithm)
+        # line buffers of the test image width instead of the widest image of the CSR
+        max_size = (im["width"], im["height"]) if args.max_size else (None, None)
+        tb = TB(im, algorithm, args.ppc, args.sync_read, args.rotate, args.pipeline, algorithms, pack=args.pack,
+                max_width=max_size[0], max_height=max_size[1])
         ims = [im, im]
         generators = [
             main_generator(tb, ims, algorithm),
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+from migen import *
+from migen.fhdl import verilog
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.wrapper import *
+from fpga_isp.debayer.common import *
+from fpga_isp.debayer.model import demosaic, to_words, pack, format_words
+
+algorithms = {
+    "Nearest"  : Demosaic_t.NEAREST,
+    "Bilinear" : Demosaic_t.BILINEAR,
+    "Edge"     : Demosaic_t.EDGE_DIRECTED,
+    "Malvar"   : Demosaic_t.MALVAR,
+}
+
+# DemosaicWrapper with plain top level ports, configured by the CSR reset values,
+# every output pixel gets its own port, formatted output words are split into 32-bit ports
+class Top(Module):
+    def __init__(self, algorithm, width, height, pattern, ppc=1, bpp=8, out_bpp=None, packing=Packing_t.NONE,
+                 out_width=None, out_format=Format_t.XRGB, matrix=Matrix_t.BT601, **kw):
+        self.pix_width = pix_width = DemosaicWrapper.pixel_width(bpp if out_bpp is None else out_bpp)
+        data_width = pix_width*ppc
+        if out_width is not None:
+            self.pix_width = pix_width = 32
+            data_width = out_width
+        self.ports = ports = data_width//pix_width
+        self.raw_data = Signal(32, name="raw_data")
+        self.raw_valid = Signal(name="raw_valid")
+        self.raw_ready = Signal(name="raw_ready")
+        self.raw_first = Signal(name="raw_first")
+        self.raw_last = Signal(name="raw_last")
+        self.rgb_data = [Signal(pix_width, name="rgb_data{}".format(i)) for i in range(ports)]
+        self.rgb_valid = Signal(name="rgb_valid")
+        self.rgb_ready = Signal(name="rgb_ready")
+        self.busy = Signal(name="busy")
+
+        raw = stream.Endpoint([("data", 32)])
+        rgb = stream.Endpoint([("data", data_width)])
+        self.submodules.wrapper = DemosaicWrapper(algorithm, raw, rgb, width, height, pattern,
+                                                  in_reverse=True, ppc=ppc, algorithms=[algorithm],
+                                                  bpp=bpp, out_bpp=out_bpp, unpacker=packing != Packing_t.NONE,
+                                                  packing=packing, out_width=out_width, out_format=out_format,
+                                                  csc=out_format in RGB2YUV.yuv_formats, matrix=matrix, **kw)
+        self.comb += [
+            raw.data.eq(self.raw_data),
+            raw.valid.eq(self.raw_valid),
+            self.raw_ready.eq(raw.ready),
+            raw.first.eq(self.raw_first),
+            raw.last.eq(self.raw_last),
+            [d.eq(rgb.data[pix_width*i:pix_width*(i+1)]) for i, d in enumerate(self.rgb_data)],
+            self.rgb_valid.eq(rgb.valid),
+            rgb.ready.eq(self.rgb_ready),
+            self.busy.eq(self.wrapper.busy),
+        ]
+
+    def ios(self):
+        return {self.raw_data, self.raw_valid, self.raw_ready, self.raw_first, self.raw_last,
+                *self.rgb_data, self.rgb_valid, self.rgb_ready, self.busy}
+
+# streams the input words from a file, frames back to back, and writes
+# the output pixels to a file, valid and ready are random with given probabilities
+harness = """
+#include <cstdio>
+#include <cstdlib>
+#include <cstdint>
+#include <vector>
+#include "Vtop.h"
+#include "verilated.h"
+
+int main(int argc, char **argv) {{
+    Verilated::commandArgs(argc, argv);
+    FILE *fin = fopen(argv[1], "rb");
+    FILE *fout = fopen(argv[2], "wb");
+    long frame_words = atol(argv[3]);
+    long out_words = atol(argv[4]);
+    int valid_prob = atoi(argv[5]);
+    int ready_prob = atoi(argv[6]);
+    srand(atoi(argv[7]));
+    long timeout = 100000;
+
+    std::vector<uint32_t> words;
+    uint32_t w;
+    while (fread(&w, sizeof(w), 1, fin) == 1)
+        words.push_back(w);
+    fclose(fin);
+
+    Vtop *top = new Vtop;
+    top->sys_rst = 1;
+    for (int i = 0; i < 4; i++) {{
+        top->sys_clk = 0; top->eval();
+        top->sys_clk = 1; top->eval();
+    }}
+    top->sys_rst = 0;
+    top->raw_last = 1;
+
+    size_t i = 0;
+    long received = 0, cycles = 0, idle = 0;
+    while (received < out_words && idle < timeout) {{
+        top->raw_valid = i < words.size() && rand() % 100 < valid_prob;
+        top->raw_data = i < words.size() ? words[i] : 0;
+        top->raw_first = i % frame_words == 0;
+        top->rgb_ready = rand() % 100 < ready_prob;
+        top->sys_clk = 0; top->eval();
+        bool in_fire = top->raw_valid && top->raw_ready;
+        bool out_fire = top->rgb_valid && top->rgb_ready;
+        if (out_fire) {{
+            uint{width}_t pixels[] = {{{pixels}}};
+            fwrite(pixels, sizeof(pixels[0]), {ports}, fout);
+            received++;
+            idle = 0;
+        }} else {{
+            idle++;
+        }}
+        top->sys_clk = 1; top->eval();
+        if (in_fire)
+            i++;
+        cycles++;
+    }}
+    fclose(fout);
+    printf("cycles %ld\\n", cycles);
+    top->final();
+    delete top;
+    return received < out_words;
+}}
+"""
+
+def build(top, build_dir):
+    os.makedirs(build_dir, exist_ok=True)
+    verilog.convert(top, ios=top.ios(), name="top").write(os.path.join(build_dir, "top.v"))
+    with open(os.path.join(build_dir, "harness.cpp"), "w") as f:
+        f.write(harness.format(ports=top.ports, width=top.pix_width,
+                               pixels=", ".join("top->rgb_data{}".format(i) for i in range(top.ports))))
+    subprocess.check_call(["verilator", "--cc", "top.v", "--top-module", "top", "--exe", "harness.cpp",
+                           "-Wno-fatal", "-O3", "-CFLAGS", "-O2", "-Mdir", "obj"], cwd=build_dir)
+    subprocess.check_call(["make", "-j", str(os.cpu_count() or 1), "-C", "obj", "-f", "Vtop.mk"], cwd=build_dir,
+                          stdout=subprocess.DEVNULL)
+    return os.path.join(build_dir, "obj", "Vtop")
+
+def load_frames(args, width, height):
+    dtype = np.uint8 if args.bpp <= 8 else np.uint16
+    if args.image:
+        raw = np.fromfile(args.image, dtype=dtype)[:width*height].reshape(height, width)
+        return [raw & (2**args.bpp-1)]*args.frames
+    rnd = np.random.RandomState(args.seed)
+    return [rnd.randint(0, 2**args.bpp, (height, width)).astype(dtype) for _ in range(args.frames)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Demosaicer co-simulation with Verilator")
+    parser.add_argument("--algorithm", default="Bilinear", choices=list(algorithms))
+    parser.add_argument("--pattern", default="RGGB", choices=[p.name for p in Bayer_t])
+    parser.add_argument("--size", default="1920x1080", help="image size, WIDTHxHEIGHT")
+    parser.add_argument("--frames", type=int, default=2, help="frames sent back to back")
+    parser.add_argument("--image", help="raw image file used for every frame instead of random data, 16-bit pixels above 8 bpp")
+    parser.add_argument("--bpp", type=int, default=8, help="raw pixel depth")
+    parser.add_argument("--out_bpp", type=int, default=None, help="output color depth")
+    parser.add_argument("--packing", default="NONE", choices=[p.name for p in Packing_t], help="send the frames MIPI packed")
+    parser.add_argument("--out_width", type=int, default=None, help="output word width of the formatter: 32, 64 or 128")
+    parser.add_argument("--format", default="XRGB", choices=[f.name for f in Format_t], help="output format of the formatter")
+    parser.add_argument("--matrix", default="BT601", choices=[m.name for m in Matrix_t], help="YUV conversion matrix")
+    parser.add_argument("--ppc", type=int, default=1, help="pixels processed per clock: 1, 2 or 4")
+    parser.add_argument("--sync_read", action="store_true", help="use line buffers with synchronous read")
+    parser.add_argument("--rotate", action="store_true", help="decode with a rotating line index")
+    parser.add_argument("--pipeline", type=int, default=0, help="register stages of the decode adder trees")
+    parser.add_argument("--valid_prob", type=int, default=100, help="input valid probability in percent")
+    parser.add_argument("--ready_prob", type=int, default=100, help="output ready probability in percent")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--build_dir", default="build_verilator")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split("x"))
+    algorithm = algorithms[args.algorithm]
+    pattern = Bayer_t[args.pattern]
+    packing = Packing_t[args.packing]
+    out_format = Format_t[args.format]
+    matrix = Matrix_t[args.matrix]
+    top = Top(algorithm, width, height, pattern, args.ppc, args.bpp, args.out_bpp, packing, args.out_width, out_format, matrix,
+              sync_read=args.sync_read, rotate=args.rotate, pipeline=args.pipeline)
+    out_bpp = args.out_bpp or args.bpp
+    sim = build(top, args.build_dir)
+
+    frames = load_frames(args, width, height)
+    if packing == Packing_t.NONE:
+        words = np.concatenate([raw.astype(">u1" if args.bpp <= 8 else ">u2").reshape(-1).view(">u4")
+                                for raw in frames]).astype(np.uint32)
+    else:
+        # the packed pixels are the MSBs of the frames
+        bits = MipiUnpacker.formats[packing][0]
+        if bits > args.bpp:
+            parser.error("{} needs --bpp {} or more".format(packing.name, bits))
+        words = np.concatenate([pack(raw >> args.bpp-bits, packing).view(">u4") for raw in frames]).astype(np.uint32)
+        frames = [raw >> args.bpp-bits << args.bpp-bits for raw in frames]
+    inp = os.path.join(args.build_dir, "input.bin")
+    out = os.path.join(args.build_dir, "output.bin")
+    # expected output of every frame, formatted words as the values of their 32-bit ports
+    expected = []
+    for raw in frames:
+        rgb = demosaic(raw, algorithm, pattern, args.bpp, out_bpp)
+        if args.out_width:
+            words32 = [(w >> 32*k) & 0xffffffff for w in format_words(rgb, out_format, args.out_width, out_bpp, matrix=matrix)
+                       for k in range(top.ports)]
+            expected.append(np.array(words32, dtype=np.uint32))
+        else:
+            expected.append(to_words(rgb, out_bpp))
+
+    words.tofile(inp)
+    start = time.time()
+    subprocess.check_call([sim, inp, out, str(len(words)//len(frames)), str(sum(map(len, expected))//top.ports),
+                           str(args.valid_prob), str(args.ready_prob), str(args.seed)])
+    print("simulated {} frames in {:.1f}s".format(len(frames), time.time()-start))
+
+    pixels = np.fromfile(out, dtype=np.uint32 if top.pix_width == 32 else np.uint64)
+    if not args.out_width:
+        pixels &= 2**(3*out_bpp)-1
+    offset = 0
+    for f, good in enumerate(expected):
+        res = pixels[offset:offset+len(good)]
+        offset += len(good)
+        if len(res) != len(good) or (res != good).any():
+            bad = np.flatnonzero(res != good[:len(res)])
+            print("Frame {} differs at {} pixels, first at {}".format(f, len(bad), bad[:1]))
+            sys.exit(1)
+        print("Frame {} DONE".format(f))
@@ -0,0 +1,98 @@
+from migen import *
+
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class MipiUnpacker(Module):
+    # pixel depth and bytes of a group of 4 pixels of each packing
+    formats = {
+        Packing_t.RAW10: (10, 5),
+        Packing_t.RAW12: (12, 6),
+    }
+
+    # 4 pixels of a group of bytes, the high bits of the pixels come in their own bytes
+    # followed by a byte with the low bits of 4 (RAW10) or 2 (RAW12) pixels
+    @staticmethod
+    def group_pixels(packing, data):
+        b = [data[8*i:8*(i+1)] for i in range(len(data)//8)]
+        if packing == Packing_t.RAW10:
+            return [Cat(b[4][2*i:2*(i+1)], b[i]) for i in range(4)]
+        return [Cat(b[3*(i//2)+2][4*(i%2):4*(i%2+1)], b[3*(i//2)+i%2]) for i in range(4)]
+
+    # unpacks the MIPI packed stream of width bit words into ppc pixels of bpp bits,
+    # the packed pixels are aligned to the MSBs of the bpp bits
+    # words are split into bytes by a gearbox buffer, every cycle it can give out a group
+    # of 4 pixels and take in a word when it fits next to the bytes left, which is more
+    # than the byte rate needed by ppc <= 2 pixels per clock
+    def __init__(self, packing, bpp, ppc=1, width=32, reverse=False):
+        self.sink = sink = stream.Endpoint([("data", width)])
+        self.source = source = stream.Endpoint([("data", bpp*ppc)])
+
+        nbytes = width//8
+        depth = 3*nbytes
+        buf = Signal(8*depth)
+        level = Signal(max=depth+1)
+        first = Signal()
+        # in reversed mode the first byte of a word is in its MSBs
+        word_bytes = [sink.data[8*i:8*(i+1)] for i in range(nbytes)]
+        if reverse:
+            word_bytes.reverse()
+        word = Cat(*word_bytes)
+
+        groups = stream.Endpoint([("data", 4*bpp)])
+        self.submodules.converter = converter = stream.Converter(4*bpp, bpp*ppc)
+        self.comb += [
+            groups.connect(converter.sink),
+            converter.source.connect(source),
+        ]
+
+        # bytes of a group of the selected packing, NONE takes no bytes
+        group = Signal(max=depth+1)
+        cases = {}
+        for fmt, (pix_bits, group_bytes) in self.formats.items():
+            pixels = self.group_pixels(fmt, buf[:8*group_bytes])
+            if pix_bits < bpp:
+                pixels = [Cat(C(0, bpp-pix_bits), p) for p in pixels]
+            else:
+                pixels = [p[pix_bits-bpp:] for p in pixels]
+            cases[fmt] = [group.eq(group_bytes), groups.data.eq(Cat(*pixels))]
+        cases["default"] = group.eq(0)
+        self.comb += Case(packing, cases)
+
+        # bytes left in the buffer after the group is taken
+        rest = Signal(8*depth)
+        left = Signal(max=depth+1)
+        take = Signal()
+        self.comb += [
+            groups.valid.eq((group != 0) & (level >= group)),
+            groups.first.eq(first),
+            take.eq(groups.valid & groups.ready),
+            # the first word of a frame waits for the groups left of the previous one
+            sink.ready.eq((left <= depth - nbytes) & (~sink.first | (left < group))),
+            rest.eq(buf),
+            left.eq(level),
+            If(take,
+                left.eq(level - group),
+                Case(group, {n: rest.eq(buf[8*n:]) for n in set(g for _, g in self.formats.values())}),
+            ),
+        ]
+
+        self.sync += [
+            If(take,
+                first.eq(0),
+            ),
+            If(sink.valid & sink.ready,
+                # a frame starts with an empty buffer, the bytes left of a partial group are dropped
+                If(sink.first,
+                    buf.eq(word),
+                    level.eq(nbytes),
+                    first.eq(1),
+                ).Else(
+                    Case(left, {n: buf.eq(Cat(rest[:8*n], word)) for n in range(depth-nbytes+1)}),
+                    level.eq(left + nbytes),
+                ),
+            ).Else(
+                buf.eq(rest),
+                level.eq(left),
+            ),
+        ]
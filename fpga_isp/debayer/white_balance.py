@@ -0,0 +1,74 @@
+from migen import *
+import math
+
+from litex.soc.interconnect.csr import *
+from litex.soc.interconnect import stream
+from fpga_isp.debayer.common import *
+
+class WhiteBalance(Module, AutoCSR):
+    # gain fields of the colors of a Bayer cell
+    gain_fields = {"R": "r", "G0": "gr", "G1": "gb", "B": "b"}
+
+    # subtracts the black level from the raw pixels and multiplies them by the gain
+    # of their color, saturating at zero and at the largest pixel value, in one pipeline stage,
+    # the colors follow the pattern from the first pixel of a frame and lines of cols pixels,
+    # the CSRs are copied to shadow registers at the frame start and used for the whole frame
+    def __init__(self, pattern, cols, bpp, ppc=1):
+        self.sink = sink = stream.Endpoint([("data", bpp*ppc)])
+        self.source = source = stream.Endpoint([("data", bpp*ppc)])
+
+        self.black = CSRStorage(bpp, description="Black level subtracted from the raw pixels")
+        self.gains = CSRStorage(description="Gains of the Bayer cell colors, unsigned 8.8 fixed point, 0x100 is unity",
+            fields=[
+                CSRField("r", size=16, description="Gain of red", reset=0x100),
+                CSRField("gr", size=16, description="Gain of green in the lines with red", reset=0x100),
+                CSRField("gb", size=16, description="Gain of green in the lines with blue", reset=0x100),
+                CSRField("b", size=16, description="Gain of blue", reset=0x100),
+        ])
+
+        black, gains = frame_settings(self, sink, [self.black, self.gains])
+        gain_of = {color: gains[16*i:16*(i+1)] for i, color in enumerate(self.gain_fields)}
+
+        # beat in the line and line parity, a frame starts with an even line
+        col = Signal(13)
+        line = Signal()
+        col_in = Mux(sink.first, 0, col)
+        line_in = Mux(sink.first, 0, line)
+        line_w = cols >> int(math.log(ppc, 2))
+        self.sync += If(sink.valid & sink.ready,
+            If(col_in == line_w-1,
+                col.eq(0),
+                line.eq(~line_in),
+            ).Else(
+                col.eq(col_in + 1),
+                line.eq(line_in),
+            ),
+        )
+
+        advance = Signal()
+        self.comb += [
+            advance.eq(pipeline_advance(source.valid, source.ready)),
+            sink.ready.eq(advance),
+        ]
+        self.sync += If(advance,
+            source.valid.eq(sink.valid),
+            source.first.eq(sink.first),
+            source.last.eq(sink.last),
+        )
+        max_value = 2**bpp-1
+        for j in range(ppc):
+            pixel = sink.data[j*bpp:(j+1)*bpp]
+            # colors of the cell of the pixel, in a line the colors alternate
+            odd = (col_in[0] if ppc == 1 else 0) ^ (j % 2)
+            gain = Signal(16)
+            self.comb += Case(pattern, {p: gain.eq(Array(gain_of[color] for y in range(2) for color in layouts[p][y])[Cat(odd, line_in)])
+                                        for p in Bayer_t})
+            level = Signal(bpp)
+            product = Signal(bpp+16)
+            self.comb += [
+                level.eq(Mux(pixel > black, pixel - black, 0)),
+                product.eq(level*gain),
+            ]
+            self.sync += If(advance,
+                source.data[j*bpp:(j+1)*bpp].eq(Mux(product[8:] > max_value, max_value, product[8:])),
+            )
@@ -6,49 +6,195 @@ from litex.soc.interconnect import stream
 from fpga_isp.debayer.nearest import *
 from fpga_isp.debayer.bilinear import *
 from fpga_isp.debayer.edge_directed import *
+from fpga_isp.debayer.malvar import *
 from fpga_isp.debayer.cache import *
+from fpga_isp.debayer.unpacker import *
+from fpga_isp.debayer.formatter import *
+from fpga_isp.debayer.csc import *
+from fpga_isp.debayer.white_balance import *
+from fpga_isp.debayer.gamma import *
+from fpga_isp.debayer.ccm import *
+from fpga_isp.debayer.stats import *
+from fpga_isp.debayer.scaler import *
+from fpga_isp.debayer.crop import *
 from fpga_isp.debayer.common import *
 from litex.soc.interconnect.csr_eventmanager import *
 
+class DemosaicPerf(Module, AutoCSR):
+    def __init__(self, sink, source, cache):
+        # the per frame counters count from the end of the previous frame and
+        # are latched when the frame is decoded, the totals count since reset
+        self.in_words = CSRStatus(32, description="Input words accepted during the last frame")
+        self.in_stalls = CSRStatus(32, description="Cycles with a valid input word not accepted during the last frame")
+        self.out_stalls = CSRStatus(32, description="Cycles with a valid output word not taken by downstream during the last frame")
+        self.frame_cycles = CSRStatus(32, description="Cycles from the first input word to the end of the last frame, "
+                                                      "the frame period when the next frame started before")
+        self.lines = CSRStatus(16, description="Lines decoded in the last frame")
+        self.frames = CSRStatus(32, description="Frames decoded")
+        self.dropped = CSRStatus(32, description="Frames dropped on a stream error or restarted in the middle")
+
+        start = sink.valid & sink.ready & sink.first
+        counting = Signal()
+        next_frame = Signal()
+        self.sync += [
+            If(cache.force_reset,
+                counting.eq(start),
+                next_frame.eq(0),
+            ).Elif(cache.frame_read,
+                counting.eq(next_frame | start),
+                next_frame.eq(0),
+            ).Elif(start,
+                counting.eq(1),
+                next_frame.eq(counting),
+            ),
+        ]
+
+        events = [
+            (self.in_words, sink.valid & sink.ready),
+            (self.in_stalls, sink.valid & ~sink.ready),
+            (self.out_stalls, source.valid & ~source.ready),
+            (self.frame_cycles, counting | start),
+            (self.lines, cache.line_read),
+        ]
+        for csr, event in events:
+            count = Signal(len(csr.status))
+            self.sync += [
+                If(cache.force_reset,
+                    count.eq(0),
+                ).Elif(cache.frame_read,
+                    csr.status.eq(count + event),
+                    count.eq(0),
+                ).Elif(event,
+                    count.eq(count + 1),
+                ),
+            ]
+        self.sync += [
+            If(cache.frame_read,
+                self.frames.status.eq(self.frames.status + 1),
+            ),
+            If(cache.force_reset,
+                self.dropped.status.eq(self.dropped.status + 1),
+            ),
+        ]
+
 class DemosaicWrapper(Module, AutoCSR):
     axi_width = 32
     raw_width = 8
     input_layout  = [("data",   raw_width)]
     output_layout = [("data",   axi_width)]
+    # demosaicers which can be built, the algorithm field bit equals the Demosaic_t value
+    cores = [
+        (Demosaic_t.NEAREST,       "nearest",  NearestNeighbour),
+        (Demosaic_t.BILINEAR,      "bilinear", Bilinear),
+        (Demosaic_t.EDGE_DIRECTED, "edge",     Edge_directed),
+        (Demosaic_t.MALVAR,        "malvar",   MalvarHeCutler),
+    ]
+
+    # width of an output pixel holding three colors of given depth
+    @staticmethod
+    def pixel_width(bpp):
+        return 32 if 3*bpp <= 32 else 64
 
-    def __init__(self, demosiacer_type, streamin, streamout, cols, rows, pattern, in_reverse=False, out_reverse=False):
+    def __init__(self, demosiacer_type, streamin, streamout, cols, rows, pattern, in_reverse=False, out_reverse=False, ppc=1, sync_read=False,
+                 max_width=None, max_height=None, pack=None, rotate=False, pipeline=0, algorithms=None, perf_counters=False,
+                 bpp=8, out_bpp=None, unpacker=False, packing=Packing_t.NONE, out_width=None, out_format=Format_t.XRGB,
+                 csc=False, matrix=Matrix_t.BT601, white_balance=False, gamma=False, ccm=False, stats=False, dpc=False, scaler=False, crop=False):
         im_w_bits = 13
         im_h_bits = 13
+        # raw pixels deeper than 8 bits come in 16-bit containers, right aligned,
+        # the output colors keep the out_bpp most significant bits
+        assert(bpp <= 16)
+        if out_bpp is None:
+            out_bpp = bpp
+        assert(out_bpp <= bpp)
+        self.bpp = bpp
+        self.out_bpp = out_bpp
+        self.raw_width = 8 if bpp <= 8 else 16
+        self.pix_width = self.pixel_width(out_bpp)
+        # pixels processed per clock, input and output words are widened accordingly
+        assert(ppc in [1, 2, 4])
+        assert(self.raw_width*ppc <= self.axi_width)
+        # with out_width the output words are packed by the formatter, otherwise they hold ppc pixels,
+        # the YUV formats need the formatter
+        assert(not csc or out_width is not None)
+        assert(len(streamout.data) == (self.pix_width*ppc if out_width is None else out_width))
+        self.ppc = ppc
+        # input packing, selected by the packing CSR field
+        self.packing = Signal(2)
+        # line buffers are sized for max_width, by default for the widest image fitting in the CSR
+        assert(max_width is None or cols <= max_width)
+        assert(max_height is None or rows <= max_height)
+        # only the listed demosaicers are built, by default all of them
+        if algorithms is None:
+            algorithms = [t for t, _, _ in self.cores]
+        cores = [(t, name, core) for t, name, core in self.cores if t in algorithms]
+        assert(len(cores) > 0 and len(cores) == len(set(algorithms)))
+        built = sum(int(t) for t, _, _ in cores)
+        assert(int(demosiacer_type) & ~built == 0)
         self.submodules.raw_converter = raw_converter = stream.Converter(self.axi_width,
-                                                                          self.raw_width,
+                                                                          self.raw_width*ppc,
                                                                           reverse=in_reverse)
-        self.input  = input  = stream.Endpoint(self.input_layout)
-        self.output = output = stream.Endpoint(self.output_layout)
+        self.input  = input  = stream.Endpoint([("data", bpp*ppc)])
+        self.output = output = stream.Endpoint([("data", self.pix_width*ppc)])
+        # raw pixels of the converter or the unpacker, ahead of the crop and the white balance
+        pixels = stream.Endpoint([("data", bpp*ppc)]) if white_balance or crop else input
         self.comb += [
             raw_converter.sink.data.eq(streamin.data),
-            raw_converter.sink.valid.eq(streamin.valid),
-            streamin.ready.eq(raw_converter.sink.ready),
             raw_converter.sink.last.eq(streamin.last),
             raw_converter.sink.first.eq(streamin.first),
-
-            output.ready.eq(streamout.ready),
-            streamout.valid.eq(output.valid),
-            streamout.last.eq(output.last),
-            streamout.first.eq(output.first),
-
-            input.first.eq(raw_converter.source.first),
-            raw_converter.source.ready.eq(input.ready),
-            input.valid.eq(raw_converter.source.valid),
-            input.data.eq(raw_converter.source.data),
         ]
+        # in reversed mode the first pixel of a word is in its MSBs,
+        # the cache expects it in the LSBs
+        raw_pixels = [raw_converter.source.data[i*self.raw_width:i*self.raw_width+bpp] for i in range(ppc)]
+        if in_reverse:
+            raw_pixels.reverse()
+        converted = [
+            raw_converter.sink.valid.eq(streamin.valid),
+            streamin.ready.eq(raw_converter.sink.ready),
+            pixels.data.eq(Cat(*raw_pixels)),
+            pixels.first.eq(raw_converter.source.first),
+            raw_converter.source.ready.eq(pixels.ready),
+            pixels.valid.eq(raw_converter.source.valid),
+        ]
+        # MIPI packed input goes through the unpacker instead of the converter
+        packed = Signal()
+        if unpacker:
+            assert(bpp >= 10 and ppc <= 2)
+            self.submodules.unpacker = unpacker = MipiUnpacker(self.packing, bpp, ppc, self.axi_width, reverse=in_reverse)
+            self.comb += [
+                unpacker.sink.data.eq(streamin.data),
+                unpacker.sink.first.eq(streamin.first),
+                unpacker.sink.last.eq(streamin.last),
+                If(packed,
+                    unpacker.sink.valid.eq(streamin.valid),
+                    streamin.ready.eq(unpacker.sink.ready),
+                    unpacker.source.connect(pixels, omit={"last"}),
+                ).Else(
+                    converted,
+                ),
+            ]
+        else:
+            self.comb += converted
 
         self.demo_ctl = CSRStorage(description="Demosaicer control regiser",
             fields=[
-                CSRField("algorithm", size=3, description="Enable specified demosaicer. 0x1 - nearest, 0x2 - bilinear, 0x4 - edge", reset=int(demosiacer_type)),
+                CSRField("algorithm", size=4, description="Enable specified demosaicer. " +
+                    ", ".join("{:#x} - {}".format(int(t), name) for t, name, _ in cores) +
+                    ", other demosaicers are not built and ignored", reset=int(demosiacer_type)),
                 CSRField("busy", size=1, description="Light up when one of implemented algorithms work", reset=0),
                 CSRField("pattern", size=2, description="Set decoding pattern", reset=pattern),
                 CSRField("bgr", size=1, description="If set, output the data in BGR format, normaly RGB", reset=out_reverse),
+                CSRField("packing", size=2, description="Input packing: 0 - none, 1 - MIPI RAW10, 2 - MIPI RAW12, "
+                    "packed input is used only with the unpacker built", reset=packing),
+                CSRField("format", size=3, description="Output format: 0 - XRGB, 1 - RGB888 packed, 2 - RGB565, "
+                    "3 - YUYV, 4 - YUV420_LINES, 5 - Y8, used only with the output formatter built, YUV with the color space converter",
+                    reset=out_format),
+                CSRField("matrix", size=1, description="YUV conversion matrix: 0 - BT.601, 1 - BT.709", reset=matrix),
         ])
+        self.comb += [
+            self.packing.eq(self.demo_ctl.fields.packing),
+            packed.eq((self.packing == Packing_t.RAW10) | (self.packing == Packing_t.RAW12)),
+        ]
 
         self.demo_im_ctl = CSRStorage(description="Demosaicer control image size regiser",
             fields=[
@@ -56,17 +202,41 @@ class DemosaicWrapper(Module, AutoCSR):
                 CSRField("rows", size=im_h_bits, description="Set currently processing image height", reset=rows),
         ])
 
+        # image decoded by the cache and the demosaicers and lines of the output frames,
+        # the whole frame or the window of the optional crop, exposed as crop_* CSRs
+        im_w = self.demo_im_ctl.fields.cols
+        im_h = self.demo_im_ctl.fields.rows
+        out_h = im_h
+        if crop:
+            self.submodules.crop = Crop(im_w, im_h, bpp, self.pix_width, ppc, size=(cols, rows))
+            self.comb += pixels.connect(self.crop.sink)
+            pixels = self.crop.source
+            im_w, im_h, out_h = self.crop.cols, self.crop.rows, self.crop.height
+
+        # optional black level and white balance gains of the raw pixels, exposed as wb_* CSRs
+        if white_balance:
+            self.submodules.wb = WhiteBalance(self.demo_ctl.fields.pattern, im_w, bpp, ppc)
+            self.comb += [
+                pixels.connect(self.wb.sink),
+                self.wb.source.connect(input, omit={"last"}),
+            ]
+        elif crop:
+            self.comb += pixels.connect(input, omit={"last"})
+
         last_cnt = Signal(im_w_bits)
+        # line width in input words
+        line_w = im_w >> int(math.log(ppc, 2))
         working  = Signal()
         cache_reset = Signal()
         self.sync += [
-            If(raw_converter.source.valid & raw_converter.source.ready & working,
+            If(input.valid & input.ready & working,
                 last_cnt.eq(last_cnt+1),
             ),
-            If((last_cnt == (self.demo_im_ctl.fields.cols-1)) & streamin.last,
+            # the count of the last word holds until it is taken
+            If(input.valid & input.ready & input.last,
                 last_cnt.eq(0),
             ),
-            If(raw_converter.source.first,
+            If(input.first,
                 If(~cache_reset,
                     last_cnt.eq(1),
                 ).Else(
@@ -75,7 +245,7 @@ class DemosaicWrapper(Module, AutoCSR):
             ),
         ]
         self.comb += [
-            If((last_cnt == (self.demo_im_ctl.fields.cols-1)) & streamin.last,
+            If((last_cnt == (line_w-1)) & streamin.last,
                 input.last.eq(1),
             ).Else(
                 input.last.eq(0),
@@ -85,67 +255,133 @@ class DemosaicWrapper(Module, AutoCSR):
         self.submodules.ev = EventManager()
         self.ev.error = EventSourcePulse(description="data underflow/overflow")
 
+        # optional defect pixel correction in front of the cache line buffers
+        if dpc:
+            self.dpc_ctl = CSRStorage(description="Defect pixel correction control register",
+                fields=[
+                    CSRField("enable", size=1, description="Replace the pixels differing from all of their same color "
+                                                           "neighbours by more than the threshold", reset=0),
+                    CSRField("threshold", size=bpp, description="Threshold of the defect pixels", reset=2**bpp//8),
+            ])
+
         treshold = Signal(2)
-        self.submodules.cache = DemosaicCache(bpp=8,
-                                              mem_chunks=6,
+        # the cache is sized for the largest kernel of the built demosaicers
+        self.submodules.cache = DemosaicCache(bpp=bpp,
+                                              mem_chunks=max(core.cache_chunks for _, _, core in cores),
                                               streamin=input,
-                                              im_w=self.demo_im_ctl.fields.cols,
-                                              im_h=self.demo_im_ctl.fields.rows,
+                                              im_w=im_w,
+                                              im_h=im_h,
                                               mem_treshold=treshold,
-                                              u_reset=self.ev.irq)
+                                              u_reset=self.ev.irq,
+                                              ppc=ppc,
+                                              sync_read=sync_read,
+                                              max_width=max_width,
+                                              max_height=max_height,
+                                              pack=pack,
+                                              dpc=(self.dpc_ctl.fields.enable, self.dpc_ctl.fields.threshold) if dpc else None)
         self.comb += [
             cache_reset.eq(self.cache.frame_sync_incorrect),
             self.ev.error.trigger.eq(self.cache.error),
         ]
+        # optional stream performance counters, exposed as perf_* CSRs
+        if perf_counters:
+            self.submodules.perf = DemosaicPerf(input, output, self.cache)
+        if max_width is not None or max_height is not None:
+            self.ev.size_error = EventSourceLevel(description="image size above the supported maximum, input is stalled")
+            self.comb += self.ev.size_error.trigger.eq(self.cache.size_error)
 
-        self.comb += [
-            If(self.demo_ctl.fields.bgr,
-                streamout.data.eq(Cat(output.data[24:32],
-                                  output.data[16:24],
-                                  output.data[8:16],
-                                  output.data[0:8],)),
-            ).Else(
-                streamout.data.eq(output.data)
-            ),
-        ]
+        # the decoded margin of the window is dropped
+        rgb = output
+        if crop:
+            self.comb += rgb.connect(self.crop.rgb_sink)
+            rgb = self.crop.rgb_source
+
+        # optional statistics of the decoded pixels, exposed as stats_* CSRs, with their own event
+        if stats:
+            self.submodules.stats = Statistics(rgb, out_h, out_bpp, self.pix_width, ppc,
+                                               size=(cols, rows))
+
+        # optional color correction matrix of the decoded pixels, exposed as ccm_* CSRs
+        if ccm:
+            self.submodules.ccm = ColorCorrection(out_bpp, self.pix_width, ppc)
+            self.comb += rgb.connect(self.ccm.sink)
+            rgb = self.ccm.source
+
+        # optional per channel lookup tables of the corrected pixels, exposed as gamma_* CSRs
+        if gamma:
+            self.submodules.gamma = GammaLUT(out_bpp, self.pix_width, ppc)
+            self.comb += rgb.connect(self.gamma.sink)
+            rgb = self.gamma.source
+
+        # optional downscaler of the pixels sent out, exposed as scaler_* CSRs
+        if scaler:
+            self.submodules.scaler = Scaler(out_bpp, self.pix_width, ppc, max_width=max_width or 2**im_w_bits-1,
+                                            size=(cols, rows))
+            self.comb += rgb.connect(self.scaler.sink)
+            rgb = self.scaler.source
 
-        self.active = Signal(3)
+        # pixels are blue, green, red from the LSBs, in BGR format
+        # the colors are reversed and aligned to the MSBs
+        if out_width is not None:
+            pixels = rgb
+            fmt = self.demo_ctl.fields.format
+            # optional YUV conversion, the luma only lines of YUV420_LINES are packed as Y8
+            if csc:
+                self.submodules.csc = RGB2YUV(self.demo_ctl.fields.matrix, fmt, out_bpp, self.pix_width, ppc)
+                self.comb += rgb.connect(self.csc.sink)
+                pixels = self.csc.source
+                fmt = Mux(self.csc.luma_only, Format_t.Y8, fmt)
+            self.submodules.formatter = formatter = OutputFormatter(fmt, self.demo_ctl.fields.bgr,
+                                                                    out_bpp, self.pix_width, ppc, out_width, yuv=csc)
+            self.comb += [
+                pixels.connect(formatter.sink),
+                formatter.source.connect(streamout),
+            ]
+        else:
+            self.comb += [
+                rgb.ready.eq(streamout.ready),
+                streamout.valid.eq(rgb.valid),
+                streamout.last.eq(rgb.last),
+                streamout.first.eq(rgb.first),
+            ]
+            for i in range(ppc):
+                pixel = rgb.data[i*self.pix_width:(i+1)*self.pix_width]
+                b, g, r = [pixel[c*out_bpp:(c+1)*out_bpp] for c in range(3)]
+                self.comb += streamout.data[i*self.pix_width:(i+1)*self.pix_width].eq(
+                    OutputFormatter.format_pixel(Format_t.XRGB, b, g, r, self.demo_ctl.fields.bgr, self.pix_width))
+
+        self.active = Signal(4)
         self.busy = Signal()
-        self.submodules.nearest = NearestNeighbour(
-                self.demo_im_ctl.fields.cols,
-                self.demo_im_ctl.fields.rows,
-                self.demo_ctl.fields.pattern,
-                output,
-                enable=self.active[0],
-                cache=self.cache)
-        self.submodules.bilinear = Bilinear(
-                self.demo_im_ctl.fields.cols,
-                self.demo_im_ctl.fields.rows,
-                self.demo_ctl.fields.pattern,
-                output,
-                enable=self.active[1],
-                cache=self.cache)
-        self.submodules.edge = Edge_directed(
-                self.demo_im_ctl.fields.cols,
-                self.demo_im_ctl.fields.rows,
-                self.demo_ctl.fields.pattern,
-                output,
-                enable=self.active[2],
-                cache=self.cache)
+        # writes of the algorithm bits of demosaicers which are not built are ignored
+        algorithm = self.demo_ctl.fields.algorithm & built
+        demosaicers = []
+        for t, name, core in cores:
+            bit = int(math.log(int(t), 2))
+            demosaicer = core(im_w,
+                              im_h,
+                              self.demo_ctl.fields.pattern,
+                              output,
+                              enable=self.active[bit],
+                              cache=self.cache,
+                              ppc=ppc,
+                              rotate=rotate,
+                              pipeline=pipeline,
+                              out_bpp=out_bpp)
+            setattr(self.submodules, name, demosaicer)
+            demosaicers.append((bit, demosaicer))
 
+        # a demosaicer is switched on only when the others are idle and stays on until it finishes the frame
+        for bit, demosaicer in demosaicers:
+            others = [d.busy for _, d in demosaicers if d is not demosaicer]
+            idle = (Cat(*others) == 0) if others else 1
+            self.comb += self.active[bit].eq(algorithm[bit] & idle | demosaicer.busy)
         self.comb += [
-            self.active[0].eq(self.demo_ctl.fields.algorithm[0] & ~self.bilinear.working & ~self.edge.working | self.nearest.working),
-            self.active[1].eq(self.demo_ctl.fields.algorithm[1] & ~self.nearest.working & ~self.edge.working | self.bilinear.working),
-            self.active[2].eq(self.demo_ctl.fields.algorithm[2] & ~self.nearest.working & ~self.bilinear.working | self.edge.working),
-            working.eq(self.nearest.working | self.bilinear.working | self.edge.working),
-            self.demo_ctl.fields.busy.eq(working),
+            working.eq(Cat(*[d.working for _, d in demosaicers]) != 0),
+            self.demo_ctl.fields.busy.eq(Cat(*[d.busy for _, d in demosaicers]) != 0),
             self.busy.eq(self.demo_ctl.fields.busy),
-
-            If(self.active[0],
-                treshold.eq(0),
-            ).Elif(self.active[1],
-                treshold.eq(1),
-            ).Else(
-                treshold.eq(2),
-            )
         ]
+
+        # lines kept in the cache follow the active demosaicer, the largest kernel by default
+        self.comb += treshold.eq(max(core.cache_treshold for _, _, core in cores))
+        for bit, demosaicer in reversed(demosaicers):
+            self.comb += If(self.active[bit], treshold.eq(demosaicer.cache_treshold))